@@ -1,4 +1,5 @@
 import os
+import sys
 
 os.environ["PYTORCH_ENABLE_MPS_FALLBACK"] = "1"
 
@@ -10,6 +11,18 @@ from lama_cleaner.parse_args import parse_args
 
 
 def entry_point():
+    if len(sys.argv) > 1 and sys.argv[1] == "batch":
+        from lama_cleaner.batch_processing import parse_batch_args, main
+
+        main(parse_batch_args(sys.argv[2:]))
+        return
+
+    if len(sys.argv) > 1 and sys.argv[1] == "export":
+        from lama_cleaner.export import parse_export_args, main
+
+        main(parse_export_args(sys.argv[2:]))
+        return
+
     args = parse_args()
     # To make os.environ["XDG_CACHE_HOME"] = args.model_cache_dir works for diffusers
     # https://github.com/huggingface/diffusers/blob/be99201a567c1ccd841dc16fb24e88f7f239c187/src/diffusers/utils/constants.py#L18
@@ -38,6 +38,15 @@ export default async function inpaint(
     'hdStrategyResizeLimit',
     hdSettings.hdStrategyResizeLimit.toString()
   )
+  if (hdSettings.hdStrategyTileSize !== undefined) {
+    fd.append('hdStrategyTileSize', hdSettings.hdStrategyTileSize.toString())
+  }
+  if (hdSettings.hdStrategyTileOverlap !== undefined) {
+    fd.append(
+      'hdStrategyTileOverlap',
+      hdSettings.hdStrategyTileOverlap.toString()
+    )
+  }
 
   fd.append('prompt', prompt === undefined ? '' : prompt)
   fd.append(
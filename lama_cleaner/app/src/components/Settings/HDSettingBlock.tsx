@@ -9,8 +9,14 @@ export enum HDStrategy {
   ORIGINAL = 'Original',
   RESIZE = 'Resize',
   CROP = 'Crop',
+  TILE = 'Tile',
+  PYRAMID = 'Pyramid',
 }
 
+// same as the server defaults
+const DEFAULT_TILE_SIZE = 1024
+const DEFAULT_TILE_OVERLAP = 128
+
 export enum LDMSampler {
   ddim = 'ddim',
   plms = 'plms',
@@ -41,6 +47,16 @@ function HDSettingBlock() {
     setHDSettings({ hdStrategyCropMargin: val })
   }
 
+  const onTileSizeChange = (value: string) => {
+    const val = value.length === 0 ? 0 : parseInt(value, 10)
+    setHDSettings({ hdStrategyTileSize: val })
+  }
+
+  const onTileOverlapChange = (value: string) => {
+    const val = value.length === 0 ? 0 : parseInt(value, 10)
+    setHDSettings({ hdStrategyTileOverlap: val })
+  }
+
   const renderOriginalOptionDesc = () => {
     return (
       <div>
@@ -104,6 +120,46 @@ function HDSettingBlock() {
     )
   }
 
+  const renderTileOptionDesc = () => {
+    return (
+      <>
+        <div>
+          Split the image into overlapping tiles and inpaint the tiles
+          containing mask, uses little GPU memory on huge pictures.
+        </div>
+        <NumberInputSetting
+          title="Tile size"
+          value={`${hdSettings.hdStrategyTileSize ?? DEFAULT_TILE_SIZE}`}
+          suffix="pixel"
+          onValue={onTileSizeChange}
+        />
+        <NumberInputSetting
+          title="Tile overlap"
+          value={`${hdSettings.hdStrategyTileOverlap ?? DEFAULT_TILE_OVERLAP}`}
+          suffix="pixel"
+          onValue={onTileOverlapChange}
+        />
+      </>
+    )
+  }
+
+  const renderPyramidOptionDesc = () => {
+    return (
+      <>
+        <div>
+          Inpaint the resized image for the overall structure, then refine the
+          mask border in original size.
+        </div>
+        <NumberInputSetting
+          title="Size limit"
+          value={`${hdSettings.hdStrategyResizeLimit}`}
+          suffix="pixel"
+          onValue={onResizeLimitChange}
+        />
+      </>
+    )
+  }
+
   const renderHDStrategyOptionDesc = (): ReactNode => {
     switch (hdSettings.hdStrategy) {
       case HDStrategy.ORIGINAL:
@@ -112,6 +168,10 @@ function HDSettingBlock() {
         return renderCropOptionDesc()
       case HDStrategy.RESIZE:
         return renderResizeOptionDesc()
+      case HDStrategy.TILE:
+        return renderTileOptionDesc()
+      case HDStrategy.PYRAMID:
+        return renderPyramidOptionDesc()
       default:
         return renderOriginalOptionDesc()
     }
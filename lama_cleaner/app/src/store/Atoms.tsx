@@ -413,6 +413,9 @@ export interface HDSettings {
   hdStrategyResizeLimit: number
   hdStrategyCropTrigerSize: number
   hdStrategyCropMargin: number
+  // optional, settings saved by older versions don't have them
+  hdStrategyTileSize?: number
+  hdStrategyTileOverlap?: number
   enabled: boolean
 }
 
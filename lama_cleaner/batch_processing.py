@@ -0,0 +1,244 @@
+import argparse
+import collections
+import json
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+import cv2
+import torch
+from PIL import Image
+from loguru import logger
+
+from lama_cleaner.const import *
+from lama_cleaner.file_manager.utils import glob_img
+from lama_cleaner.helper import concat_alpha_channel, load_img, pil_to_bytes
+from lama_cleaner.model_manager import ModelManager
+from lama_cleaner.schema import Config, HDStrategy
+
+
+def parse_batch_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="lama-cleaner batch",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument(
+        "--image", required=True, type=str, help="Image file or image directory"
+    )
+    parser.add_argument(
+        "--mask",
+        required=True,
+        type=str,
+        help="Mask file or mask directory. If it's a directory, masks are paired with "
+        "images by file name (without suffix). If it's a file, it's used for all images.",
+    )
+    parser.add_argument(
+        "--output", required=True, type=str, help="Result images output directory"
+    )
+    parser.add_argument("--model", default=DEFAULT_MODEL, choices=AVAILABLE_MODELS)
+    parser.add_argument(
+        "--device", default=DEFAULT_DEVICE, type=str, choices=AVAILABLE_DEVICES
+    )
+    parser.add_argument(
+        "--config",
+        default=None,
+        type=str,
+        help="Json file of inpainting config, see lama_cleaner/schema.py Config",
+    )
+    parser.add_argument("--no-half", action="store_true", help=NO_HALF_HELP)
+    parser.add_argument(
+        "--precision", default="auto", choices=AVAILABLE_PRECISIONS, help=PRECISION_HELP
+    )
+    parser.add_argument("--quality", default=95, type=int, help=QUALITY_HELP)
+    parser.add_argument(
+        "--batch-size",
+        default=1,
+        type=int,
+        help="Number of images run in one forward, images are grouped by padded size",
+    )
+    parser.add_argument(
+        "--decode-workers", default=4, type=int, help="Number of image decode threads"
+    )
+    parser.add_argument(
+        "--encode-workers", default=4, type=int, help="Number of image encode threads"
+    )
+    parser.add_argument(
+        "--prefetch",
+        default=16,
+        type=int,
+        help="Max number of decoded images waiting for the model",
+    )
+    parser.add_argument("--recursive", action="store_true")
+    args = parser.parse_args(argv)
+
+    if args.device == "cuda" and not torch.cuda.is_available():
+        parser.error("torch.cuda.is_available() is False, please use --device cpu")
+    if not Path(args.image).exists():
+        parser.error(f"invalid --image: {args.image} not exists")
+    if not Path(args.mask).exists():
+        parser.error(f"invalid --mask: {args.mask} not exists")
+    if Path(args.output).is_file():
+        parser.error(f"invalid --output: {args.output} is a file")
+    if args.batch_size < 1:
+        parser.error(f"invalid --batch-size: {args.batch_size} < 1")
+    if args.prefetch < args.batch_size:
+        parser.error("--prefetch must be larger than or equal to --batch-size")
+    return args
+
+
+def load_config(config_path) -> Config:
+    if config_path is None:
+        return Config(
+            ldm_steps=25,
+            hd_strategy=HDStrategy.CROP,
+            hd_strategy_crop_margin=196,
+            hd_strategy_crop_trigger_size=800,
+            hd_strategy_resize_limit=2048,
+        )
+    with open(config_path, "r", encoding="utf-8") as f:
+        return Config(**json.load(f))
+
+
+def pair_image_mask(image, mask, recursive: bool = False):
+    image_paths = sorted(glob_img(image, recursive))
+    if Path(mask).is_file():
+        return [(it, Path(mask)) for it in image_paths]
+
+    mask_paths = {it.stem: it for it in glob_img(mask, recursive)}
+    pairs = []
+    for it in image_paths:
+        if it.stem not in mask_paths:
+            logger.warning(f"Mask of {it} not found, skip")
+            continue
+        pairs.append((it, mask_paths[it.stem]))
+    return pairs
+
+
+def decode(image_path: Path, mask_path: Path):
+    start = time.time()
+    image, alpha_channel, exif_infos = load_img(
+        image_path.read_bytes(), return_exif=True
+    )
+    mask, _ = load_img(mask_path.read_bytes(), gray=True)
+    mask = cv2.threshold(mask, 127, 255, cv2.THRESH_BINARY)[1]
+    if mask.shape[:2] != image.shape[:2]:
+        mask = cv2.resize(
+            mask, (image.shape[1], image.shape[0]), interpolation=cv2.INTER_NEAREST
+        )
+    return image_path, image, mask, alpha_channel, exif_infos, time.time() - start
+
+
+def encode(
+    save_path: Path, bgr_np_img, alpha_channel, exif_infos, quality: int
+) -> float:
+    start = time.time()
+    rgb_np_img = cv2.cvtColor(bgr_np_img.astype("uint8"), cv2.COLOR_BGR2RGB)
+    rgb_np_img = concat_alpha_channel(rgb_np_img, alpha_channel)
+    ext = save_path.suffix.strip(".").lower()
+    if ext == "jpg":
+        ext = "jpeg"
+    img_bytes = pil_to_bytes(
+        Image.fromarray(rgb_np_img), ext, quality=quality, exif_infos=exif_infos
+    )
+    save_path.write_bytes(img_bytes)
+    return time.time() - start
+
+
+def main(args):
+    pairs = pair_image_mask(args.image, args.mask, args.recursive)
+    if not pairs:
+        logger.warning(f"No image found in {args.image}")
+        return
+
+    output_dir = Path(args.output)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    config = load_config(args.config)
+    model = ModelManager(
+        name=args.model,
+        device=torch.device(args.device),
+        no_half=args.no_half,
+        precision=args.precision,
+        hf_access_token="",
+        disable_nsfw=False,
+        sd_cpu_textencoder=False,
+        sd_run_local=False,
+        local_files_only=False,
+        cpu_offload=False,
+        enable_xformers=False,
+    )
+    logger.info(f"Processing {len(pairs)} images with {args.model}")
+
+    # seconds spent in each stage, decode/encode are summed over all worker threads
+    stage_times = collections.defaultdict(float)
+    decode_pool = ThreadPoolExecutor(args.decode_workers, "decode")
+    encode_pool = ThreadPoolExecutor(args.encode_workers, "encode")
+    pending_decode = collections.deque()
+    pending_encode = collections.deque()
+    next_pair = 0
+
+    def fill_decode_queue():
+        nonlocal next_pair
+        while next_pair < len(pairs) and len(pending_decode) < args.prefetch:
+            pending_decode.append(decode_pool.submit(decode, *pairs[next_pair]))
+            next_pair += 1
+
+    def drain_encode_queue(max_pending: int):
+        while len(pending_encode) > max_pending:
+            stage_times["encode"] += pending_encode.popleft().result()
+
+    start = time.time()
+    num_processed = 0
+    fill_decode_queue()
+    while pending_decode:
+        wait_start = time.time()
+        batch = []
+        while pending_decode and len(batch) < args.batch_size:
+            batch.append(pending_decode.popleft().result())
+        stage_times["wait_decode"] += time.time() - wait_start
+        fill_decode_queue()
+
+        for it in batch:
+            stage_times["decode"] += it[-1]
+
+        forward_start = time.time()
+        if len(batch) == 1:
+            results = [model(batch[0][1], batch[0][2], config)]
+        else:
+            results = model.inpaint_batch(
+                [it[1] for it in batch], [it[2] for it in batch], config
+            )
+        stage_times["forward"] += time.time() - forward_start
+
+        for (image_path, _, _, alpha_channel, exif_infos, _), result in zip(
+            batch, results
+        ):
+            pending_encode.append(
+                encode_pool.submit(
+                    encode,
+                    output_dir / image_path.name,
+                    result,
+                    alpha_channel,
+                    exif_infos,
+                    args.quality,
+                )
+            )
+        num_processed += len(batch)
+
+        wait_start = time.time()
+        drain_encode_queue(args.prefetch)
+        stage_times["wait_encode"] += time.time() - wait_start
+
+    drain_encode_queue(0)
+    decode_pool.shutdown()
+    encode_pool.shutdown()
+    total_time = time.time() - start
+
+    logger.info(
+        f"Processed {num_processed} images in {total_time:.2f}s, "
+        f"{num_processed / total_time:.2f} images/s"
+    )
+    for stage in ["decode", "forward", "encode", "wait_decode", "wait_encode"]:
+        seconds = stage_times[stage]
+        logger.info(
+            f"{stage}: total {seconds:.2f}s, {seconds / num_processed * 1000:.2f}ms/image"
+        )
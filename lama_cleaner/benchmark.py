@@ -10,7 +10,7 @@ import psutil
 import torch
 
 from lama_cleaner.model_manager import ModelManager
-from lama_cleaner.schema import Config, HDStrategy, SDSampler
+from lama_cleaner.warmup import run_model
 
 try:
     torch._C._jit_override_can_fuse_on_cpu(False)
@@ -31,24 +31,6 @@ if os.environ.get("CACHE_DIR"):
     os.environ["TORCH_HOME"] = os.environ["CACHE_DIR"]
 
 
-def run_model(model, size):
-    # RGB
-    image = np.random.randint(0, 256, (size[0], size[1], 3)).astype(np.uint8)
-    mask = np.random.randint(0, 255, size).astype(np.uint8)
-
-    config = Config(
-        ldm_steps=2,
-        hd_strategy=HDStrategy.ORIGINAL,
-        hd_strategy_crop_margin=128,
-        hd_strategy_crop_trigger_size=128,
-        hd_strategy_resize_limit=128,
-        prompt="a fox is sitting on a bench",
-        sd_steps=5,
-        sd_sampler=SDSampler.ddim
-    )
-    model(image, mask, config)
-
-
 def benchmark(model, times: int, empty_cache: bool):
     sizes = [(512, 512)]
 
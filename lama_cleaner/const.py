@@ -31,6 +31,7 @@ AVAILABLE_MODELS = [
     "instruct_pix2pix",
 ]
 SD15_MODELS = ["sd1.5", "anything4", "realisticVision1.4"]
+DIFFUSION_MODELS = SD15_MODELS + ["sd2", "paint_by_example", "instruct_pix2pix"]
 
 AVAILABLE_DEVICES = ["cuda", "cpu", "mps"]
 DEFAULT_DEVICE = "cuda"
@@ -103,6 +104,95 @@ QUALITY_HELP = """
 Quality of image encoding, 0-100. Default is 95, higher quality will generate larger file size.
 """
 
+PNG_COMPRESS_LEVEL_HELP = """
+zlib compression level of PNG results, 0-9. Default is 6(PIL's default). Lower level encodes faster but generates larger file, level 1 is several times faster than 6 on large images.
+Results are sent as WebP if the client prefers image/webp in Accept header, e.g: image/webp,*/*;q=0.8
+"""
+
+MAX_SESSIONS_HELP = """
+Max number of image editing sessions kept in memory. A session stores the decoded image, /inpaint with sessionId only uploads the mask and the result becomes the session image. 0(default) disables sessions.
+"""
+
+RESULT_CACHE_SIZE_HELP = """
+Size(MB) of the in-memory cache of /inpaint results. Resubmitting the same image, mask and settings returns the cached result without running the model, e.g: 128. 0(default) disables the cache.
+"""
+
+MAX_BATCH_SIZE_HELP = """
+Max number of image/mask pairs in one /inpaint_batch request.
+"""
+
+MAX_QUEUE_SIZE_HELP = """
+Max number of inpaint/plugin requests waiting for the model. When the queue is full, new requests are rejected with 429, e.g: 8. 0(default) means unbounded.
+"""
+
+REPLICAS_HELP = """
+Number of model replicas, each replica runs one request at a time, each replica has its own inference worker taking requests from the queue. CPU replicas get an even share of the available CPU cores, their worker is pinned to them and runs torch with that many threads.
+"""
+
+REPLICA_DEVICES_HELP = """
+Device of each replica, overrides --device and --replicas. e.g: cuda:0 cuda:1, or cpu:0-15 cpu:16-31 to pin replicas to CPU cores(one replica per NUMA socket).
+"""
+
+TRACE_DIR_HELP = """
+Trace every inpaint/plugin request and save it to this directory in Chrome trace format(open with chrome://tracing or ui.perfetto.dev). Without it, only requests with X-Trace header are traced, get them from /trace/<X-Trace-Id>.
+"""
+
+WARMUP_HELP = """
+Run the model on random images of --warmup-sizes with --warmup-strategies before serving, so the first request is not slowed down by model compilation. /ready returns 503 until warmup finished.
+"""
+
+WARMUP_SIZES_HELP = """
+Image sizes used by --warmup, in WIDTHxHEIGHT format, e.g: 512x512 1024x768
+"""
+
+SHAPE_BUCKETS_HELP = """
+Pad model inputs up to the smallest of these sizes(each side) instead of the next multiple of 8, e.g: 512 768 1024 1536 2048. Fewer distinct shapes means TorchScript and oneDNN don't specialize again for every new image size. Sides larger than all buckets are padded as usual. Use with --warmup-sizes of the buckets.
+"""
+
+OOM_FALLBACK_HELP = """
+When a request runs out of memory, free memory and retry it with Crop strategy, then Tile strategy with 512 pixel tiles, then Resize strategy with decreasing limit(smaller sd scale for diffusion models) instead of failing it. The strategy finally used is returned in X-HD-Strategy header.
+"""
+
+AVAILABLE_BACKENDS = ["torch", "onnxruntime"]
+BACKEND_HELP = """
+Runtime to run the model with. onnxruntime only supports lama and needs onnxruntime(or onnxruntime-gpu) installed. The onnx model is exported(needs onnx installed) from big-lama.pt on first use, or ahead of time with `lama-cleaner export --model lama --format onnx`.
+"""
+ONNX_MODEL_HELP = """
+Path of the exported onnx model used by onnxruntime backend, default is big-lama.onnx in the model cache directory.
+"""
+ONNX_INTRA_OP_THREADS_HELP = """
+Threads onnxruntime uses to run one operator, 0 lets onnxruntime decide(one per physical core).
+"""
+ONNX_INTER_OP_THREADS_HELP = """
+Threads onnxruntime uses to run independent operators in parallel, 0 or 1 runs operators sequentially.
+"""
+
+AVAILABLE_PRECISIONS = ["auto", "fp32", "bf16", "fp16"]
+PRECISION_HELP = """
+Numeric precision of all models. auto: fp16 on cuda for models running in half precision before(unless --no-half), fp32 otherwise. fp16 only works on cuda, bf16 on cuda and cpus with native bf16, models fall back to fp32 on other devices. Compare a precision with fp32 with `python -m lama_cleaner.precision`.
+"""
+
+# queue: wait until enough memory is free, reject requests larger than the budget
+# reject: also reject requests when the memory is used by running jobs
+# downgrade: like queue, run requests larger than the budget with crop/resize strategy
+MEMORY_POLICIES = ["queue", "reject", "downgrade"]
+
+MEMORY_BUDGET_HELP = """
+Memory(MB) of each device inpaint requests can use, or auto(90% of free VRAM, 80% of available RAM). Peak memory of every request is estimated from a memory profile of the model calibrated at startup, requests larger than the budget are rejected with 413, others wait until enough memory is free. 0 to disable.
+"""
+
+MEMORY_POLICY_HELP = """
+What to do with requests exceeding --memory-budget. queue: wait for running jobs, reject too large requests. reject: also reject with 503 when the memory is used by running jobs. downgrade: like queue, run too large requests with Crop/Resize strategy(smaller sd scale for diffusion models) instead.
+"""
+
+MEMORY_PROFILE_HELP = """
+JSON file to save calibrated memory profiles of models, loaded at startup to skip calibration. Create it with: python -m lama_cleaner.memory_estimator --output PATH
+"""
+
+MODEL_CACHE_SIZE_HELP = """
+Size(MB) of RAM/VRAM used to keep models loaded after switching to another model, switching back to a loaded model needs no reload. Least recently used models are released when exceeded. 0 means only keep the current model.
+"""
+
 
 class RealESRGANModelName(str, Enum):
     realesr_general_x4v3 = "realesr-general-x4v3"
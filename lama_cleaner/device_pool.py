@@ -0,0 +1,302 @@
+import contextlib
+import os
+import threading
+from typing import Callable, List, Optional, Set
+
+import torch
+from loguru import logger
+
+from lama_cleaner.memory_estimator import AdmissionController
+from lama_cleaner.model_manager import ModelManager
+from lama_cleaner.schema import Config
+
+_thread_local = threading.local()
+
+
+def parse_cores(cores: str) -> Set[int]:
+    """
+    Args:
+        cores: e.g: 0-7,16-23
+
+    Returns:
+        set of core ids
+    """
+    result = set()
+    for part in cores.split(","):
+        if "-" in part:
+            start, end = part.split("-")
+            result.update(range(int(start), int(end) + 1))
+        else:
+            result.add(int(part))
+    return result
+
+
+def split_cores(num_replicas: int) -> List[Set[int]]:
+    """Split cores available to this process evenly into num_replicas sets"""
+    if hasattr(os, "sched_getaffinity"):
+        cores = sorted(os.sched_getaffinity(0))
+    else:
+        cores = list(range(os.cpu_count() or 1))
+    if num_replicas > len(cores):
+        raise ValueError(f"{num_replicas} replicas is more than {len(cores)} cores")
+    size = len(cores) // num_replicas
+    return [set(cores[i * size : (i + 1) * size]) for i in range(num_replicas)]
+
+
+class ReplicaSpec:
+    def __init__(self, device: torch.device, cores: Optional[Set[int]] = None):
+        """
+
+        Args:
+            device: device of the replica
+            cores: cpu cores the inference worker of the replica is pinned to, it
+                runs torch with len(cores) threads. None means no pinning
+        """
+        self.device = device
+        self.cores = cores
+
+    @classmethod
+    def parse(cls, spec: str) -> "ReplicaSpec":
+        """
+        Args:
+            spec: cpu, cpu:0-7,16-23, cuda, cuda:1, mps
+        """
+        if spec.startswith("cpu:"):
+            return cls(torch.device("cpu"), parse_cores(spec[len("cpu:") :]))
+        return cls(torch.device(spec))
+
+    def __repr__(self):
+        if self.cores is None:
+            return str(self.device)
+        return f"{self.device}(cores={sorted(self.cores)})"
+
+
+def replica_specs(
+    device: torch.device, num_replicas: int, devices: Optional[List[str]] = None
+) -> List[ReplicaSpec]:
+    """
+    Args:
+        device: used when devices is empty
+        num_replicas: used when devices is empty, cpu replicas get an even share of cores
+        devices: one spec for each replica, see ReplicaSpec.parse
+    """
+    if devices:
+        return [ReplicaSpec.parse(it) for it in devices]
+    if num_replicas == 1:
+        return [ReplicaSpec(device)]
+    if device.type == "cpu":
+        return [ReplicaSpec(device, cores) for cores in split_cores(num_replicas)]
+    return [ReplicaSpec(device) for _ in range(num_replicas)]
+
+
+class Replica:
+    def __init__(self, index: int, spec: ReplicaSpec, model: ModelManager):
+        self.index = index
+        self.spec = spec
+        self.model = model
+        self.lock = threading.Lock()
+        # jobs waiting for or running on this replica
+        self.load = 0
+        self.num_jobs = 0
+
+
+class DevicePool:
+    """
+    Replicas of ModelManager on several devices or cpu core sets. Run it with an
+    InferenceScheduler which has one worker for each replica and
+    worker_init=bind_worker, each worker runs its jobs on its own replica. Calls from
+    other threads run on the least loaded replica.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        specs: List[ReplicaSpec],
+        admission: Optional[AdmissionController] = None,
+        **kwargs,
+    ):
+        """
+
+        Args:
+            name: model to load
+            specs: one for each replica
+            admission: reserve estimated memory of the device for each job
+            **kwargs: passed to ModelManager
+        """
+        self._lock = threading.Lock()
+        self.admission = admission
+        self._name = name
+        self.replicas: List[Replica] = []
+        for i, spec in enumerate(specs):
+            logger.info(f"Init replica {i} on {spec}")
+            replica = Replica(i, spec, ModelManager(name, spec.device, **kwargs))
+            self.replicas.append(replica)
+
+    def __len__(self):
+        return len(self.replicas)
+
+    @property
+    def name(self) -> str:
+        return self._name
+
+    @property
+    def model_cache_size(self) -> int:
+        return self.replicas[0].model.model_cache_size
+
+    def bind_worker(self, index: int):
+        """
+        Bind the calling inference worker to replica index for its lifetime, pin it to
+        the cores of the replica and run torch with len(cores) threads. Call it before
+        the worker runs any torch op, intra-op threads are created by the first one
+        and inherit the affinity of the worker.
+        """
+        replica = self.replicas[index]
+        _thread_local.replica = replica
+        cores = replica.spec.cores
+        if cores is None:
+            return
+        if hasattr(os, "sched_setaffinity"):
+            # pid 0 is the calling thread on linux
+            os.sched_setaffinity(0, cores)
+        # number of OpenMP threads is set for the calling thread
+        torch.set_num_threads(len(cores))
+        logger.info(f"Inference worker {index} runs on replica {index}: {replica.spec}")
+
+    @contextlib.contextmanager
+    def acquire(self, replica: Optional[Replica] = None):
+        """
+        Take the replica bound to the calling worker, or the least loaded one, block
+        until it's free
+
+        Args:
+            replica: use this replica instead
+        """
+        with self._lock:
+            if replica is None:
+                replica = getattr(_thread_local, "replica", None)
+            if replica is None:
+                replica = min(self.replicas, key=lambda it: (it.load, it.num_jobs))
+            replica.load += 1
+            replica.num_jobs += 1
+        try:
+            with replica.lock:
+                yield replica
+        finally:
+            with self._lock:
+                replica.load -= 1
+
+    def run(self, fn: Callable, *args):
+        """Run fn(model, *args) on the least loaded replica"""
+        with self.acquire() as replica:
+            return fn(replica.model, *args)
+
+    def run_on_all(self, fn: Callable, *args) -> list:
+        """Run fn(model, *args) on every replica one by one"""
+        results = []
+        for replica in self.replicas:
+            with self.acquire(replica):
+                results.append(fn(replica.model, *args))
+        return results
+
+    def _reserve(self, replica: Replica, estimate: Optional[int]):
+        if self.admission is None:
+            return contextlib.nullcontext()
+        return self.admission.reserve(replica.spec.device, estimate)
+
+    def admit(self, image, mask, config: Config) -> Config:
+        """Check the request fits the memory budget, see AdmissionController.admit"""
+        if self.admission is None:
+            return config
+        model = self.replicas[0].model.model
+        if model is None:
+            # evicted by a switch in progress, the job still reserves its estimated
+            # memory when it runs
+            return config
+        return self.admission.admit(model, image, mask, config)
+
+    def __call__(self, image, mask, config: Config):
+        with self.acquire() as replica:
+            estimate = None
+            if self.admission is not None:
+                estimate = self.admission.estimate(
+                    replica.model.model, image, mask, config
+                )
+            with self._reserve(replica, estimate):
+                return replica.model(image, mask, config)
+
+    def inpaint_batch(self, images, masks, config: Config):
+        with self.acquire() as replica:
+            estimate = None
+            if self.admission is not None:
+                estimate = self.admission.estimate_batch(
+                    replica.model.model, images, masks, config
+                )
+            with self._reserve(replica, estimate):
+                return replica.model.inpaint_batch(images, masks, config)
+
+    def incremental_call(self, image, mask, prev_mask, prev_result, config: Config):
+        with self.acquire() as replica:
+            estimate = None
+            if self.admission is not None:
+                estimate = self.admission.estimate(
+                    replica.model.model, image, mask, config
+                )
+            with self._reserve(replica, estimate):
+                return replica.model.incremental_call(
+                    image, mask, prev_mask, prev_result, config
+                )
+
+    def calibrate_memory(self, force: bool = False):
+        """Fit memory profile of the current model on the first replica"""
+        if self.admission is None:
+            return None
+        with self.acquire(self.replicas[0]) as replica:
+            return self.admission.calibrate(replica.model.model, force=force)
+
+    def is_downloaded(self, name: str) -> bool:
+        return self.replicas[0].model.is_downloaded(name)
+
+    @contextlib.contextmanager
+    def _hold_all(self):
+        """Wait for running jobs and keep new ones off every replica"""
+        with contextlib.ExitStack() as stack:
+            for replica in self.replicas:
+                stack.enter_context(replica.lock)
+            yield
+
+    def switch(self, new_name: str):
+        """
+        Switch every replica while holding all of them, so requests never run on a
+        mix of old and new models. If a replica fails to switch, it keeps the old
+        model(see ModelManager.switch) and the replicas switched before it go back
+        to the old model.
+        """
+        old_name = self._name
+        with self._hold_all():
+            switched = []
+            try:
+                for replica in self.replicas:
+                    replica.model.switch(new_name)
+                    switched.append(replica)
+            except Exception:
+                for replica in switched:
+                    replica.model.switch(old_name)
+                raise
+            self._name = new_name
+
+    def resident_models(self):
+        # every replica holds the same models
+        return self.replicas[0].model.resident_models()
+
+    def stats(self) -> list:
+        with self._lock:
+            return [
+                {
+                    "replica": it.index,
+                    "device": str(it.spec),
+                    "load": it.load,
+                    "numJobs": it.num_jobs,
+                    "shapes": it.model.model.shape_stats() if it.model.model else {},
+                }
+                for it in self.replicas
+            ]
@@ -0,0 +1,186 @@
+"""
+Encode result images, negotiate output format with the Accept header
+
+PIL's default PNG zlib level(6) takes seconds on a large image, level 1 is ~4x faster
+with slightly bigger files. WebP is used only when the client asks for it, method 0 is
+the fastest encoder setting.
+
+Benchmark on an image: python -m lama_cleaner.encoding image.png
+"""
+
+import argparse
+import io
+import time
+from typing import List, Optional, Tuple
+
+from PIL import Image, PngImagePlugin
+
+# PIL default, same PNG bytes as before the level was configurable
+DEFAULT_PNG_COMPRESS_LEVEL = 6
+WEBP_METHOD = 0
+# output formats the server can switch to, in order of preference
+NEGOTIABLE_EXTS = ["webp", "png", "jpeg"]
+# formats can't store alpha channel
+NO_ALPHA_EXTS = {"jpeg"}
+# formats don't lose quality, a webp converted from them is lossless too
+LOSSLESS_EXTS = {"png", "bmp", "tiff", "gif"}
+
+
+def ext_to_mimetype(ext: str) -> str:
+    return f"image/{ext}"
+
+
+def parse_accept(accept: Optional[str]) -> List[Tuple[str, float]]:
+    """
+    Args:
+        accept: Accept header, e.g: image/webp,image/*;q=0.8
+
+    Returns:
+        list of (media range, q)
+    """
+    result = []
+    if not accept:
+        return result
+    for part in accept.split(","):
+        media_range, *params = [it.strip() for it in part.split(";")]
+        if not media_range:
+            continue
+        q = 1.0
+        for param in params:
+            key, _, value = param.partition("=")
+            if key.strip() == "q":
+                try:
+                    q = float(value)
+                except ValueError:
+                    q = 0.0
+        result.append((media_range.lower(), q))
+    return result
+
+
+def _quality_of(mimetype: str, accepted: List[Tuple[str, float]]) -> float:
+    """q of the most specific media range matches mimetype"""
+    main_type = mimetype.split("/")[0]
+    best_specificity, best_q = -1, 0.0
+    for media_range, q in accepted:
+        if media_range == mimetype:
+            specificity = 2
+        elif media_range == f"{main_type}/*":
+            specificity = 1
+        elif media_range == "*/*":
+            specificity = 0
+        else:
+            continue
+        if specificity > best_specificity:
+            best_specificity, best_q = specificity, q
+    return best_q
+
+
+def negotiate_ext(accept: Optional[str], default: str, has_alpha: bool = False) -> str:
+    """
+    Choose output format from Accept header. The format of the input image is kept
+    unless the client prefers another format with a higher q, e.g:
+    `image/webp,*/*;q=0.8` asks for webp
+
+    Args:
+        accept: Accept header
+        default: format of the input image
+        has_alpha: result has alpha channel
+
+    Returns:
+        ext of the output format
+    """
+    accepted = parse_accept(accept)
+    if not accepted:
+        return default
+
+    candidates = [default] + [
+        it
+        for it in NEGOTIABLE_EXTS
+        if it != default and not (has_alpha and it in NO_ALPHA_EXTS)
+    ]
+    best_ext, best_q = default, 0.0
+    for ext in candidates:
+        q = _quality_of(ext_to_mimetype(ext), accepted)
+        if q > best_q:
+            best_ext, best_q = ext, q
+    return best_ext
+
+
+def encode_image(
+    pil_img: Image.Image,
+    ext: str,
+    quality: int = 95,
+    exif_infos={},
+    png_compress_level: int = DEFAULT_PNG_COMPRESS_LEVEL,
+    lossless: bool = False,
+) -> bytes:
+    """
+    Args:
+        pil_img:
+        ext: output format, png/jpeg/webp...
+        quality: jpeg and lossy webp quality
+        exif_infos: exif and parameters returned by load_img, parameters is only
+            saved in png
+        png_compress_level: zlib level 0-9
+        lossless: lossless webp
+
+    Returns:
+        encoded bytes
+    """
+    with io.BytesIO() as output:
+        kwargs = {k: v for k, v in exif_infos.items() if v is not None}
+        if ext == "png":
+            if "parameters" in kwargs:
+                pnginfo_data = PngImagePlugin.PngInfo()
+                pnginfo_data.add_text("parameters", kwargs["parameters"])
+                kwargs["pnginfo"] = pnginfo_data
+            kwargs["compress_level"] = png_compress_level
+        elif ext == "webp":
+            kwargs["method"] = WEBP_METHOD
+            kwargs["lossless"] = lossless
+            if lossless:
+                # compression effort for lossless, 0 is the fastest
+                quality = 0
+                # keep rgb of transparent pixels
+                kwargs["exact"] = True
+
+        pil_img.save(
+            output,
+            format=ext,
+            quality=quality,
+            **kwargs,
+        )
+        image_bytes = output.getvalue()
+    return image_bytes
+
+
+def benchmark(pil_img: Image.Image, times: int):
+    settings = [
+        ("png level 6", "png", dict(png_compress_level=6)),
+        ("png level 1", "png", dict(png_compress_level=1)),
+        ("jpeg", "jpeg", dict()),
+        ("webp lossy", "webp", dict()),
+        ("webp lossless", "webp", dict(lossless=True)),
+    ]
+    print(f"Image size: {pil_img.size}, mode: {pil_img.mode}")
+    for name, ext, kwargs in settings:
+        if ext in NO_ALPHA_EXTS and pil_img.mode == "RGBA":
+            continue
+        start = time.time()
+        for _ in range(times):
+            data = encode_image(pil_img, ext, **kwargs)
+        print(
+            f"{name:15s} {(time.time() - start) / times * 1000:8.2f}ms "
+            f"{len(data) / 1024:10.1f}KB"
+        )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser()
+    parser.add_argument("image", type=str)
+    parser.add_argument("--times", default=3, type=int)
+    args = parser.parse_args()
+    img = Image.open(args.image)
+    if img.mode not in ("RGB", "RGBA"):
+        img = img.convert("RGB")
+    benchmark(img, args.times)
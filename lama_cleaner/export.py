@@ -0,0 +1,32 @@
+import argparse
+
+from loguru import logger
+
+from lama_cleaner.model.lama import LAMA_ONNX_MODEL_PATH, LaMa
+
+# model name -> (model class, default output path)
+EXPORTABLE_MODELS = {"lama": (LaMa, LAMA_ONNX_MODEL_PATH)}
+
+
+def parse_export_args(argv=None):
+    parser = argparse.ArgumentParser(
+        prog="lama-cleaner export",
+        formatter_class=argparse.ArgumentDefaultsHelpFormatter,
+    )
+    parser.add_argument("--model", default="lama", choices=list(EXPORTABLE_MODELS))
+    parser.add_argument("--format", default="onnx", choices=["onnx"])
+    parser.add_argument(
+        "--output",
+        default=None,
+        type=str,
+        help="Exported model path, default is where --backend onnxruntime loads it",
+    )
+    parser.add_argument("--opset", default=17, type=int, help="ONNX opset version")
+    return parser.parse_args(argv)
+
+
+def main(args):
+    model_cls, default_output = EXPORTABLE_MODELS[args.model]
+    output = args.output or default_output
+    logger.info(f"Exporting {args.model} to {args.format}: {output}")
+    model_cls.export_onnx(output, opset_version=args.opset)
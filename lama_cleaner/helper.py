@@ -1,14 +1,15 @@
 import io
 import os
 import sys
-from typing import List, Optional
+from typing import List, Optional, Tuple
 
 from urllib.parse import urlparse
 import cv2
-from PIL import Image, ImageOps, PngImagePlugin
+from PIL import Image, ImageOps
 import numpy as np
 import torch
 from lama_cleaner.const import MPS_SUPPORT_MODELS
+from lama_cleaner.encoding import DEFAULT_PNG_COMPRESS_LEVEL, encode_image
 from loguru import logger
 from torch.hub import download_url_to_file, get_dir
 import hashlib
@@ -108,6 +109,44 @@ def load_jit_model(url_or_path, device, model_md5: str):
     return model
 
 
+def load_onnx_session(
+    model_path, device, intra_op_threads: int = 0, inter_op_threads: int = 0
+):
+    """
+    Args:
+        model_path: exported onnx model
+        device: cuda runs on CUDAExecutionProvider, others on CPUExecutionProvider
+        intra_op_threads: 0 lets onnxruntime decide
+        inter_op_threads: more than 1 runs independent operators in parallel
+
+    Returns:
+        onnxruntime.InferenceSession
+    """
+    try:
+        import onnxruntime as ort
+    except ImportError:
+        raise ImportError(
+            "onnxruntime backend needs onnxruntime, install it with: "
+            "pip install onnxruntime(or onnxruntime-gpu)"
+        )
+
+    options = ort.SessionOptions()
+    options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+    options.intra_op_num_threads = intra_op_threads
+    options.inter_op_num_threads = inter_op_threads
+    if inter_op_threads > 1:
+        options.execution_mode = ort.ExecutionMode.ORT_PARALLEL
+
+    providers = ["CPUExecutionProvider"]
+    if device.type == "cuda":
+        providers.insert(0, ("CUDAExecutionProvider", {"device_id": device.index or 0}))
+
+    logger.info(f"Loading onnx model from: {model_path}")
+    return ort.InferenceSession(
+        str(model_path), sess_options=options, providers=providers
+    )
+
+
 def load_model(model: torch.nn.Module, url_or_path, device, model_md5):
     if os.path.exists(url_or_path):
         model_path = url_or_path
@@ -135,54 +174,151 @@ def numpy_to_bytes(image_numpy: np.ndarray, ext: str) -> bytes:
     return image_bytes
 
 
-def pil_to_bytes(pil_img, ext: str, quality: int = 95, exif_infos={}) -> bytes:
-    with io.BytesIO() as output:
-        kwargs = {k: v for k, v in exif_infos.items() if v is not None}
-        if ext == "png" and "parameters" in kwargs:
-            pnginfo_data = PngImagePlugin.PngInfo()
-            pnginfo_data.add_text("parameters", kwargs["parameters"])
-            kwargs["pnginfo"] = pnginfo_data
+def pil_to_bytes(
+    pil_img,
+    ext: str,
+    quality: int = 95,
+    exif_infos={},
+    png_compress_level: int = DEFAULT_PNG_COMPRESS_LEVEL,
+    lossless: bool = False,
+) -> bytes:
+    return encode_image(
+        pil_img,
+        ext,
+        quality=quality,
+        exif_infos=exif_infos,
+        png_compress_level=png_compress_level,
+        lossless=lossless,
+    )
 
-        pil_img.save(
-            output,
-            format=ext,
-            quality=quality,
-            **kwargs,
-        )
-        image_bytes = output.getvalue()
-    return image_bytes
+
+_EXIF_ORIENTATION_TAG = 0x0112
+# EXIF orientation -> cv2 ops(applied in order) turning the image upright
+_EXIF_ORIENTATION_OPS = {
+    2: [lambda x: cv2.flip(x, 1)],
+    3: [lambda x: cv2.rotate(x, cv2.ROTATE_180)],
+    4: [lambda x: cv2.flip(x, 0)],
+    5: [cv2.transpose],
+    6: [lambda x: cv2.rotate(x, cv2.ROTATE_90_CLOCKWISE)],
+    7: [cv2.transpose, lambda x: cv2.rotate(x, cv2.ROTATE_180)],
+    8: [lambda x: cv2.rotate(x, cv2.ROTATE_90_COUNTERCLOCKWISE)],
+}
+# PIL modes decoded by cv2 to the same pixels
+_CV2_DECODE_MODES = {
+    "JPEG": {"RGB", "L"},
+    "PNG": {"RGB", "RGBA", "L"},
+}
+
+
+def _read_exif(image: Image.Image, img_bytes) -> Image.Exif:
+    if image.format == "PNG" and "exif" not in image.info and b"eXIf" not in img_bytes:
+        # PngImageFile.getexif decodes the whole image looking for eXIf after IDAT
+        return Image.Exif()
+    return image.getexif()
+
+
+def _cv2_decode(image: Image.Image, img_bytes):
+    """
+    Decode with cv2(libjpeg-turbo/libpng), RGB/RGBA/L JPEG and PNG only. Images are
+    decoded in their own mode, IMREAD_GRAYSCALE of a color JPEG decodes luma directly
+    and differs from converting the RGB pixels to gray like PIL does
+
+    Returns:
+        BGR/BGRA/gray np.ndarray, None if the image is not supported
+    """
+    modes = _CV2_DECODE_MODES.get(image.format)
+    if modes is None or image.mode not in modes:
+        return None
+
+    # IMREAD_UNCHANGED ignores EXIF orientation
+    np_img = cv2.imdecode(
+        np.frombuffer(img_bytes, dtype=np.uint8), cv2.IMREAD_UNCHANGED
+    )
+    if np_img is None or np_img.dtype != np.uint8:
+        return None
+    channels = 1 if np_img.ndim == 2 else np_img.shape[2]
+    if channels != len(image.mode):
+        # e.g: PNG with tRNS chunk is RGB in PIL but BGRA in cv2
+        return None
+    return np_img
 
 
 def load_img(img_bytes, gray: bool = False, return_exif: bool = False):
+    """
+    Args:
+        img_bytes:
+        gray: return single channel image
+        return_exif:
+
+    Returns:
+        np_img(RGB or gray), alpha_channel, exif_infos(if return_exif)
+    """
     alpha_channel = None
+    # only the header is read
     image = Image.open(io.BytesIO(img_bytes))
 
+    if return_exif or image.format in _CV2_DECODE_MODES:
+        exif = _read_exif(image, img_bytes)
     if return_exif:
         info = image.info or {}
-        exif_infos = {"exif": image.getexif(), "parameters": info.get("parameters")}
-
-    try:
-        image = ImageOps.exif_transpose(image)
-    except:
-        pass
-
-    if gray:
-        image = image.convert("L")
-        np_img = np.array(image)
-    else:
-        if image.mode == "RGBA":
-            np_img = np.array(image)
+        exif_infos = {"exif": exif, "parameters": info.get("parameters")}
+
+    np_img = _cv2_decode(image, img_bytes)
+    if np_img is not None:
+        if np_img.ndim == 2:
+            if not gray:
+                np_img = cv2.cvtColor(np_img, cv2.COLOR_GRAY2RGB)
+        elif gray:
+            # same weights as PIL convert("L"), alpha is dropped
+            code = cv2.COLOR_BGR2GRAY if np_img.shape[2] == 3 else cv2.COLOR_BGRA2GRAY
+            np_img = cv2.cvtColor(np_img, code)
+        elif np_img.shape[2] == 4:
             alpha_channel = np_img[:, :, -1]
-            np_img = cv2.cvtColor(np_img, cv2.COLOR_RGBA2RGB)
+            np_img = cv2.cvtColor(np_img, cv2.COLOR_BGRA2RGB)
         else:
-            image = image.convert("RGB")
+            np_img = cv2.cvtColor(np_img, cv2.COLOR_BGR2RGB)
+
+        for op in _EXIF_ORIENTATION_OPS.get(exif.get(_EXIF_ORIENTATION_TAG), []):
+            np_img = op(np_img)
+            if alpha_channel is not None:
+                alpha_channel = op(alpha_channel)
+        if alpha_channel is not None:
+            alpha_channel = np.ascontiguousarray(alpha_channel)
+    else:
+        try:
+            image = ImageOps.exif_transpose(image)
+        except:
+            pass
+
+        if gray:
+            image = image.convert("L")
             np_img = np.array(image)
+        else:
+            if image.mode == "RGBA":
+                np_img = np.array(image)
+                alpha_channel = np_img[:, :, -1]
+                np_img = cv2.cvtColor(np_img, cv2.COLOR_RGBA2RGB)
+            else:
+                image = image.convert("RGB")
+                np_img = np.array(image)
 
     if return_exif:
         return np_img, alpha_channel, exif_infos
     return np_img, alpha_channel
 
 
+def concat_alpha_channel(rgb_np_img, alpha_channel) -> np.ndarray:
+    if alpha_channel is not None:
+        if alpha_channel.shape[:2] != rgb_np_img.shape[:2]:
+            alpha_channel = cv2.resize(
+                alpha_channel, dsize=(rgb_np_img.shape[1], rgb_np_img.shape[0])
+            )
+        rgb_np_img = np.concatenate(
+            (rgb_np_img, alpha_channel[:, :, np.newaxis]), axis=-1
+        )
+    return rgb_np_img
+
+
 def norm_img(np_img):
     if len(np_img.shape) == 2:
         np_img = np_img[:, :, np.newaxis]
@@ -205,23 +341,35 @@ def resize_max_size(
         return np_img
 
 
-def pad_img_to_modulo(
-    img: np.ndarray, mod: int, square: bool = False, min_size: Optional[int] = None
-):
-    """
+def bucket_size(size: int, buckets: List[int]) -> int:
+    """Smallest bucket not less than size, size itself if it's larger than all buckets"""
+    for bucket in buckets:
+        if bucket >= size:
+            return bucket
+    return size
 
+
+def padded_size(
+    height: int,
+    width: int,
+    mod: int,
+    square: bool = False,
+    min_size: Optional[int] = None,
+    buckets: Optional[List[int]] = None,
+) -> Tuple[int, int]:
+    """
     Args:
-        img: [H, W, C]
+        height:
+        width:
         mod:
-        square: 是否为正方形
+        square:
         min_size:
+        buckets: sorted sizes, each side is padded up to one of them, so images of
+            different sizes get the same padded shape
 
     Returns:
-
+        (height, width) after padding
     """
-    if len(img.shape) == 2:
-        img = img[:, :, np.newaxis]
-    height, width = img.shape[:2]
     out_height = ceil_modulo(height, mod)
     out_width = ceil_modulo(width, mod)
 
@@ -230,10 +378,41 @@ def pad_img_to_modulo(
         out_width = max(min_size, out_width)
         out_height = max(min_size, out_height)
 
+    if buckets:
+        buckets = [ceil_modulo(it, mod) for it in buckets]
+        out_height = bucket_size(out_height, buckets)
+        out_width = bucket_size(out_width, buckets)
+
     if square:
         max_size = max(out_height, out_width)
         out_height = max_size
         out_width = max_size
+    return out_height, out_width
+
+
+def pad_img_to_modulo(
+    img: np.ndarray,
+    mod: int,
+    square: bool = False,
+    min_size: Optional[int] = None,
+    buckets: Optional[List[int]] = None,
+):
+    """
+
+    Args:
+        img: [H, W, C]
+        mod:
+        square: 是否为正方形
+        min_size:
+        buckets: see padded_size
+
+    Returns:
+
+    """
+    if len(img.shape) == 2:
+        img = img[:, :, np.newaxis]
+    height, width = img.shape[:2]
+    out_height, out_width = padded_size(height, width, mod, square, min_size, buckets)
 
     return np.pad(
         img,
@@ -266,6 +445,29 @@ def boxes_from_mask(mask: np.ndarray) -> List[np.ndarray]:
     return boxes
 
 
+def mask_bbox(mask: np.ndarray, margin: int = 0) -> Optional[Tuple[int, int, int, int]]:
+    """
+    Args:
+        mask: (h, w) 0~255
+        margin: pixels to expand the box on each side, clipped to the mask
+
+    Returns:
+        (x1, y1, x2, y2) of the nonzero pixels, None if the mask is empty
+    """
+    if mask.dtype != np.uint8:
+        mask = mask.astype(np.uint8)
+    x, y, w, h = cv2.boundingRect(mask)
+    if w == 0 or h == 0:
+        return None
+    height, width = mask.shape[:2]
+    return (
+        max(x - margin, 0),
+        max(y - margin, 0),
+        min(x + w + margin, width),
+        min(y + h + margin, height),
+    )
+
+
 def only_keep_largest_contour(mask: np.ndarray) -> List[np.ndarray]:
     """
     Args:
@@ -0,0 +1,175 @@
+"""
+Compact mask encodings, decoded straight into a uint8 array without an image codec
+
+- png: grayscale image, thresholded at 127(default)
+- rle: COCO style RLE json, {"size": [height, width], "counts": [...] or "..."}.
+  Runs are column-major and start with a run of 0, counts is a list of run lengths
+  or the compressed string of pycocotools
+- bitpacked: rows packed MSB first, each row padded to a whole byte
+  (np.packbits(mask, axis=1)), shape is the shape of the image
+"""
+
+import json
+from typing import List, Optional, Tuple, Union
+
+import cv2
+import numpy as np
+
+from lama_cleaner.helper import load_img
+
+PNG = "png"
+RLE = "rle"
+BITPACKED = "bitpacked"
+MASK_ENCODINGS = [PNG, RLE, BITPACKED]
+
+
+def _binarize(mask: np.ndarray) -> np.ndarray:
+    """bool mask, uint8 mask is thresholded at 127 like png mask"""
+    if mask.dtype == bool:
+        return mask
+    return mask > 127
+
+
+def _counts_from_string(s: str) -> List[int]:
+    """Decode compressed RLE counts of pycocotools(rleFrString)"""
+    counts = []
+    p = 0
+    while p < len(s):
+        x = 0
+        k = 0
+        more = True
+        while more:
+            c = ord(s[p]) - 48
+            x |= (c & 0x1F) << (5 * k)
+            more = c & 0x20
+            p += 1
+            k += 1
+            if not more and c & 0x10:
+                x |= -1 << (5 * k)
+        if len(counts) > 2:
+            x += counts[-2]
+        counts.append(x)
+    return counts
+
+
+def _counts_to_string(counts: List[int]) -> str:
+    """Compress RLE counts like pycocotools(rleToString)"""
+    chars = []
+    for i, x in enumerate(counts):
+        if i > 2:
+            x -= counts[i - 2]
+        more = True
+        while more:
+            c = x & 0x1F
+            x >>= 5
+            more = x != -1 if c & 0x10 else x != 0
+            if more:
+                c |= 0x20
+            chars.append(chr(c + 48))
+    return "".join(chars)
+
+
+def encode_rle(mask: np.ndarray, compress: bool = True) -> dict:
+    """
+    Args:
+        mask: [H, W] bool, or uint8 thresholded at 127
+        compress: counts as pycocotools compressed string
+
+    Returns:
+        COCO RLE
+    """
+    pixels = _binarize(mask).ravel(order="F").astype(np.int8)
+    # indices where value changes, a run of 0 is always first
+    changes = np.flatnonzero(np.diff(pixels)) + 1
+    boundaries = np.concatenate([[0], changes, [pixels.size]])
+    counts = np.diff(boundaries).tolist()
+    if pixels.size and pixels[0]:
+        counts = [0] + counts
+    return {
+        "size": list(mask.shape[:2]),
+        "counts": _counts_to_string(counts) if compress else counts,
+    }
+
+
+def decode_rle(rle: dict, shape: Optional[Tuple[int, int]] = None) -> np.ndarray:
+    """
+    Args:
+        rle: COCO RLE
+        shape: expected (height, width), checked before decoding
+
+    Returns:
+        [H, W] uint8 mask, 0 or 255
+    """
+    try:
+        height, width = [int(it) for it in rle["size"]]
+        counts = rle["counts"]
+    except (KeyError, TypeError, ValueError):
+        raise ValueError('RLE mask must be {"size": [height, width], "counts": ...}')
+    if shape is not None and (height, width) != tuple(shape):
+        raise ValueError(f"RLE mask size {height}x{width} not equal to {shape}")
+    if isinstance(counts, str):
+        counts = _counts_from_string(counts)
+    counts = np.asarray(counts, dtype=np.int64)
+    if (counts < 0).any() or counts.sum() != height * width:
+        raise ValueError(f"RLE counts don't match mask size {height}x{width}")
+
+    values = np.zeros(len(counts), dtype=np.uint8)
+    values[1::2] = 255
+    pixels = np.repeat(values, counts)
+    return np.ascontiguousarray(pixels.reshape((height, width), order="F"))
+
+
+def encode_bitpacked(mask: np.ndarray) -> bytes:
+    """
+    Args:
+        mask: [H, W] bool, or uint8 thresholded at 127
+    """
+    return np.packbits(_binarize(mask), axis=1).tobytes()
+
+
+def decode_bitpacked(data: bytes, shape: Tuple[int, int]) -> np.ndarray:
+    """
+    Args:
+        data: rows packed MSB first
+        shape: (height, width)
+
+    Returns:
+        [H, W] uint8 mask, 0 or 255
+    """
+    height, width = shape
+    row_bytes = (width + 7) // 8
+    if len(data) != height * row_bytes:
+        raise ValueError(
+            f"Bit-packed mask of {height}x{width} must be {height * row_bytes} bytes, "
+            f"got {len(data)}"
+        )
+    packed = np.frombuffer(data, dtype=np.uint8).reshape(height, row_bytes)
+    mask = np.unpackbits(packed, axis=1, count=width)
+    mask *= 255
+    return mask
+
+
+def decode_mask(
+    data: Union[bytes, str], encoding: str, shape: Tuple[int, int]
+) -> np.ndarray:
+    """
+    Args:
+        data: encoded mask
+        encoding: png, rle or bitpacked
+        shape: (height, width) of the image, size of bit-packed mask
+
+    Returns:
+        [H, W] uint8 mask, 0 or 255
+    """
+    if encoding == PNG:
+        mask, _ = load_img(data, gray=True)
+        return cv2.threshold(mask, 127, 255, cv2.THRESH_BINARY)[1]
+    if encoding == RLE:
+        try:
+            rle = json.loads(data)
+        except ValueError:
+            raise ValueError("RLE mask is not valid json")
+        return decode_rle(rle, shape)
+    if encoding == BITPACKED:
+        return decode_bitpacked(data, shape)
+    raise ValueError(f"Unknown mask encoding: {encoding}, choices: {MASK_ENCODINGS}")
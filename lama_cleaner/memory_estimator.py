@@ -0,0 +1,365 @@
+"""
+Predict peak memory of a request before running it, so a big upload is queued,
+rejected or run with a cheaper hd strategy instead of running out of memory.
+
+Memory of one forward is modeled as `base + per_pixel * padded pixels * batch size`,
+the coefficients of each model and device type are fitted from a benchmark:
+
+    python -m lama_cleaner.memory_estimator --model lama --device cuda
+
+or calibrated by the server at startup when --memory-budget is set.
+"""
+
+import argparse
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+from pathlib import Path
+from typing import Dict, List, NamedTuple, Optional, Tuple
+
+import numpy as np
+import torch
+from loguru import logger
+
+from lama_cleaner.const import MEMORY_POLICIES
+from lama_cleaner.model.base import InpaintModel
+from lama_cleaner.schema import Config, HDStrategy
+
+try:
+    import psutil
+except ImportError:
+    psutil = None
+
+MB = 1024 * 1024
+CALIBRATION_SIZES = [(512, 512), (1024, 1024)]
+
+
+class MemoryAdmissionError(Exception):
+    def __init__(self, message: str, retryable: bool = False):
+        """
+        Args:
+            retryable: memory is used by other jobs, the request may fit later
+        """
+        super().__init__(message)
+        self.retryable = retryable
+
+
+class MemoryProfile(NamedTuple):
+    # bytes used by a forward no matter the input size
+    base: float
+    # bytes for each padded input pixel
+    per_pixel: float
+
+    def estimate(self, shape: Tuple[int, int], batch_size: int = 1) -> int:
+        return int(self.base + self.per_pixel * shape[0] * shape[1] * batch_size)
+
+    @classmethod
+    def fit(cls, samples: List[Tuple[int, int]]) -> "MemoryProfile":
+        """
+        Args:
+            samples: list of (padded pixels, peak bytes)
+        """
+        pixels = np.array([it[0] for it in samples], dtype=np.float64)
+        peaks = np.array([it[1] for it in samples], dtype=np.float64)
+        if len(set(pixels)) < 2:
+            # e.g: fcf always runs on 512x512
+            return cls(float(peaks.max()), 0.0)
+        per_pixel, base = np.polyfit(pixels, peaks, 1)
+        return cls(max(float(base), 0.0), max(float(per_pixel), 0.0))
+
+
+@contextlib.contextmanager
+def measure_peak_memory(device: torch.device):
+    """
+    Peak memory(bytes) allocated in the block, more than memory used before it.
+    cuda uses the allocator statistics, cpu samples RSS of the process
+
+    Yields:
+        list, the peak is appended when the block exits
+    """
+    result = []
+    if device.type == "cuda":
+        torch.cuda.synchronize(device)
+        torch.cuda.reset_peak_memory_stats(device)
+        start = torch.cuda.memory_allocated(device)
+        try:
+            yield result
+        finally:
+            torch.cuda.synchronize(device)
+            result.append(torch.cuda.max_memory_allocated(device) - start)
+        return
+
+    if psutil is None:
+        raise RuntimeError("psutil is required to measure cpu memory")
+    process = psutil.Process()
+    start = process.memory_info().rss
+    peak = [start]
+    stop = threading.Event()
+
+    def _sample():
+        while not stop.is_set():
+            peak[0] = max(peak[0], process.memory_info().rss)
+            time.sleep(0.001)
+
+    sampler = threading.Thread(target=_sample, daemon=True)
+    sampler.start()
+    try:
+        yield result
+    finally:
+        stop.set()
+        sampler.join()
+        peak[0] = max(peak[0], process.memory_info().rss)
+        result.append(peak[0] - start)
+
+
+def calibrate(
+    model: InpaintModel, sizes: List[Tuple[int, int]] = CALIBRATION_SIZES
+) -> MemoryProfile:
+    """Fit MemoryProfile of model by running one forward at each size"""
+    from lama_cleaner.warmup import run_model
+
+    samples = []
+    for size in sizes:
+        # the first run of a shape includes one-off allocations, e.g: cuDNN workspace
+        peaks = []
+        for _ in range(2):
+            with measure_peak_memory(model.device) as peak:
+                run_model(model, size, HDStrategy.ORIGINAL)
+            peaks.append(peak[0])
+        padded = model.padded_shape(*size)
+        samples.append((padded[0] * padded[1], max(peaks)))
+        logger.info(
+            f"Memory of {model.name} on {padded}: {max(peaks) / MB:.1f}MB "
+            f"(runs: {[round(it / MB, 1) for it in peaks]})"
+        )
+    return MemoryProfile.fit(samples)
+
+
+def available_memory(device: torch.device) -> int:
+    """Free memory of device in bytes"""
+    if device.type == "cuda":
+        return torch.cuda.mem_get_info(device)[0]
+    if psutil is not None:
+        return psutil.virtual_memory().available
+    return os.sysconf("SC_AVPHYS_PAGES") * os.sysconf("SC_PAGE_SIZE")
+
+
+class MemoryBudget:
+    """Memory of one device reserved by running jobs"""
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.used = 0
+        self._cond = threading.Condition()
+
+    @contextlib.contextmanager
+    def reserve(self, nbytes: int, block: bool = True):
+        """
+        Args:
+            nbytes:
+            block: wait until nbytes is free, otherwise raise MemoryAdmissionError
+        """
+        # a request larger than the budget runs alone instead of waiting forever
+        nbytes = min(nbytes, self.capacity)
+        with self._cond:
+            while self.used + nbytes > self.capacity:
+                if not block:
+                    raise MemoryAdmissionError(
+                        f"Not enough free memory: needs ~{nbytes / MB:.0f}MB, "
+                        f"{(self.capacity - self.used) / MB:.0f}MB free",
+                        retryable=True,
+                    )
+                self._cond.wait()
+            self.used += nbytes
+        try:
+            yield
+        finally:
+            with self._cond:
+                self.used -= nbytes
+                self._cond.notify_all()
+
+
+class AdmissionController:
+    def __init__(
+        self,
+        capacity: Dict[str, int],
+        policy: str = "queue",
+        profile_path: Optional[str] = None,
+    ):
+        """
+
+        Args:
+            capacity: str(device) -> bytes can be used by inference
+            policy: one of MEMORY_POLICIES, see const.py
+            profile_path: json file to load and save calibrated profiles
+        """
+        if policy not in MEMORY_POLICIES:
+            raise ValueError(
+                f"Unknown memory policy: {policy}, choices: {MEMORY_POLICIES}"
+            )
+        self.budgets = {k: MemoryBudget(v) for k, v in capacity.items()}
+        self.policy = policy
+        self.profile_path = profile_path
+        self.profiles: Dict[str, MemoryProfile] = {}
+        self._lock = threading.Lock()
+        if profile_path and Path(profile_path).exists():
+            with open(profile_path) as f:
+                self.profiles = {k: MemoryProfile(**v) for k, v in json.load(f).items()}
+
+    @property
+    def capacity(self) -> int:
+        """The smallest budget, a request may run on any device"""
+        return min(it.capacity for it in self.budgets.values())
+
+    @staticmethod
+    def _profile_key(model: InpaintModel) -> str:
+        # memory of a forward depends on the dtype it runs in
+        return f"{model.name}:{model.device.type}:{model.precision}"
+
+    def profile(self, model: InpaintModel) -> Optional[MemoryProfile]:
+        return self.profiles.get(self._profile_key(model))
+
+    def calibrate(self, model: InpaintModel, force: bool = False) -> MemoryProfile:
+        key = self._profile_key(model)
+        if not force and key in self.profiles:
+            return self.profiles[key]
+        profile = calibrate(model)
+        logger.info(
+            f"Memory profile of {key}: base {profile.base / MB:.1f}MB, "
+            f"{profile.per_pixel:.1f} bytes/pixel"
+        )
+        with self._lock:
+            self.profiles[key] = profile
+            self.save()
+        return profile
+
+    def save(self):
+        if self.profile_path:
+            with open(self.profile_path, "w") as f:
+                json.dump({k: v._asdict() for k, v in self.profiles.items()}, f)
+
+    def estimate(
+        self, model: InpaintModel, image, mask, config: Config
+    ) -> Optional[int]:
+        """
+        Returns:
+            bytes of the largest forward, None if model is not calibrated
+        """
+        profile = self.profile(model)
+        if profile is None:
+            return None
+        # crops and tiles of the same shape run in batches
+        max_batch_size = 1
+        if config.hd_strategy == HDStrategy.CROP:
+            max_batch_size = max(config.hd_strategy_crop_batch_size, 1)
+        elif config.hd_strategy in (HDStrategy.TILE, HDStrategy.PYRAMID):
+            max_batch_size = max(config.hd_strategy_tile_batch_size, 1)
+        counts = collections.Counter(model.forward_shapes(image, mask, config))
+        return max(
+            (
+                profile.estimate(shape, min(count, max_batch_size))
+                for shape, count in counts.items()
+            ),
+            default=0,
+        )
+
+    def estimate_batch(
+        self, model: InpaintModel, images, masks, config: Config
+    ) -> Optional[int]:
+        """Images with the same padded shape run in one forward"""
+        profile = self.profile(model)
+        if profile is None:
+            return None
+        batch_sizes = {}
+        estimate = 0
+        for image, mask in zip(images, masks):
+            if model._use_hd_strategy(image, config):
+                estimate = max(estimate, self.estimate(model, image, mask, config))
+            else:
+                shape = model.padded_shape(*image.shape[:2])
+                batch_sizes[shape] = batch_sizes.get(shape, 0) + 1
+        for shape, batch_size in batch_sizes.items():
+            estimate = max(estimate, profile.estimate(shape, batch_size))
+        return estimate
+
+    def admit(self, model: InpaintModel, image, mask, config: Config) -> Config:
+        """
+        Check the request fits the memory budget before queueing it
+
+        Returns:
+            config to run the request with, may be downgraded
+        Raises:
+            MemoryAdmissionError
+        """
+        estimate = self.estimate(model, image, mask, config)
+        if estimate is None or estimate <= self.capacity:
+            return config
+
+        if self.policy == "downgrade":
+            for candidate in model.downgrade_configs(image, config):
+                candidate_estimate = self.estimate(model, image, mask, candidate)
+                if candidate_estimate <= self.capacity:
+                    logger.info(
+                        f"Request needs ~{estimate / MB:.0f}MB, run with "
+                        f"hd_strategy: {HDStrategy(candidate.hd_strategy).value} "
+                        f"sd_scale: {candidate.sd_scale} "
+                        f"(~{candidate_estimate / MB:.0f}MB) instead"
+                    )
+                    return candidate
+
+        raise MemoryAdmissionError(
+            f"Request needs ~{estimate / MB:.0f}MB memory, more than the budget "
+            f"{self.capacity / MB:.0f}MB. Use a smaller image, Crop or Resize strategy"
+        )
+
+    @contextlib.contextmanager
+    def reserve(self, device: torch.device, nbytes: Optional[int]):
+        """Hold nbytes of device while running a job"""
+        budget = self.budgets.get(str(device))
+        if budget is None or not nbytes:
+            yield
+            return
+        with budget.reserve(nbytes, block=self.policy != "reject"):
+            yield
+
+    def stats(self) -> dict:
+        return {
+            "policy": self.policy,
+            "budgets": {
+                k: {"capacity": v.capacity, "used": v.used}
+                for k, v in self.budgets.items()
+            },
+            "profiles": {k: v._asdict() for k, v in self.profiles.items()},
+        }
+
+
+if __name__ == "__main__":
+    from lama_cleaner.const import AVAILABLE_MODELS
+    from lama_cleaner.model_manager import ModelManager
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="lama", choices=AVAILABLE_MODELS)
+    parser.add_argument("--device", default="cuda", type=str)
+    parser.add_argument(
+        "--sizes", default=["512x512", "1024x1024", "1536x1536"], nargs="+"
+    )
+    parser.add_argument("--output", default=None, type=str, help="profile json file")
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    model = ModelManager(args.model, device).model
+    sizes = [tuple(int(x) for x in it.split("x"))[::-1] for it in args.sizes]
+    profile = calibrate(model, sizes)
+    print(
+        f"{args.model}:{device.type} base: {profile.base / MB:.1f}MB "
+        f"per_pixel: {profile.per_pixel:.1f} bytes"
+    )
+    for size in sizes:
+        print(f"{size}: {profile.estimate(model.padded_shape(*size)) / MB:.1f}MB")
+    if args.output:
+        controller = AdmissionController({}, profile_path=args.output)
+        controller.profiles[AdmissionController._profile_key(model)] = profile
+        controller.save()
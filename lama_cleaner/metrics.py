@@ -0,0 +1,296 @@
+"""
+Minimal metrics in Prometheus text exposition format, served by /metrics
+
+Stage durations of one request are summed in a StageTimes, code running on the
+inference worker adds to the StageTimes of the current job with metrics.timer(stage),
+e.g: padding and forward of every crop box.
+"""
+
+import contextlib
+import math
+import threading
+import time
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from lama_cleaner import tracing
+
+_thread_local = threading.local()
+
+DEFAULT_BUCKETS = (
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1,
+    2.5,
+    5,
+    10,
+    30,
+    60,
+    120,
+)
+
+
+def _escape(value: str) -> str:
+    return value.replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def _format_labels(label_names: Sequence[str], label_values: Sequence[str]) -> str:
+    if not label_names:
+        return ""
+    pairs = [f'{k}="{_escape(str(v))}"' for k, v in zip(label_names, label_values)]
+    return "{" + ",".join(pairs) + "}"
+
+
+def _format_value(value: float) -> str:
+    if value == math.inf:
+        return "+Inf"
+    return repr(float(value))
+
+
+class _Metric:
+    type = ""
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.label_names = tuple(label_names)
+        self._lock = threading.Lock()
+
+    def _label_values(self, labels: Dict[str, str]) -> Tuple[str, ...]:
+        if set(labels) - set(self.label_names):
+            raise ValueError(
+                f"Unknown labels of {self.name}: {set(labels) - set(self.label_names)}"
+            )
+        return tuple(str(labels.get(it, "")) for it in self.label_names)
+
+    def samples(self) -> List[Tuple[str, str, float]]:
+        """list of (name suffix, formatted labels, value)"""
+        raise NotImplementedError
+
+    def render(self) -> str:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for suffix, labels, value in self.samples():
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(_Metric):
+    type = "counter"
+
+    def __init__(self, name: str, documentation: str, label_names: Sequence[str] = ()):
+        super().__init__(name, documentation, label_names)
+        self._values: Dict[Tuple[str, ...], float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._label_values(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self._values.get(self._label_values(labels), 0)
+
+    def samples(self):
+        with self._lock:
+            items = sorted(self._values.items())
+        return [("", _format_labels(self.label_names, k), v) for k, v in items]
+
+
+class Gauge(_Metric):
+    type = "gauge"
+
+    def __init__(self, name: str, documentation: str):
+        super().__init__(name, documentation)
+        self._value = 0.0
+        self._function: Optional[Callable[[], float]] = None
+
+    def set(self, value: float):
+        self._value = value
+
+    def set_function(self, function: Callable[[], float]):
+        """Value is read from function when rendering"""
+        self._function = function
+
+    def get(self) -> float:
+        if self._function is not None:
+            return self._function()
+        return self._value
+
+    def samples(self):
+        return [("", "", self.get())]
+
+
+class Histogram(_Metric):
+    type = "histogram"
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        label_names: Sequence[str] = (),
+        buckets: Sequence[float] = DEFAULT_BUCKETS,
+    ):
+        super().__init__(name, documentation, label_names)
+        self.buckets = tuple(sorted(buckets)) + (math.inf,)
+        # label values -> (bucket counts, sum)
+        self._values: Dict[Tuple[str, ...], Tuple[List[int], float]] = {}
+
+    def observe(self, value: float, **labels):
+        key = self._label_values(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0.0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+                    break
+            self._values[key] = (counts, total + value)
+
+    def count(self, **labels) -> int:
+        counts, _ = self._values.get(self._label_values(labels), ([0], 0.0))
+        return sum(counts)
+
+    def samples(self):
+        with self._lock:
+            items = sorted((k, (list(c), s)) for k, (c, s) in self._values.items())
+
+        samples = []
+        for label_values, (counts, total) in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                labels = _format_labels(
+                    self.label_names + ("le",),
+                    label_values + (_format_value(bound),),
+                )
+                samples.append(("_bucket", labels, cumulative))
+            labels = _format_labels(self.label_names, label_values)
+            samples.append(("_sum", labels, total))
+            samples.append(("_count", labels, cumulative))
+        return samples
+
+
+class Registry:
+    def __init__(self):
+        self._metrics: List[_Metric] = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self) -> str:
+        return "\n".join(it.render() for it in self._metrics) + "\n"
+
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+
+registry = Registry()
+stage_seconds = registry.register(
+    Histogram(
+        "lama_cleaner_stage_seconds",
+        "Time spent in each stage of a request. "
+        "stage: decode, queue, preprocess, forward, postprocess, encode, total",
+        ["stage", "model", "hd_strategy", "plugin"],
+    )
+)
+oom_errors = registry.register(
+    Counter(
+        "lama_cleaner_oom_errors_total",
+        "Number of requests failed with CUDA out of memory",
+        ["model", "plugin"],
+    )
+)
+forward_shapes = registry.register(
+    Counter(
+        "lama_cleaner_forward_shapes_total",
+        "Number of forwards, result: hit if the model ran the padded shape before, "
+        "miss if it's new and the model may specialize for it",
+        ["model", "result"],
+    )
+)
+oom_fallbacks = registry.register(
+    Counter(
+        "lama_cleaner_oom_fallbacks_total",
+        "Number of out of memory forwards retried with a cheaper hd strategy",
+        ["model"],
+    )
+)
+memory_rejections = registry.register(
+    Counter(
+        "lama_cleaner_memory_rejections_total",
+        "Number of requests rejected by memory admission control. "
+        "reason: too_large, busy",
+        ["model", "reason"],
+    )
+)
+queue_full_errors = registry.register(
+    Counter(
+        "lama_cleaner_queue_full_errors_total",
+        "Number of requests rejected because the inference queue is full",
+    )
+)
+queue_depth = registry.register(
+    Gauge("lama_cleaner_queue_depth", "Number of jobs waiting for the model")
+)
+running_jobs = registry.register(
+    Gauge("lama_cleaner_running_jobs", "Number of jobs running on the model")
+)
+
+
+class StageTimes:
+    """Seconds spent in each stage of one request"""
+
+    def __init__(self):
+        self.start = time.time()
+        self.stages: Dict[str, float] = {}
+
+    def add(self, stage: str, seconds: float):
+        self.stages[stage] = self.stages.get(stage, 0) + seconds
+
+    @contextlib.contextmanager
+    def timer(self, stage: str):
+        """Add time of the block to stage, the block is also a tracing span"""
+        start = time.time()
+        try:
+            with tracing.span(stage):
+                yield
+        finally:
+            self.add(stage, time.time() - start)
+
+    def observe(self, model: str = "", hd_strategy: str = "", plugin: str = ""):
+        """Record all stages and the total time since created to stage_seconds"""
+        labels = dict(model=model, hd_strategy=hd_strategy, plugin=plugin)
+        for stage, seconds in self.stages.items():
+            stage_seconds.observe(seconds, stage=stage, **labels)
+        stage_seconds.observe(time.time() - self.start, stage="total", **labels)
+
+
+@contextlib.contextmanager
+def collect(stage_times: Optional[StageTimes]):
+    """timer() calls of the current thread add to stage_times"""
+    prev = getattr(_thread_local, "stage_times", None)
+    _thread_local.stage_times = stage_times
+    try:
+        yield stage_times
+    finally:
+        _thread_local.stage_times = prev
+
+
+@contextlib.contextmanager
+def timer(stage: str):
+    """
+    Add time of the block to StageTimes of the current request, if any. The block is
+    also a tracing span
+    """
+    stage_times = getattr(_thread_local, "stage_times", None)
+    if stage_times is None:
+        with tracing.span(stage):
+            yield
+        return
+    with stage_times.timer(stage):
+        yield
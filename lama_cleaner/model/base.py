@@ -1,18 +1,73 @@
 import abc
-from typing import Optional
+import collections
+import contextlib
+import functools
+from typing import List, Optional, Tuple
 
 import cv2
 import torch
 import numpy as np
 from loguru import logger
 
+from lama_cleaner import metrics, precision, tracing
 from lama_cleaner.helper import (
     boxes_from_mask,
+    ceil_modulo,
+    padded_size,
     resize_max_size,
     pad_img_to_modulo,
     switch_mps_device,
 )
-from lama_cleaner.schema import Config, HDStrategy
+from lama_cleaner.model.utils import is_oom_error, torch_gc
+from lama_cleaner.postprocess import blend_masked
+from lama_cleaner.scheduler import check_cancelled, set_job_info
+from lama_cleaner.schema import MIN_TILE_SIZE, Config, HDStrategy
+
+
+def with_oom_fallback(call):
+    """
+    Retry __call__ with the configs of model.downgrade_configs when it runs out of
+    memory, until one of them succeeds. The config finally used is set to the
+    "fallback_config" info of the running job
+    """
+
+    @functools.wraps(call)
+    def wrapper(self, image, mask, config: Config):
+        if not self.oom_fallback:
+            return call(self, image, mask, config)
+
+        candidates = [config, *self.downgrade_configs(image, config)]
+        for candidate in candidates[:-1]:
+            try:
+                result = call(self, image, mask, candidate)
+            except Exception as e:
+                if not is_oom_error(e):
+                    raise
+                logger.warning(
+                    f"Out of memory with hd_strategy: "
+                    f"{HDStrategy(candidate.hd_strategy).value} "
+                    f"sd_scale: {candidate.sd_scale}, retry with a cheaper config"
+                )
+                metrics.oom_fallbacks.inc(model=self.name)
+            else:
+                if candidate is not config:
+                    set_job_info("fallback_config", candidate)
+                return result
+            # tensors of the failed forward are released with the exception
+            torch_gc()
+
+        result = call(self, image, mask, candidates[-1])
+        if candidates[-1] is not config:
+            set_job_info("fallback_config", candidates[-1])
+        return result
+
+    return wrapper
+
+
+# tile size used when falling back from other strategies
+FALLBACK_TILE_SIZE = 512
+# crop windows are grown to multiples of it, so crops of similar size run in one batch
+CROP_BIN_MOD = 64
 
 
 class InpaintModel:
@@ -20,6 +75,17 @@ class InpaintModel:
     min_size: Optional[int] = None
     pad_mod = 8
     pad_to_square = False
+    # precisions other than fp32 the model supports on each device type
+    precisions = {"cuda": ("fp16", "bf16"), "cpu": ("bf16",)}
+    # auto precision runs the model in fp16 on cuda
+    cuda_half = False
+    # auto precision runs the model in bf16 on cpus with native bf16, set it only
+    # after comparing the results with fp32: python -m lama_cleaner.precision
+    cpu_auto_bf16 = False
+    # class names of submodules running in fp32 under autocast
+    fp32_modules = ()
+    # init_model casts the weights to self.dtype instead of running under autocast
+    cast_weights = False
 
     def __init__(self, device, **kwargs):
         """
@@ -29,7 +95,28 @@ class InpaintModel:
         """
         device = switch_mps_device(self.name, device)
         self.device = device
+        # retry with cheaper hd strategies when out of memory, see with_oom_fallback
+        self.oom_fallback = kwargs.get("oom_fallback", False)
+        # pad inputs up to these sizes, so TorchScript/oneDNN see a few shapes only
+        self.shape_buckets = sorted(kwargs.get("shape_buckets") or [])
+        # padded shape -> number of forwards
+        self.shape_counts = collections.Counter()
+        # fp32, fp16 or bf16, see precision.py
+        self.precision = precision.resolve_precision(
+            kwargs.get("precision", "auto"),
+            device,
+            self.precisions,
+            cuda_half=self.cuda_half,
+            cpu_auto_bf16=self.cpu_auto_bf16,
+            no_half=kwargs.get("no_half", False),
+        )
+        self.dtype = precision.PRECISION_DTYPES[self.precision]
+        logger.info(f"{self.name} runs in {self.precision}")
         self.init_model(device, **kwargs)
+        if self.precision != "fp32" and self.fp32_modules:
+            for it in vars(self).values():
+                if isinstance(it, torch.nn.Module):
+                    precision.keep_fp32(it, self.fp32_modules)
 
     @abc.abstractmethod
     def init_model(self, device, **kwargs):
@@ -49,30 +136,189 @@ class InpaintModel:
         """
         ...
 
-    def _pad_forward(self, image, mask, config: Config):
-        origin_height, origin_width = image.shape[:2]
-        pad_image = pad_img_to_modulo(
-            image, mod=self.pad_mod, square=self.pad_to_square, min_size=self.min_size
+    def forward_batch(self, images, masks, config: Config):
+        """Run forward on images which have the same size, models support batch
+        inference should override this method
+        images: list of [H, W, C] RGB
+        masks: list of [H, W, 1]
+        return: list of BGR IMAGE
+        """
+        return [self.forward(image, mask, config) for image, mask in zip(images, masks)]
+
+    def _pad(self, img):
+        return pad_img_to_modulo(
+            img,
+            mod=self.pad_mod,
+            square=self.pad_to_square,
+            min_size=self.min_size,
+            buckets=self.shape_buckets,
         )
-        pad_mask = pad_img_to_modulo(
-            mask, mod=self.pad_mod, square=self.pad_to_square, min_size=self.min_size
+
+    def padded_shape(self, height: int, width: int) -> Tuple[int, int]:
+        """(height, width) of an image after _pad"""
+        return padded_size(
+            height,
+            width,
+            self.pad_mod,
+            square=self.pad_to_square,
+            min_size=self.min_size,
+            buckets=self.shape_buckets,
         )
 
+    def _count_shape(self, shape, batch_size: int = 1):
+        """A shape not seen before makes TorchScript/oneDNN specialize again"""
+        shape = tuple(shape[:2])
+        result = "hit" if shape in self.shape_counts else "miss"
+        metrics.forward_shapes.inc(model=self.name, result=result)
+        self.shape_counts[shape] += batch_size
+
+    def shape_stats(self) -> dict:
+        """
+        Returns:
+            forwards of each padded shape, e.g: {"512x512": 10}
+        """
+        return {f"{h}x{w}": count for (h, w), count in self.shape_counts.items()}
+
+    def forward_shapes(self, image, mask, config: Config) -> List[Tuple[int, int]]:
+        """
+        Padded (height, width) of every forward __call__ runs, without running it.
+        Used to estimate memory of a request
+        """
+        shapes = []
+        if config.hd_strategy == HDStrategy.CROP:
+            if max(image.shape) > config.hd_strategy_crop_trigger_size:
+                for batch in self._crop_batches(mask, config):
+                    for l, t, r, b in batch:
+                        shapes.append(self.padded_shape(b - t, r - l))
+                return shapes
+        elif config.hd_strategy == HDStrategy.RESIZE:
+            if max(image.shape) > config.hd_strategy_resize_limit:
+                h, w = image.shape[:2]
+                ratio = config.hd_strategy_resize_limit / max(h, w)
+                return [self.padded_shape(int(h * ratio + 0.5), int(w * ratio + 0.5))]
+        elif config.hd_strategy == HDStrategy.TILE:
+            if max(image.shape) > self._tile_size(config):
+                return [
+                    self.padded_shape(b - t, r - l)
+                    for l, t, r, b in self._masked_tile_boxes(mask, config)
+                ]
+        elif config.hd_strategy == HDStrategy.PYRAMID:
+            if max(image.shape) > config.hd_strategy_resize_limit:
+                h, w = image.shape[:2]
+                ratio = config.hd_strategy_resize_limit / max(h, w)
+                band_mask = self._pyramid_band_mask(mask, config)
+                return [
+                    self.padded_shape(int(h * ratio + 0.5), int(w * ratio + 0.5))
+                ] + [
+                    self.padded_shape(b - t, r - l)
+                    for l, t, r, b in self._masked_tile_boxes(band_mask, config)
+                ]
+        return [self.padded_shape(*image.shape[:2])]
+
+    def downgrade_configs(self, image, config: Config):
+        """
+        Configs using less memory than config, from the cheapest change of the result
+        to the most: Crop, Tile, then Resize with decreasing limit
+        """
+        longer_side = max(image.shape[:2])
+        if config.hd_strategy != HDStrategy.CROP:
+            yield config.copy(
+                update={
+                    "hd_strategy": HDStrategy.CROP,
+                    "hd_strategy_crop_trigger_size": min(
+                        config.hd_strategy_crop_trigger_size, longer_side - 1
+                    ),
+                    "hd_strategy_crop_batch_size": 1,
+                }
+            )
+        # tiles keep the resolution, try them before resizing
+        tile_size = min(config.hd_strategy_tile_size, FALLBACK_TILE_SIZE)
+        if config.hd_strategy != HDStrategy.TILE and longer_side > tile_size:
+            yield config.copy(
+                update={
+                    "hd_strategy": HDStrategy.TILE,
+                    "hd_strategy_tile_size": tile_size,
+                    "hd_strategy_tile_batch_size": 1,
+                }
+            )
+        limit = min(config.hd_strategy_resize_limit, longer_side)
+        while limit >= 256:
+            limit = limit * 3 // 4
+            yield config.copy(
+                update={
+                    "hd_strategy": HDStrategy.RESIZE,
+                    "hd_strategy_resize_limit": limit,
+                }
+            )
+
+    def _autocast(self):
+        if self.cast_weights:
+            return contextlib.nullcontext()
+        return precision.autocast(self.device, self.precision)
+
+    @tracing.traced("pad_forward")
+    def _pad_forward(self, image, mask, config: Config):
+        with metrics.timer("preprocess"):
+            pad_image = self._pad(image)
+            pad_mask = self._pad(mask)
+
         logger.info(f"final forward pad size: {pad_image.shape}")
+        self._count_shape(pad_image.shape)
+
+        with metrics.timer("forward"), self._autocast():
+            result = self.forward(pad_image, pad_mask, config)
+        with metrics.timer("postprocess"):
+            return self._blend_result(result, image, mask, config)
+
+    @tracing.traced("pad_forward_batch")
+    def _pad_forward_batch(self, images, masks, config: Config):
+        """
+        Pad all images, images with the same padded shape are run in one forward_batch
+
+        Returns:
+            list of BGR IMAGE, same order as images
+        """
+        groups = {}
+        with metrics.timer("preprocess"):
+            for i, (image, mask) in enumerate(zip(images, masks)):
+                pad_image = self._pad(image)
+                pad_mask = self._pad(mask)
+                groups.setdefault(pad_image.shape, []).append((i, pad_image, pad_mask))
+
+        results = [None] * len(images)
+        for pad_shape, items in groups.items():
+            logger.info(
+                f"batch forward pad size: {pad_shape}, batch size: {len(items)}"
+            )
+            self._count_shape(pad_shape, len(items))
+            with metrics.timer("forward"), self._autocast():
+                batch_result = self.forward_batch(
+                    [it[1] for it in items], [it[2] for it in items], config
+                )
+            with metrics.timer("postprocess"):
+                for (i, _, _), result in zip(items, batch_result):
+                    results[i] = self._blend_result(result, images[i], masks[i], config)
+        return results
 
-        result = self.forward(pad_image, pad_mask, config)
+    def _blend_result(self, result, image, mask, config: Config):
+        origin_height, origin_width = image.shape[:2]
         result = result[0:origin_height, 0:origin_width, :]
 
-        result, image, mask = self.forward_post_process(result, image, mask, config)
+        with tracing.span("forward_post_process"):
+            result, image, mask = self.forward_post_process(result, image, mask, config)
 
-        mask = mask[:, :, np.newaxis]
-        result = result * (mask / 255) + image[:, :, ::-1] * (1 - (mask / 255))
-        return result
+        return blend_masked(result, image, mask, self.mask_blur(config))
 
     def forward_post_process(self, result, image, mask, config):
         return result, image, mask
 
+    def mask_blur(self, config: Config) -> int:
+        """Radius of the gaussian blur applied to the mask before blending"""
+        return 0
+
     @torch.no_grad()
+    @with_oom_fallback
+    @tracing.traced("InpaintModel.__call__")
     def __call__(self, image, mask, config: Config):
         """
         images: [H, W, C] RGB, not normalized
@@ -84,13 +330,13 @@ class InpaintModel:
         if config.hd_strategy == HDStrategy.CROP:
             if max(image.shape) > config.hd_strategy_crop_trigger_size:
                 logger.info(f"Run crop strategy")
-                boxes = boxes_from_mask(mask)
                 crop_result = []
-                for box in boxes:
-                    crop_image, crop_box = self._run_box(image, mask, box, config)
-                    crop_result.append((crop_image, crop_box))
+                for windows in self._crop_batches(mask, config):
+                    check_cancelled()
+                    crop_images = self._run_boxes(image, mask, windows, config)
+                    crop_result.extend(zip(crop_images, windows))
 
-                inpaint_result = image[:, :, ::-1]
+                inpaint_result = image[:, :, ::-1].copy()
                 for crop_image, crop_box in crop_result:
                     x1, y1, x2, y2 = crop_box
                     inpaint_result[y1:y2, x1:x2, :] = crop_image
@@ -98,12 +344,13 @@ class InpaintModel:
         elif config.hd_strategy == HDStrategy.RESIZE:
             if max(image.shape) > config.hd_strategy_resize_limit:
                 origin_size = image.shape[:2]
-                downsize_image = resize_max_size(
-                    image, size_limit=config.hd_strategy_resize_limit
-                )
-                downsize_mask = resize_max_size(
-                    mask, size_limit=config.hd_strategy_resize_limit
-                )
+                with metrics.timer("preprocess"):
+                    downsize_image = resize_max_size(
+                        image, size_limit=config.hd_strategy_resize_limit
+                    )
+                    downsize_mask = resize_max_size(
+                        mask, size_limit=config.hd_strategy_resize_limit
+                    )
 
                 logger.info(
                     f"Run resize strategy, origin size: {image.shape} forward size: {downsize_image.shape}"
@@ -113,21 +360,116 @@ class InpaintModel:
                 )
 
                 # only paste masked area result
-                inpaint_result = cv2.resize(
-                    inpaint_result,
-                    (origin_size[1], origin_size[0]),
-                    interpolation=cv2.INTER_CUBIC,
-                )
-                original_pixel_indices = mask < 127
-                inpaint_result[original_pixel_indices] = image[:, :, ::-1][
-                    original_pixel_indices
-                ]
+                with metrics.timer("postprocess"):
+                    inpaint_result = cv2.resize(
+                        inpaint_result,
+                        (origin_size[1], origin_size[0]),
+                        interpolation=cv2.INTER_CUBIC,
+                    )
+                    original_pixel_indices = mask < 127
+                    inpaint_result[original_pixel_indices] = image[:, :, ::-1][
+                        original_pixel_indices
+                    ]
+
+        elif config.hd_strategy == HDStrategy.TILE:
+            if max(image.shape) > self._tile_size(config):
+                logger.info(f"Run tile strategy")
+                inpaint_result = self._run_tiles(image, mask, config)
+
+        elif config.hd_strategy == HDStrategy.PYRAMID:
+            if max(image.shape) > config.hd_strategy_resize_limit:
+                logger.info(f"Run pyramid strategy")
+                inpaint_result = self._run_pyramid(image, mask, config)
 
         if inpaint_result is None:
             inpaint_result = self._pad_forward(image, mask, config)
 
         return inpaint_result
 
+    @torch.no_grad()
+    @tracing.traced("InpaintModel.incremental_call")
+    def incremental_call(self, image, mask, prev_mask, prev_result, config: Config):
+        """
+        Only inpaint mask regions changed since prev_mask, the others are copied from
+        prev_result. Every changed region runs like crop strategy, no matter what
+        config.hd_strategy is
+        images: [H, W, C] RGB, not normalized
+        masks: [H, W], mask of all strokes
+        prev_mask: [H, W], mask of prev_result
+        prev_result: [H, W, C] BGR IMAGE, result of prev_mask
+        return: BGR IMAGE
+        """
+        cur = mask > 127
+        prev = prev_mask > 127
+        inpaint_result = prev_result.copy()
+
+        # restore pixels erased from mask
+        removed = prev & ~cur
+        inpaint_result[removed] = image[:, :, ::-1][removed]
+
+        changed = (cur != prev).astype(np.uint8)
+        if not changed.any():
+            return inpaint_result
+
+        # a region is also changed when the stroke next to it is erased
+        changed = cv2.dilate(changed, np.ones((3, 3), np.uint8))
+        num_labels, labels, stats, _ = cv2.connectedComponentsWithStats(
+            cur.astype(np.uint8), connectivity=8
+        )
+        changed_labels = np.unique(labels[changed > 0])
+        changed_labels = changed_labels[changed_labels != 0]
+        logger.info(
+            f"Incremental inpainting: {len(changed_labels)}/{num_labels - 1} regions changed"
+        )
+
+        for label in changed_labels:
+            check_cancelled()
+            x, y, w, h = stats[label, :4]
+            crop_image, [l, t, r, b] = self._run_box(
+                image, mask, [x, y, x + w, y + h], config
+            )
+            # other regions in the crop keep their previous result
+            region = labels[t:b, l:r] == label
+            inpaint_result[t:b, l:r][region] = crop_image[region]
+
+        return inpaint_result
+
+    def _use_hd_strategy(self, image, config: Config) -> bool:
+        if config.hd_strategy == HDStrategy.CROP:
+            return max(image.shape) > config.hd_strategy_crop_trigger_size
+        if config.hd_strategy in (HDStrategy.RESIZE, HDStrategy.PYRAMID):
+            return max(image.shape) > config.hd_strategy_resize_limit
+        if config.hd_strategy == HDStrategy.TILE:
+            return max(image.shape) > self._tile_size(config)
+        return False
+
+    @torch.no_grad()
+    @tracing.traced("InpaintModel.inpaint_batch")
+    def inpaint_batch(self, images, masks, config: Config):
+        """
+        Images not triggering hd strategy are batched, the others run one by one
+        images: list of [H, W, C] RGB, not normalized
+        masks: list of [H, W]
+        return: list of BGR IMAGE
+        """
+        results = [None] * len(images)
+        batch_indices = []
+        for i, (image, mask) in enumerate(zip(images, masks)):
+            if self._use_hd_strategy(image, config):
+                check_cancelled()
+                results[i] = self(image, mask, config)
+            else:
+                batch_indices.append(i)
+
+        batch_results = self._pad_forward_batch(
+            [images[i] for i in batch_indices],
+            [masks[i] for i in batch_indices],
+            config,
+        )
+        for i, result in zip(batch_indices, batch_results):
+            results[i] = result
+        return results
+
     def _crop_box(self, image, mask, box, config: Config):
         """
 
@@ -139,15 +481,31 @@ class InpaintModel:
         Returns:
             BGR IMAGE, (l, r, r, b)
         """
+        l, t, r, b = self._crop_box_coords(box, *image.shape[:2], config)
+        crop_img = image[t:b, l:r, :]
+        crop_mask = mask[t:b, l:r]
+
+        logger.info(
+            f"box size: ({box[3] - box[1]},{box[2] - box[0]}) crop size: {crop_img.shape}"
+        )
+
+        return crop_img, crop_mask, [l, t, r, b]
+
+    @staticmethod
+    def _crop_box_coords(box, img_h: int, img_w: int, config: Config):
+        """box with crop margin, moved inside the image"""
         box_h = box[3] - box[1]
         box_w = box[2] - box[0]
         cx = (box[0] + box[2]) // 2
         cy = (box[1] + box[3]) // 2
-        img_h, img_w = image.shape[:2]
 
         w = box_w + config.hd_strategy_crop_margin * 2
         h = box_h + config.hd_strategy_crop_margin * 2
+        return InpaintModel._window_coords(cx, cy, w, h, img_h, img_w)
 
+    @staticmethod
+    def _window_coords(cx: int, cy: int, w: int, h: int, img_h: int, img_w: int):
+        """w x h window centered at (cx, cy), moved inside the image"""
         _l = cx - w // 2
         _r = cx + w // 2
         _t = cy - h // 2
@@ -172,53 +530,201 @@ class InpaintModel:
         r = min(r, img_w)
         t = max(t, 0)
         b = min(b, img_h)
+        return l, t, r, b
 
-        crop_img = image[t:b, l:r, :]
-        crop_mask = mask[t:b, l:r]
+    def _plan_crop_boxes(self, mask, config: Config) -> List[Tuple[int, int, int, int]]:
+        """
+        Crop windows of the boxes of mask. Overlapping windows are merged when the
+        window of the merged box is not larger than the two windows, so specks close
+        to each other run in one crop. Windows are grown to multiples of CROP_BIN_MOD
+        to get more crops of the same size to batch
+        """
+        img_h, img_w = mask.shape[:2]
+        boxes = [list(it) for it in boxes_from_mask(mask)]
+        windows = [self._crop_box_coords(it, img_h, img_w, config) for it in boxes]
+
+        def area(window):
+            return (window[2] - window[0]) * (window[3] - window[1])
+
+        merged = True
+        while merged:
+            merged = False
+            i = 0
+            while i < len(boxes):
+                j = i + 1
+                while j < len(boxes):
+                    wi, wj = windows[i], windows[j]
+                    overlapped = (
+                        wi[0] < wj[2]
+                        and wj[0] < wi[2]
+                        and wi[1] < wj[3]
+                        and wj[1] < wi[3]
+                    )
+                    if overlapped:
+                        box = [
+                            min(boxes[i][0], boxes[j][0]),
+                            min(boxes[i][1], boxes[j][1]),
+                            max(boxes[i][2], boxes[j][2]),
+                            max(boxes[i][3], boxes[j][3]),
+                        ]
+                        window = self._crop_box_coords(box, img_h, img_w, config)
+                        if area(window) <= area(wi) + area(wj):
+                            boxes[i], windows[i] = box, window
+                            del boxes[j], windows[j]
+                            merged = True
+                            continue
+                    j += 1
+                i += 1
+
+        result = []
+        for l, t, r, b in windows:
+            w = min(ceil_modulo(r - l, CROP_BIN_MOD), img_w)
+            h = min(ceil_modulo(b - t, CROP_BIN_MOD), img_h)
+            cx, cy = (l + r) // 2, (t + b) // 2
+            result.append(self._window_coords(cx, cy, w, h, img_h, img_w))
+        return result
 
-        logger.info(f"box size: ({box_h},{box_w}) crop size: {crop_img.shape}")
+    def _crop_batches(self, mask, config: Config) -> List[List[Tuple[int, ...]]]:
+        """Crop windows of the same size in batches of hd_strategy_crop_batch_size"""
+        batch_size = max(config.hd_strategy_crop_batch_size, 1)
+        groups = {}
+        for l, t, r, b in self._plan_crop_boxes(mask, config):
+            groups.setdefault((b - t, r - l), []).append((l, t, r, b))
+        return [
+            windows[i : i + batch_size]
+            for windows in groups.values()
+            for i in range(0, len(windows), batch_size)
+        ]
 
-        return crop_img, crop_mask, [l, t, r, b]
+    def _tile_size(self, config: Config) -> int:
+        """At least MIN_TILE_SIZE and a multiple of pad_mod, so tiles aren't padded"""
+        return ceil_modulo(
+            max(config.hd_strategy_tile_size, MIN_TILE_SIZE), self.pad_mod
+        )
 
-    def _calculate_cdf(self, histogram):
-        cdf = histogram.cumsum()
-        normalized_cdf = cdf / float(cdf.max())
-        return normalized_cdf
-
-    def _calculate_lookup(self, source_cdf, reference_cdf):
-        lookup_table = np.zeros(256)
-        lookup_val = 0
-        for source_index, source_val in enumerate(source_cdf):
-            for reference_index, reference_val in enumerate(reference_cdf):
-                if reference_val >= source_val:
-                    lookup_val = reference_index
-                    break
-            lookup_table[source_index] = lookup_val
-        return lookup_table
-
-    def _match_histograms(self, source, reference, mask):
-        transformed_channels = []
-        for channel in range(source.shape[-1]):
-            source_channel = source[:, :, channel]
-            reference_channel = reference[:, :, channel]
-
-            # only calculate histograms for non-masked parts
-            source_histogram, _ = np.histogram(source_channel[mask == 0], 256, [0, 256])
-            reference_histogram, _ = np.histogram(
-                reference_channel[mask == 0], 256, [0, 256]
-            )
+    def _tile_overlap(self, config: Config) -> int:
+        return min(
+            max(config.hd_strategy_tile_overlap, 0), self._tile_size(config) // 2
+        )
 
-            source_cdf = self._calculate_cdf(source_histogram)
-            reference_cdf = self._calculate_cdf(reference_histogram)
+    def _tile_boxes(self, img_h: int, img_w: int, config: Config) -> List[List[int]]:
+        """Overlapping tiles covering the image, last tiles are moved inside the image"""
+        tile_size = self._tile_size(config)
+        overlap = self._tile_overlap(config)
+        stride = tile_size - overlap
+
+        def starts(length):
+            if length <= tile_size:
+                return [0]
+            return list(range(0, length - tile_size, stride)) + [length - tile_size]
+
+        return [
+            [l, t, min(l + tile_size, img_w), min(t + tile_size, img_h)]
+            for t in starts(img_h)
+            for l in starts(img_w)
+        ]
 
-            lookup = self._calculate_lookup(source_cdf, reference_cdf)
+    def _masked_tile_boxes(self, mask, config: Config) -> List[List[int]]:
+        """Tiles without mask keep the original image, they are not inpainted"""
+        masked = mask > 127
+        return [
+            [l, t, r, b]
+            for l, t, r, b in self._tile_boxes(*mask.shape[:2], config)
+            if masked[t:b, l:r].any()
+        ]
 
-            transformed_channels.append(cv2.LUT(source_channel, lookup))
+    @staticmethod
+    def _tile_weight(height: int, width: int, overlap: int) -> np.ndarray:
+        """Weight rising linearly from the tile border over the overlap"""
 
-        result = cv2.merge(transformed_channels)
-        result = cv2.convertScaleAbs(result)
+        def ramp(n):
+            x = np.arange(n, dtype=np.float32)
+            return np.minimum(np.minimum(x + 1, n - x) / (overlap + 1), 1)
 
-        return result
+        return np.outer(ramp(height), ramp(width))
+
+    def _run_tiles(self, image, mask, config: Config):
+        """
+        Inpaint tiles containing mask, hd_strategy_tile_batch_size tiles in one
+        forward. Overlapping results are averaged with feathered weights so there is
+        no seam between tiles
+        """
+        boxes = self._masked_tile_boxes(mask, config)
+        overlap = self._tile_overlap(config)
+        batch_size = max(config.hd_strategy_tile_batch_size, 1)
+
+        inpaint_result = image[:, :, ::-1].astype(np.float32)
+        accumulated = np.zeros_like(inpaint_result)
+        weights = np.zeros(image.shape[:2], dtype=np.float32)
+        for i in range(0, len(boxes), batch_size):
+            check_cancelled()
+            batch = boxes[i : i + batch_size]
+            with tracing.span("run_tiles", tiles=batch):
+                results = self._pad_forward_batch(
+                    [image[t:b, l:r, :] for l, t, r, b in batch],
+                    [mask[t:b, l:r] for l, t, r, b in batch],
+                    config,
+                )
+            with metrics.timer("postprocess"):
+                for (l, t, r, b), result in zip(batch, results):
+                    weight = self._tile_weight(b - t, r - l, overlap)
+                    accumulated[t:b, l:r, :] += result * weight[:, :, np.newaxis]
+                    weights[t:b, l:r] += weight
+
+        with metrics.timer("postprocess"):
+            # pixels outside the mask keep the original value
+            covered = (weights > 0) & (mask > 127)
+            inpaint_result[covered] = (
+                accumulated[covered] / weights[covered, np.newaxis]
+            )
+        return inpaint_result
+
+    @staticmethod
+    def _pyramid_band_mask(mask, config: Config):
+        """Part of mask within hd_strategy_pyramid_band of the mask border"""
+        dist = cv2.distanceTransform(
+            (mask > 127).astype(np.uint8), cv2.DIST_L2, cv2.DIST_MASK_3
+        )
+        return np.where(dist <= config.hd_strategy_pyramid_band, mask, 0).astype(
+            np.uint8
+        )
+
+    def _run_pyramid(self, image, mask, config: Config):
+        """
+        Inpaint the image resized to hd_strategy_resize_limit, then inpaint the border
+        band of the mask in full resolution tiles. The upsampled low resolution
+        result fills the rest of the mask and is the context of the band, so the
+        band joins the low resolution fill without seams
+        """
+        origin_h, origin_w = image.shape[:2]
+        with metrics.timer("preprocess"):
+            downsize_image = resize_max_size(
+                image, size_limit=config.hd_strategy_resize_limit
+            )
+            downsize_mask = resize_max_size(
+                mask, size_limit=config.hd_strategy_resize_limit
+            )
+        logger.info(
+            f"Run pyramid strategy, origin size: {image.shape} "
+            f"low resolution size: {downsize_image.shape}"
+        )
+        with tracing.span("pyramid_low_res"):
+            low_res = self._pad_forward(downsize_image, downsize_mask, config)
+
+        with metrics.timer("postprocess"):
+            fill = cv2.resize(
+                low_res.astype(np.float32),
+                (origin_w, origin_h),
+                interpolation=cv2.INTER_CUBIC,
+            )
+            # soft mask border keeps the original image, it's blended by the band
+            guided = image.copy()
+            masked = mask > 127
+            guided[masked] = np.clip(fill[:, :, ::-1][masked], 0, 255).astype(np.uint8)
+            band_mask = self._pyramid_band_mask(mask, config)
+
+        with tracing.span("pyramid_refine"):
+            return self._run_tiles(guided, band_mask, config)
 
     def _apply_cropper(self, image, mask, config: Config):
         img_h, img_w = image.shape[:2]
@@ -253,11 +759,50 @@ class InpaintModel:
         """
         crop_img, crop_mask, [l, t, r, b] = self._crop_box(image, mask, box, config)
 
-        return self._pad_forward(crop_img, crop_mask, config), [l, t, r, b]
+        with tracing.span("run_box", box=[int(it) for it in (l, t, r, b)]):
+            return self._pad_forward(crop_img, crop_mask, config), [l, t, r, b]
+
+    def _run_boxes(self, image, mask, windows, config: Config):
+        """
+        Run crop windows of the same size in one batch
+
+        Args:
+            image: [H, W, C] RGB
+            mask: [H, W, 1]
+            windows: list of [left,top,right,bottom]
+
+        Returns:
+            list of BGR IMAGE
+        """
+        logger.info(
+            f"crop size: {windows[0][3] - windows[0][1]}x"
+            f"{windows[0][2] - windows[0][0]}, batch size: {len(windows)}"
+        )
+        with tracing.span("run_boxes", boxes=[[int(x) for x in it] for it in windows]):
+            return self._pad_forward_batch(
+                [image[t:b, l:r, :] for l, t, r, b in windows],
+                [mask[t:b, l:r] for l, t, r, b in windows],
+                config,
+            )
 
 
 class DiffusionInpaintModel(InpaintModel):
+    cuda_half = True
+    cast_weights = True
+
+    @torch.no_grad()
+    def inpaint_batch(self, images, masks, config: Config):
+        # diffusion pipelines run one image per call
+        return [self(image, mask, config) for image, mask in zip(images, masks)]
+
     @torch.no_grad()
+    def incremental_call(self, image, mask, prev_mask, prev_result, config: Config):
+        # diffusion results depend on the whole mask and prompt, always rerun
+        return self(image, mask, config)
+
+    @torch.no_grad()
+    @with_oom_fallback
+    @tracing.traced("DiffusionInpaintModel.__call__")
     def __call__(self, image, mask, config: Config):
         """
         images: [H, W, C] RGB, not normalized
@@ -268,13 +813,29 @@ class DiffusionInpaintModel(InpaintModel):
         if config.use_croper:
             crop_img, crop_mask, (l, t, r, b) = self._apply_cropper(image, mask, config)
             crop_image = self._scaled_pad_forward(crop_img, crop_mask, config)
-            inpaint_result = image[:, :, ::-1]
+            inpaint_result = image[:, :, ::-1].copy()
             inpaint_result[t:b, l:r, :] = crop_image
         else:
             inpaint_result = self._scaled_pad_forward(image, mask, config)
 
         return inpaint_result
 
+    def forward_shapes(self, image, mask, config: Config) -> List[Tuple[int, int]]:
+        h, w = image.shape[:2]
+        if config.use_croper:
+            _, _, (l, t, r, b) = self._apply_cropper(image, mask, config)
+            h, w = b - t, r - l
+        longer_side_length = int(config.sd_scale * max(h, w))
+        if max(h, w) > longer_side_length:
+            ratio = longer_side_length / max(h, w)
+            h, w = int(h * ratio + 0.5), int(w * ratio + 0.5)
+        return [self.padded_shape(h, w)]
+
+    def downgrade_configs(self, image, config: Config):
+        for scale in [0.75, 0.5, 0.25]:
+            if scale < config.sd_scale:
+                yield config.copy(update={"sd_scale": scale})
+
     def _scaled_pad_forward(self, image, mask, config: Config):
         longer_side_length = int(config.sd_scale * max(image.shape[:2]))
         origin_size = image.shape[:2]
@@ -9,6 +9,7 @@ from loguru import logger
 
 from lama_cleaner.model.base import DiffusionInpaintModel
 from lama_cleaner.model.utils import torch_gc, get_scheduler
+from lama_cleaner.postprocess import match_histograms
 from lama_cleaner.schema import Config
 
 
@@ -114,8 +115,6 @@ class ControlNet(DiffusionInpaintModel):
     min_size = 512
 
     def init_model(self, device: torch.device, **kwargs):
-        fp16 = not kwargs.get("no_half", False)
-
         model_kwargs = {
             "local_files_only": kwargs.get("local_files_only", kwargs["sd_run_local"])
         }
@@ -130,7 +129,7 @@ class ControlNet(DiffusionInpaintModel):
             )
 
         use_gpu = device == torch.device("cuda") and torch.cuda.is_available()
-        torch_dtype = torch.float16 if use_gpu and fp16 else torch.float32
+        torch_dtype = self.dtype
 
         sd_controlnet_method = kwargs["sd_controlnet_method"]
         self.sd_controlnet_method = sd_controlnet_method
@@ -166,7 +165,7 @@ class ControlNet(DiffusionInpaintModel):
             self.model = PipeClass.from_pretrained(
                 model_id,
                 controlnet=controlnet,
-                revision="fp16" if use_gpu and fp16 else "main",
+                revision="fp16" if torch_dtype == torch.float16 else "main",
                 torch_dtype=torch_dtype,
                 **model_kwargs,
             )
@@ -276,13 +275,18 @@ class ControlNet(DiffusionInpaintModel):
 
     def forward_post_process(self, result, image, mask, config):
         if config.sd_match_histograms:
-            result = self._match_histograms(result, image[:, :, ::-1], mask)
-
-        if config.sd_mask_blur != 0:
-            k = 2 * config.sd_mask_blur + 1
-            mask = cv2.GaussianBlur(mask, (k, k), 0)
+            result = match_histograms(
+                result,
+                image[:, :, ::-1],
+                mask,
+                margin=self.mask_blur(config),
+                device=self.device,
+            )
         return result, image, mask
 
+    def mask_blur(self, config: Config) -> int:
+        return config.sd_mask_blur
+
     @staticmethod
     def is_downloaded() -> bool:
         # model will be downloaded when app start, and can't switch in frontend settings
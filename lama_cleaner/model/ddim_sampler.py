@@ -3,6 +3,7 @@ import numpy as np
 from tqdm import tqdm
 
 from lama_cleaner.model.utils import make_ddim_timesteps, make_ddim_sampling_parameters, noise_like
+from lama_cleaner.scheduler import check_cancelled
 
 from loguru import logger
 
@@ -123,6 +124,7 @@ class DDIMSampler(object):
         iterator = tqdm(time_range, desc="DDIM Sampler", total=total_steps)
 
         for i, step in enumerate(iterator):
+            check_cancelled()
             index = total_steps - i - 1
             ts = torch.full((b,), step, device=device, dtype=torch.long)
 
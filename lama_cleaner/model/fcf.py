@@ -1627,6 +1627,8 @@ class FcF(InpaintModel):
     min_size = 512
     pad_mod = 512
     pad_to_square = True
+    # FFT doesn't support bf16 and needs power of 2 sizes in fp16 on cuda
+    fp32_modules = ("FourierUnit",)
 
     def init_model(self, device, **kwargs):
         seed = 0
@@ -1672,35 +1674,56 @@ class FcF(InpaintModel):
 
         boxes = boxes_from_mask(mask)
         crop_result = []
-        config.hd_strategy_crop_margin = 128
         for box in boxes:
-            crop_image, crop_mask, crop_box = self._crop_box(image, mask, box, config)
-            origin_size = crop_image.shape[:2]
-            resize_image = resize_max_size(crop_image, size_limit=512)
-            resize_mask = resize_max_size(crop_mask, size_limit=512)
-            inpaint_result = self._pad_forward(resize_image, resize_mask, config)
-
-            # only paste masked area result
-            inpaint_result = cv2.resize(
-                inpaint_result,
-                (origin_size[1], origin_size[0]),
-                interpolation=cv2.INTER_CUBIC,
-            )
-
-            original_pixel_indices = crop_mask < 127
-            inpaint_result[original_pixel_indices] = crop_image[:, :, ::-1][
-                original_pixel_indices
-            ]
-
-            crop_result.append((inpaint_result, crop_box))
+            crop_result.append(self._run_box(image, mask, box, config))
 
-        inpaint_result = image[:, :, ::-1]
+        inpaint_result = image[:, :, ::-1].copy()
         for crop_image, crop_box in crop_result:
             x1, y1, x2, y2 = crop_box
             inpaint_result[y1:y2, x1:x2, :] = crop_image
 
         return inpaint_result
 
+    def forward_shapes(self, image, mask, config: Config):
+        # every box is resized to 512 and padded to 512x512
+        return [(512, 512)] * max(len(boxes_from_mask(mask)), 1)
+
+    def downgrade_configs(self, image, config: Config):
+        # hd strategy doesn't change the forward size
+        return iter(())
+
+    def _run_box(self, image, mask, box, config: Config):
+        """
+        Crop around box and resize the crop to 512
+
+        Returns:
+            BGR IMAGE, [l, t, r, b]
+        """
+        config.hd_strategy_crop_margin = 128
+        crop_image, crop_mask, crop_box = self._crop_box(image, mask, box, config)
+        origin_size = crop_image.shape[:2]
+        resize_image = resize_max_size(crop_image, size_limit=512)
+        resize_mask = resize_max_size(crop_mask, size_limit=512)
+        inpaint_result = self._pad_forward(resize_image, resize_mask, config)
+
+        # only paste masked area result
+        inpaint_result = cv2.resize(
+            inpaint_result,
+            (origin_size[1], origin_size[0]),
+            interpolation=cv2.INTER_CUBIC,
+        )
+
+        original_pixel_indices = crop_mask < 127
+        inpaint_result[original_pixel_indices] = crop_image[:, :, ::-1][
+            original_pixel_indices
+        ]
+        return inpaint_result, crop_box
+
+    @torch.no_grad()
+    def inpaint_batch(self, images, masks, config: Config):
+        # every image is cropped and resized to 512x512 in __call__
+        return [self(image, mask, config) for image, mask in zip(images, masks)]
+
     def forward(self, image, mask, config: Config):
         """Input images and output images have same size
         images: [H, W, C] RGB
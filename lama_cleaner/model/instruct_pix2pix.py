@@ -15,7 +15,6 @@ class InstructPix2Pix(DiffusionInpaintModel):
 
     def init_model(self, device: torch.device, **kwargs):
         from diffusers import StableDiffusionInstructPix2PixPipeline
-        fp16 = not kwargs.get('no_half', False)
 
         model_kwargs = {"local_files_only": kwargs.get('local_files_only', False)}
         if kwargs['disable_nsfw'] or kwargs.get('cpu_offload', False):
@@ -27,10 +26,10 @@ class InstructPix2Pix(DiffusionInpaintModel):
             ))
 
         use_gpu = device == torch.device('cuda') and torch.cuda.is_available()
-        torch_dtype = torch.float16 if use_gpu and fp16 else torch.float32
+        torch_dtype = self.dtype
         self.model = StableDiffusionInstructPix2PixPipeline.from_pretrained(
             "timbrooks/instruct-pix2pix",
-            revision="fp16" if use_gpu and fp16 else "main",
+            revision="fp16" if torch_dtype == torch.float16 else "main",
             torch_dtype=torch_dtype,
             **model_kwargs
         )
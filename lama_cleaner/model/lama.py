@@ -1,15 +1,21 @@
+import inspect
 import os
+from pathlib import Path
 
 import cv2
 import numpy as np
 import torch
+from loguru import logger
 
+from lama_cleaner import tracing
 from lama_cleaner.helper import (
     norm_img,
     get_cache_path_by_url,
     load_jit_model,
+    load_onnx_session,
 )
 from lama_cleaner.model.base import InpaintModel
+from lama_cleaner.onnx_symbolics import register_fft_symbolics
 from lama_cleaner.schema import Config
 
 LAMA_MODEL_URL = os.environ.get(
@@ -17,14 +23,71 @@ LAMA_MODEL_URL = os.environ.get(
     "https://github.com/Sanster/models/releases/download/add_big_lama/big-lama.pt",
 )
 LAMA_MODEL_MD5 = os.environ.get("LAMA_MODEL_MD5", "e3aa4aaa15225a33ec84f9f4bc47e500")
+LAMA_ONNX_MODEL_PATH = os.environ.get(
+    "LAMA_ONNX_MODEL_PATH",
+    str(Path(get_cache_path_by_url(LAMA_MODEL_URL)).with_suffix(".onnx")),
+)
 
 
 class LaMa(InpaintModel):
     name = "lama"
     pad_mod = 8
+    # FFT in the TorchScript model can't be kept in fp32, cuFFT doesn't support bf16
+    # and needs power of 2 sizes in fp16, cpu autocast runs FFT in fp32
+    precisions = {"cpu": ("bf16",)}
 
     def init_model(self, device, **kwargs):
-        self.model = load_jit_model(LAMA_MODEL_URL, device, LAMA_MODEL_MD5).eval()
+        self.session = None
+        if kwargs.get("backend", "torch") != "onnxruntime":
+            self.model = load_jit_model(LAMA_MODEL_URL, device, LAMA_MODEL_MD5).eval()
+            return
+
+        onnx_model = kwargs.get("onnx_model") or LAMA_ONNX_MODEL_PATH
+        if not os.path.exists(onnx_model):
+            logger.info(f"{onnx_model} not found, export it from TorchScript model")
+            self.export_onnx(onnx_model)
+        # created once and reused by all requests, InferenceSession.run is thread safe
+        self.session = load_onnx_session(
+            onnx_model,
+            device,
+            intra_op_threads=kwargs.get("onnx_intra_op_threads", 0),
+            inter_op_threads=kwargs.get("onnx_inter_op_threads", 0),
+        )
+        self.model = None
+
+    @staticmethod
+    def export_onnx(output, opset_version: int = 17):
+        """Export big-lama.pt with dynamic batch size, height and width, FFT needs
+        opset 17 or later
+
+        height and width of the inputs must be multiple of pad_mod
+        """
+        register_fft_symbolics(opset_version)
+        model = load_jit_model(LAMA_MODEL_URL, torch.device("cpu"), LAMA_MODEL_MD5)
+        image = torch.rand(1, 3, 512, 512)
+        mask = (torch.rand(1, 1, 512, 512) > 0.5).float()
+        Path(output).parent.mkdir(parents=True, exist_ok=True)
+        dynamic_axes = {0: "batch", 2: "height", 3: "width"}
+        kwargs = {}
+        # torch>=2.9 defaults to the dynamo exporter, which doesn't take TorchScript
+        if "dynamo" in inspect.signature(torch.onnx.export).parameters:
+            kwargs["dynamo"] = False
+        with torch.no_grad():
+            torch.onnx.export(
+                model,
+                (image, mask),
+                str(output),
+                input_names=["image", "mask"],
+                output_names=["output"],
+                dynamic_axes={
+                    "image": dynamic_axes,
+                    "mask": dynamic_axes,
+                    "output": dynamic_axes,
+                },
+                opset_version=opset_version,
+                **kwargs,
+            )
+        logger.info(f"Export lama onnx model to: {output}")
 
     @staticmethod
     def is_downloaded() -> bool:
@@ -36,16 +99,35 @@ class LaMa(InpaintModel):
         mask: [H, W]
         return: BGR IMAGE
         """
-        image = norm_img(image)
-        mask = norm_img(mask)
+        return self.forward_batch([image], [mask], config)[0]
 
-        mask = (mask > 0) * 1
-        image = torch.from_numpy(image).unsqueeze(0).to(self.device)
-        mask = torch.from_numpy(mask).unsqueeze(0).to(self.device)
+    def forward_batch(self, images, masks, config: Config):
+        """Images with the same size are stacked and run in one forward
+        images: list of [H, W, C] RGB
+        masks: list of [H, W]
+        return: list of BGR IMAGE
+        """
+        with tracing.span("to_tensor", batch_size=len(images)):
+            image = np.stack([norm_img(it) for it in images])
+            mask = np.stack([(norm_img(it) > 0) * 1 for it in masks])
+            if self.session is None:
+                image = torch.from_numpy(image).to(self.device)
+                mask = torch.from_numpy(mask).to(self.device)
 
-        inpainted_image = self.model(image, mask)
+        if self.session is not None:
+            with tracing.span(
+                "lama_forward", device=self.device, backend="onnxruntime"
+            ):
+                inpainted_image = self.session.run(
+                    None, {"image": image, "mask": mask.astype(np.float32)}
+                )[0]
+        else:
+            with tracing.span("lama_forward", device=self.device):
+                inpainted_image = self.model(image, mask)
 
-        cur_res = inpainted_image[0].permute(1, 2, 0).detach().cpu().numpy()
-        cur_res = np.clip(cur_res * 255, 0, 255).astype("uint8")
-        cur_res = cv2.cvtColor(cur_res, cv2.COLOR_RGB2BGR)
-        return cur_res
+        with tracing.span("to_numpy"):
+            if isinstance(inpainted_image, torch.Tensor):
+                inpainted_image = inpainted_image.detach().float().cpu().numpy()
+            cur_res = inpainted_image.transpose(0, 2, 3, 1)
+            cur_res = np.clip(cur_res * 255, 0, 255).astype("uint8")
+            return [cv2.cvtColor(it, cv2.COLOR_RGB2BGR) for it in cur_res]
@@ -4,6 +4,7 @@ import numpy as np
 import torch
 from loguru import logger
 
+from lama_cleaner import tracing
 from lama_cleaner.model.base import InpaintModel
 from lama_cleaner.model.ddim_sampler import DDIMSampler
 from lama_cleaner.model.plms_sampler import PLMSSampler
@@ -237,10 +238,12 @@ class LatentDiffusion(DDPM):
 class LDM(InpaintModel):
     name = "ldm"
     pad_mod = 32
+    precisions = {"cuda": ("fp16",)}
+    cuda_half = True
+    cast_weights = True
 
-    def __init__(self, device, fp16: bool = True, **kwargs):
-        self.fp16 = fp16
-        super().__init__(device)
+    def __init__(self, device, **kwargs):
+        super().__init__(device, **kwargs)
         self.device = device
 
     def init_model(self, device, **kwargs):
@@ -253,7 +256,7 @@ class LDM(InpaintModel):
         self.cond_stage_model_encode = load_jit_model(
             LDM_ENCODE_MODEL_URL, device, LDM_ENCODE_MODEL_MD5
         )
-        if self.fp16 and "cuda" in str(device):
+        if self.precision == "fp16":
             self.diffusion_model = self.diffusion_model.half()
             self.cond_stage_model_decode = self.cond_stage_model_decode.half()
             self.cond_stage_model_encode = self.cond_stage_model_encode.half()
@@ -300,20 +303,23 @@ class LDM(InpaintModel):
         mask = self._norm(mask)
         masked_image = self._norm(masked_image)
 
-        c = self.cond_stage_model_encode(masked_image)
+        with tracing.span("cond_stage_model_encode", device=self.device):
+            c = self.cond_stage_model_encode(masked_image)
         torch.cuda.empty_cache()
 
         cc = torch.nn.functional.interpolate(mask, size=c.shape[-2:])  # 1,1,128,128
         c = torch.cat((c, cc), dim=1)  # 1,4,128,128
 
         shape = (c.shape[1] - 1,) + c.shape[2:]
-        samples_ddim = sampler.sample(
-            steps=steps, conditioning=c, batch_size=c.shape[0], shape=shape
-        )
+        with tracing.span("sample", device=self.device, steps=steps):
+            samples_ddim = sampler.sample(
+                steps=steps, conditioning=c, batch_size=c.shape[0], shape=shape
+            )
         torch.cuda.empty_cache()
-        x_samples_ddim = self.cond_stage_model_decode(
-            samples_ddim
-        )  # samples_ddim: 1, 3, 128, 128 float32
+        with tracing.span("cond_stage_model_decode", device=self.device):
+            x_samples_ddim = self.cond_stage_model_decode(
+                samples_ddim
+            )  # samples_ddim: 1, 3, 128, 128 float32
         torch.cuda.empty_cache()
 
         # image = torch.clamp((image + 1.0) / 2.0, min=0.0, max=1.0)
@@ -321,7 +327,9 @@ class LDM(InpaintModel):
         inpainted_image = torch.clamp((x_samples_ddim + 1.0) / 2.0, min=0.0, max=1.0)
 
         # inpainted = (1 - mask) * image + mask * predicted_image
-        inpainted_image = inpainted_image.cpu().numpy().transpose(0, 2, 3, 1)[0] * 255
+        inpainted_image = (
+            inpainted_image.float().cpu().numpy().transpose(0, 2, 3, 1)[0] * 255
+        )
         inpainted_image = inpainted_image.astype(np.uint8)[:, :, ::-1]
         return inpainted_image
 
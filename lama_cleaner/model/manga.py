@@ -7,6 +7,7 @@ import torch
 import time
 from loguru import logger
 
+from lama_cleaner import tracing
 from lama_cleaner.helper import get_cache_path_by_url, load_jit_model
 from lama_cleaner.model.base import InpaintModel
 from lama_cleaner.schema import Config
@@ -67,7 +68,8 @@ class Manga(InpaintModel):
             gray_img[np.newaxis, np.newaxis, :, :].astype(np.float32)
         ).to(self.device)
         start = time.time()
-        lines = self.line_model(gray_img)
+        with tracing.span("erika_forward", device=self.device):
+            lines = self.line_model(gray_img)
         torch.cuda.empty_cache()
         lines = torch.clamp(lines, 0, 255)
         logger.info(f"erika_model time: {time.time() - start}")
@@ -82,10 +84,11 @@ class Manga(InpaintModel):
         lines = lines / 255 * 2 - 1.0
 
         start = time.time()
-        inpainted_image = self.inpaintor_model(gray_img, lines, mask, noise, ones)
+        with tracing.span("inpaintor_forward", device=self.device):
+            inpainted_image = self.inpaintor_model(gray_img, lines, mask, noise, ones)
         logger.info(f"image_inpaintor_model time: {time.time() - start}")
 
-        cur_res = inpainted_image[0].permute(1, 2, 0).detach().cpu().numpy()
+        cur_res = inpainted_image[0].permute(1, 2, 0).detach().float().cpu().numpy()
         cur_res = (cur_res * 127.5 + 127.5).astype(np.uint8)
         cur_res = cv2.cvtColor(cur_res, cv2.COLOR_GRAY2BGR)
         return cur_res
@@ -8,6 +8,7 @@ import torch.nn as nn
 import torch.nn.functional as F
 import torch.utils.checkpoint as checkpoint
 
+from lama_cleaner import tracing
 from lama_cleaner.helper import load_model, get_cache_path_by_url, norm_img
 from lama_cleaner.model.base import InpaintModel
 from lama_cleaner.model.utils import (
@@ -1875,14 +1876,14 @@ class MAT(InpaintModel):
     min_size = 512
     pad_mod = 512
     pad_to_square = True
+    cuda_half = True
+    cast_weights = True
 
     def init_model(self, device, **kwargs):
         seed = 240  # pick up a random number
         set_seed(seed)
 
-        fp16 = not kwargs.get("no_half", False)
-        use_gpu = "cuda" in str(device) and torch.cuda.is_available()
-        self.torch_dtype = torch.float16 if use_gpu and fp16 else torch.float32
+        self.torch_dtype = self.dtype
 
         G = Generator(
             z_dim=512,
@@ -1921,9 +1922,10 @@ class MAT(InpaintModel):
         )
         mask = torch.from_numpy(mask).unsqueeze(0).to(self.torch_dtype).to(self.device)
 
-        output = self.model(
-            image, mask, self.z, self.label, truncation_psi=1, noise_mode="none"
-        )
+        with tracing.span("mat_forward", device=self.device):
+            output = self.model(
+                image, mask, self.z, self.label, truncation_psi=1, noise_mode="none"
+            )
         output = (
             (output.permute(0, 2, 3, 1) * 127.5 + 127.5)
             .round()
@@ -7,6 +7,7 @@ from loguru import logger
 
 from lama_cleaner.model.base import DiffusionInpaintModel
 from lama_cleaner.model.utils import set_seed
+from lama_cleaner.postprocess import match_histograms
 from lama_cleaner.schema import Config
 
 
@@ -16,9 +17,8 @@ class PaintByExample(DiffusionInpaintModel):
     min_size = 512
 
     def init_model(self, device: torch.device, **kwargs):
-        fp16 = not kwargs.get('no_half', False)
         use_gpu = device == torch.device('cuda') and torch.cuda.is_available()
-        torch_dtype = torch.float16 if use_gpu and fp16 else torch.float32
+        torch_dtype = self.dtype
         model_kwargs = {"local_files_only": kwargs.get('local_files_only', False)}
 
         if kwargs['disable_nsfw'] or kwargs.get('cpu_offload', False):
@@ -66,13 +66,18 @@ class PaintByExample(DiffusionInpaintModel):
 
     def forward_post_process(self, result, image, mask, config):
         if config.paint_by_example_match_histograms:
-            result = self._match_histograms(result, image[:, :, ::-1], mask)
-
-        if config.paint_by_example_mask_blur != 0:
-            k = 2 * config.paint_by_example_mask_blur + 1
-            mask = cv2.GaussianBlur(mask, (k, k), 0)
+            result = match_histograms(
+                result,
+                image[:, :, ::-1],
+                mask,
+                margin=self.mask_blur(config),
+                device=self.device,
+            )
         return result, image, mask
 
+    def mask_blur(self, config: Config) -> int:
+        return config.paint_by_example_mask_blur
+
     @staticmethod
     def is_downloaded() -> bool:
         # model will be downloaded when app start, and can't switch in frontend settings
@@ -2,6 +2,7 @@
 import torch
 import numpy as np
 from lama_cleaner.model.utils import make_ddim_timesteps, make_ddim_sampling_parameters, noise_like
+from lama_cleaner.scheduler import check_cancelled
 from tqdm import tqdm
 
 
@@ -133,6 +134,7 @@ class PLMSSampler(object):
         old_eps = []
 
         for i, step in enumerate(iterator):
+            check_cancelled()
             index = total_steps - i - 1
             ts = torch.full((b,), step, device=device, dtype=torch.long)
             ts_next = torch.full((b,), time_range[min(i + 1, len(time_range) - 1)], device=device, dtype=torch.long)
@@ -6,8 +6,10 @@ import numpy as np
 import torch
 from loguru import logger
 
+from lama_cleaner import tracing
 from lama_cleaner.model.base import DiffusionInpaintModel
 from lama_cleaner.model.utils import torch_gc, get_scheduler
+from lama_cleaner.postprocess import match_histograms
 from lama_cleaner.schema import Config
 
 
@@ -71,8 +73,6 @@ class SD(DiffusionInpaintModel):
     def init_model(self, device: torch.device, **kwargs):
         from diffusers.pipelines.stable_diffusion import StableDiffusionInpaintPipeline
 
-        fp16 = not kwargs.get("no_half", False)
-
         model_kwargs = {
             "local_files_only": kwargs.get("local_files_only", kwargs["sd_run_local"])
         }
@@ -87,7 +87,7 @@ class SD(DiffusionInpaintModel):
             )
 
         use_gpu = device == torch.device("cuda") and torch.cuda.is_available()
-        torch_dtype = torch.float16 if use_gpu and fp16 else torch.float32
+        torch_dtype = self.dtype
 
         if kwargs.get("sd_local_model_path", None):
             self.model = load_from_local_model(
@@ -97,7 +97,7 @@ class SD(DiffusionInpaintModel):
         else:
             self.model = StableDiffusionInpaintPipeline.from_pretrained(
                 self.model_id_or_path,
-                revision="fp16" if use_gpu and fp16 else "main",
+                revision="fp16" if torch_dtype == torch.float16 else "main",
                 torch_dtype=torch_dtype,
                 use_auth_token=kwargs["hf_access_token"],
                 **model_kwargs,
@@ -140,19 +140,20 @@ class SD(DiffusionInpaintModel):
 
         img_h, img_w = image.shape[:2]
 
-        output = self.model(
-            image=PIL.Image.fromarray(image),
-            prompt=config.prompt,
-            negative_prompt=config.negative_prompt,
-            mask_image=PIL.Image.fromarray(mask[:, :, -1], mode="L"),
-            num_inference_steps=config.sd_steps,
-            guidance_scale=config.sd_guidance_scale,
-            output_type="np.array",
-            callback=self.callback,
-            height=img_h,
-            width=img_w,
-            generator=torch.manual_seed(config.sd_seed),
-        ).images[0]
+        with tracing.span("sd_pipeline", steps=config.sd_steps):
+            output = self.model(
+                image=PIL.Image.fromarray(image),
+                prompt=config.prompt,
+                negative_prompt=config.negative_prompt,
+                mask_image=PIL.Image.fromarray(mask[:, :, -1], mode="L"),
+                num_inference_steps=config.sd_steps,
+                guidance_scale=config.sd_guidance_scale,
+                output_type="np.array",
+                callback=self.callback,
+                height=img_h,
+                width=img_w,
+                generator=torch.manual_seed(config.sd_seed),
+            ).images[0]
 
         output = (output * 255).round().astype("uint8")
         output = cv2.cvtColor(output, cv2.COLOR_RGB2BGR)
@@ -160,13 +161,18 @@ class SD(DiffusionInpaintModel):
 
     def forward_post_process(self, result, image, mask, config):
         if config.sd_match_histograms:
-            result = self._match_histograms(result, image[:, :, ::-1], mask)
-
-        if config.sd_mask_blur != 0:
-            k = 2 * config.sd_mask_blur + 1
-            mask = cv2.GaussianBlur(mask, (k, k), 0)
+            result = match_histograms(
+                result,
+                image[:, :, ::-1],
+                mask,
+                margin=self.mask_blur(config),
+                device=self.device,
+            )
         return result, image, mask
 
+    def mask_blur(self, config: Config) -> int:
+        return config.sd_mask_blur
+
     @staticmethod
     def is_downloaded() -> bool:
         # model will be downloaded when app start, and can't switch in frontend settings
@@ -909,6 +909,15 @@ class Conv2dLayer(torch.nn.Module):
         return out
 
 
+def is_oom_error(e: Exception) -> bool:
+    """Out of memory error of cuda, mps or cpu allocator"""
+    oom_error = getattr(torch.cuda, "OutOfMemoryError", None)
+    if oom_error is not None and isinstance(e, oom_error):
+        return True
+    message = str(e)
+    return "out of memory" in message or "can't allocate memory" in message
+
+
 def torch_gc():
     if torch.cuda.is_available():
         torch.cuda.empty_cache()
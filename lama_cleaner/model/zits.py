@@ -5,6 +5,7 @@ import cv2
 import torch
 import torch.nn.functional as F
 
+from lama_cleaner import tracing
 from lama_cleaner.helper import get_cache_path_by_url, load_jit_model
 from lama_cleaner.schema import Config
 import numpy as np
@@ -221,6 +222,9 @@ class ZITS(InpaintModel):
     min_size = 256
     pad_mod = 32
     pad_to_square = True
+    # FFT in the TorchScript model can't be kept in fp32, cuFFT doesn't support bf16
+    # and needs power of 2 sizes in fp16, cpu autocast runs FFT in fp32
+    precisions = {"cpu": ("bf16",)}
 
     def __init__(self, device, **kwargs):
         """
@@ -228,7 +232,7 @@ class ZITS(InpaintModel):
         Args:
             device:
         """
-        super().__init__(device)
+        super().__init__(device, **kwargs)
         self.device = device
         self.sample_edge_line_iterations = 1
 
@@ -331,18 +335,20 @@ class ZITS(InpaintModel):
         mask = mask[:, :, 0]
         items = load_image(image, mask, device=self.device)
 
-        self.wireframe_edge_and_line(items, config.zits_wireframe)
-
-        inpainted_image = self.inpaint(
-            items["images"],
-            items["masks"],
-            items["edge"],
-            items["line"],
-            items["rel_pos"],
-            items["direct"],
-        )
+        with tracing.span("wireframe_edge_and_line", device=self.device):
+            self.wireframe_edge_and_line(items, config.zits_wireframe)
+
+        with tracing.span("zits_inpaint", device=self.device):
+            inpainted_image = self.inpaint(
+                items["images"],
+                items["masks"],
+                items["edge"],
+                items["line"],
+                items["rel_pos"],
+                items["direct"],
+            )
 
-        inpainted_image = inpainted_image * 255.0
+        inpainted_image = inpainted_image.float() * 255.0
         inpainted_image = (
             inpainted_image.cpu().permute(0, 2, 3, 1)[0].numpy().astype(np.uint8)
         )
@@ -374,12 +380,12 @@ class ZITS(InpaintModel):
             lines_masked = []
             scores_masked = []
         else:
-            lines_masked = output_masked["lines_pred"].numpy()
+            lines_masked = output_masked["lines_pred"].float().numpy()
             lines_masked = [
                 [line[1] * h, line[0] * w, line[3] * h, line[2] * w]
                 for line in lines_masked
             ]
-            scores_masked = output_masked["lines_score"].numpy()
+            scores_masked = output_masked["lines_score"].float().numpy()
 
         for line, score in zip(lines_masked, scores_masked):
             if score > mask_th:
@@ -1,3 +1,7 @@
+import collections
+import itertools
+import threading
+
 import torch
 import gc
 
@@ -36,12 +40,55 @@ models = {
 }
 
 
+def model_footprint(model) -> int:
+    """Bytes of parameters and buffers of all torch modules held by model"""
+    modules = []
+    for v in vars(model).values():
+        if isinstance(v, torch.nn.Module):
+            modules.append(v)
+        elif isinstance(getattr(v, "components", None), dict):
+            # diffusers pipeline
+            modules.extend(
+                it for it in v.components.values() if isinstance(it, torch.nn.Module)
+            )
+
+    seen = set()
+    total = 0
+    for module in modules:
+        for t in itertools.chain(module.parameters(), module.buffers()):
+            key = (t.device, t.data_ptr())
+            if t.data_ptr() == 0 or key in seen:
+                continue
+            seen.add(key)
+            total += t.numel() * t.element_size()
+    return total
+
+
 class ModelManager:
-    def __init__(self, name: str, device: torch.device, **kwargs):
+    def __init__(
+        self, name: str, device: torch.device, model_cache_size: int = 0, **kwargs
+    ):
+        """
+
+        Args:
+            name: model to load
+            device:
+            model_cache_size: bytes, models switched away stay loaded until their total
+                size exceeds model_cache_size, switching back to them needs no reload.
+                0 means only keep the current model
+            **kwargs: passed to model init
+        """
         self.name = name
         self.device = device
         self.kwargs = kwargs
+        self.model_cache_size = model_cache_size
+        # name -> model, least recently used first
+        self._resident = collections.OrderedDict()
+        # name -> bytes, kept after eviction to make room before loading again
+        self._footprints = {}
+        self._lock = threading.Lock()
         self.model = self.init_model(name, device, **kwargs)
+        self._add_resident(name, self.model)
 
     def init_model(self, name: str, device, **kwargs):
         if name in SD15_MODELS and kwargs.get("sd_controlnet", False):
@@ -63,22 +110,91 @@ class ModelManager:
         self.switch_controlnet_method(control_method=config.controlnet_method)
         return self.model(image, mask, config)
 
+    def inpaint_batch(self, images, masks, config: Config):
+        self.switch_controlnet_method(control_method=config.controlnet_method)
+        return self.model.inpaint_batch(images, masks, config)
+
+    def incremental_call(self, image, mask, prev_mask, prev_result, config: Config):
+        self.switch_controlnet_method(control_method=config.controlnet_method)
+        return self.model.incremental_call(image, mask, prev_mask, prev_result, config)
+
     def switch(self, new_name: str, **kwargs):
         if new_name == self.name:
             return
-        try:
-            if torch.cuda.memory_allocated() > 0:
-                # Clear current loaded model from memory
-                torch.cuda.empty_cache()
-                del self.model
-                gc.collect()
+        if new_name not in models:
+            raise NotImplementedError(f"Not supported model: {new_name}")
+
+        with self._lock:
+            if new_name in self._resident:
+                self._resident.move_to_end(new_name)
+                self.model = self._resident[new_name]
+                self.name = new_name
+                logger.info(f"Switch to resident model {new_name}")
+                return
 
-            self.model = self.init_model(
+        # make room before loading, size of a model is known after its first load
+        self._evict(reserve=self._footprints.get(new_name, 0), keep_current=False)
+        try:
+            model = self.init_model(
                 new_name, switch_mps_device(new_name, self.device), **self.kwargs
             )
-            self.name = new_name
-        except NotImplementedError as e:
-            raise e
+        except Exception:
+            self._restore_current()
+            raise
+        self.model = model
+        self.name = new_name
+        self._add_resident(new_name, model)
+
+    def _restore_current(self):
+        """Load the current model again if it was evicted by a failed switch"""
+        if self.model is not None:
+            return
+        logger.warning(f"Switch failed, load {self.name} again")
+        self.model = self.init_model(
+            self.name, switch_mps_device(self.name, self.device), **self.kwargs
+        )
+        self._add_resident(self.name, self.model)
+
+    def resident_models(self):
+        with self._lock:
+            return [
+                {
+                    "name": name,
+                    "size": self._footprints[name],
+                    "current": name == self.name,
+                }
+                for name in self._resident
+            ]
+
+    def _add_resident(self, name: str, model):
+        footprint = model_footprint(model)
+        logger.info(f"Model {name} size: {footprint / 1024 / 1024:.2f}MB")
+        with self._lock:
+            self._resident[name] = model
+            self._footprints[name] = footprint
+        self._evict()
+
+    def _evict(self, reserve: int = 0, keep_current: bool = True):
+        """
+        Drop least recently used models until their total size plus reserve fit in
+        model_cache_size
+        """
+        evicted = []
+        with self._lock:
+            while len(self._resident) > (1 if keep_current else 0):
+                total = sum(self._footprints[it] for it in self._resident)
+                if total + reserve <= self.model_cache_size:
+                    break
+                name, _ = self._resident.popitem(last=False)
+                evicted.append(name)
+        if not evicted:
+            return
+
+        logger.info(f"Evict models: {evicted}")
+        if self.name in evicted:
+            self.model = None
+        gc.collect()
+        torch_gc()
 
     def switch_controlnet_method(self, control_method: str):
         if not self.kwargs.get("sd_controlnet"):
@@ -104,6 +220,9 @@ class ModelManager:
                     f"to use {control_method} you should load a norml SD model"
                 )
 
+        # other resident sd models are loaded with the old control method
+        with self._lock:
+            self._resident.clear()
         del self.model
         torch_gc()
 
@@ -112,4 +231,5 @@ class ModelManager:
         self.model = self.init_model(
             self.name, switch_mps_device(self.name, self.device), **self.kwargs
         )
+        self._add_resident(self.name, self.model)
         logger.info(f"Switch ControlNet method from {old_method} to {control_method}")
@@ -0,0 +1,111 @@
+"""
+ONNX symbolics of the FFT ops in FourierUnit of LaMa, which the TorchScript ONNX
+exporter doesn't support: torch.fft.rfftn/irfftn with norm="ortho", and
+Tensor.real/imag/torch.complex.
+
+ONNX has no complex tensors, a complex tensor is exported as a float tensor with a
+trailing dimension of 2 (real, imag), the layout of the DFT operator (opset 17).
+"""
+
+import torch
+
+DFT_OPSET = 17
+
+
+def _const(g, value):
+    return g.op("Constant", value_t=torch.tensor(value))
+
+
+def _fft_axes(x, dim):
+    """Axes of dim in the (..., 2) layout, counted from the back"""
+    from torch.onnx import symbolic_helper
+
+    dims = symbolic_helper._get_const(dim, "is", "dim")
+    if any(it >= 0 for it in dims):
+        rank = symbolic_helper._get_tensor_rank(x)
+        dims = [it - rank if it >= 0 else it for it in dims]
+    if len(dims) != 2:
+        raise RuntimeError(f"Only 2D FFT can be exported, got dim: {dims}")
+    return [it - 1 for it in dims]
+
+
+def _check_norm(norm):
+    from torch.onnx import symbolic_helper
+
+    norm = symbolic_helper._maybe_get_const(norm, "s")
+    if norm != "ortho":
+        raise RuntimeError(f"Only ortho FFT norm can be exported, got: {norm}")
+
+
+def _sqrt_size(g, sizes):
+    size = g.op("ReduceProd", sizes, keepdims_i=0)
+    return g.op("Sqrt", g.op("Cast", size, to_i=torch.onnx.TensorProtoDataType.FLOAT))
+
+
+def rfftn(g, x, s, dim, norm):
+    _check_norm(norm)
+    h, w = _fft_axes(x, dim)
+    sizes = g.op("Gather", g.op("Shape", x), _const(g, [h + 1, w + 1]), axis_i=0)
+    x = g.op("Unsqueeze", x, _const(g, [-1]))
+    x = g.op("DFT", x, axis_i=w, onesided_i=1)
+    x = g.op("DFT", x, axis_i=h)
+    return g.op("Div", x, _sqrt_size(g, sizes))
+
+
+def irfftn(g, x, s, dim, norm):
+    from torch.onnx import symbolic_helper
+
+    _check_norm(norm)
+    h, w = _fft_axes(x, dim)
+    shape = g.op("Shape", x)
+    height = g.op("Gather", shape, _const(g, [h]), axis_i=0)
+    half_width = g.op("Gather", shape, _const(g, [w]), axis_i=0)
+    width = symbolic_helper._unpack_list(s)[-1]
+    width = g.op("Unsqueeze", width, _const(g, [0]))
+
+    x = g.op("DFT", x, axis_i=h, inverse_i=1)
+    # rows of a real signal are hermitian, X[W - k] = conj(X[k]), rebuild the
+    # other half of each row before the inverse DFT along the width
+    missing = g.op("Sub", width, half_width)
+    mirror = g.op("Slice", x, missing, _const(g, [0]), _const(g, [w]), _const(g, [-1]))
+    mirror = g.op("Mul", mirror, _const(g, [1.0, -1.0]))
+    x = g.op("Concat", x, mirror, axis_i=w)
+    x = g.op("DFT", x, axis_i=w, inverse_i=1)
+    x = g.op("Gather", x, _const(g, 0), axis_i=-1)
+    # onnx inverse DFT is scaled by 1 / n, ortho by 1 / sqrt(n)
+    sizes = g.op("Concat", height, width, axis_i=0)
+    return g.op("Mul", x, _sqrt_size(g, sizes))
+
+
+def real(g, x):
+    return g.op("Gather", x, _const(g, 0), axis_i=-1)
+
+
+def imag(g, x):
+    return g.op("Gather", x, _const(g, 1), axis_i=-1)
+
+
+def make_complex(g, real, imag):
+    axes = _const(g, [-1])
+    return g.op(
+        "Concat",
+        g.op("Unsqueeze", real, axes),
+        g.op("Unsqueeze", imag, axes),
+        axis_i=-1,
+    )
+
+
+def register_fft_symbolics(opset_version: int):
+    if opset_version < DFT_OPSET:
+        raise ValueError(
+            f"Exporting FFT needs opset version {DFT_OPSET} or later, "
+            f"got {opset_version}"
+        )
+    for name, fn in [
+        ("fft_rfftn", rfftn),
+        ("fft_irfftn", irfftn),
+        ("real", real),
+        ("imag", imag),
+        ("complex", make_complex),
+    ]:
+        torch.onnx.register_custom_op_symbolic(f"aten::{name}", fn, opset_version)
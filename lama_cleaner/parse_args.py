@@ -6,6 +6,7 @@ from pathlib import Path
 from loguru import logger
 
 from lama_cleaner.const import *
+from lama_cleaner.encoding import DEFAULT_PNG_COMPRESS_LEVEL
 from lama_cleaner.runtime import dump_environment_info
 
 
@@ -32,6 +33,9 @@ def parse_args():
 
     parser.add_argument("--model", default=DEFAULT_MODEL, choices=AVAILABLE_MODELS)
     parser.add_argument("--no-half", action="store_true", help=NO_HALF_HELP)
+    parser.add_argument(
+        "--precision", default="auto", choices=AVAILABLE_PRECISIONS, help=PRECISION_HELP
+    )
     parser.add_argument("--cpu-offload", action="store_true", help=CPU_OFFLOAD_HELP)
     parser.add_argument("--disable-nsfw", action="store_true", help=DISABLE_NSFW_HELP)
     parser.add_argument(
@@ -80,6 +84,101 @@ def parse_args():
         type=int,
         help=QUALITY_HELP,
     )
+    parser.add_argument(
+        "--png-compress-level",
+        default=DEFAULT_PNG_COMPRESS_LEVEL,
+        type=int,
+        choices=range(10),
+        metavar="{0-9}",
+        help=PNG_COMPRESS_LEVEL_HELP,
+    )
+    parser.add_argument(
+        "--max-sessions",
+        default=0,
+        type=int,
+        help=MAX_SESSIONS_HELP,
+    )
+    parser.add_argument(
+        "--session-ttl",
+        default=3600,
+        type=int,
+        help="Seconds, image sessions not used for this long are dropped",
+    )
+    parser.add_argument(
+        "--result-cache-size",
+        default=0,
+        type=int,
+        help=RESULT_CACHE_SIZE_HELP,
+    )
+    parser.add_argument(
+        "--max-batch-size",
+        default=16,
+        type=int,
+        help=MAX_BATCH_SIZE_HELP,
+    )
+    parser.add_argument(
+        "--max-queue-size",
+        default=0,
+        type=int,
+        help=MAX_QUEUE_SIZE_HELP,
+    )
+    parser.add_argument(
+        "--model-cache-size",
+        default=0,
+        type=int,
+        help=MODEL_CACHE_SIZE_HELP,
+    )
+    parser.add_argument("--replicas", default=1, type=int, help=REPLICAS_HELP)
+    parser.add_argument(
+        "--replica-devices", default=None, nargs="+", help=REPLICA_DEVICES_HELP
+    )
+    parser.add_argument(
+        "--shape-buckets", default=None, type=int, nargs="+", help=SHAPE_BUCKETS_HELP
+    )
+    parser.add_argument("--oom-fallback", action="store_true", help=OOM_FALLBACK_HELP)
+    parser.add_argument(
+        "--backend", default="torch", choices=AVAILABLE_BACKENDS, help=BACKEND_HELP
+    )
+    parser.add_argument("--onnx-model", default=None, type=str, help=ONNX_MODEL_HELP)
+    parser.add_argument(
+        "--onnx-intra-op-threads",
+        default=0,
+        type=int,
+        help=ONNX_INTRA_OP_THREADS_HELP,
+    )
+    parser.add_argument(
+        "--onnx-inter-op-threads",
+        default=0,
+        type=int,
+        help=ONNX_INTER_OP_THREADS_HELP,
+    )
+    parser.add_argument(
+        "--memory-budget", default="0", type=str, help=MEMORY_BUDGET_HELP
+    )
+    parser.add_argument(
+        "--memory-policy",
+        default="queue",
+        choices=MEMORY_POLICIES,
+        help=MEMORY_POLICY_HELP,
+    )
+    parser.add_argument(
+        "--memory-profile", default=None, type=str, help=MEMORY_PROFILE_HELP
+    )
+    parser.add_argument("--trace-dir", default=None, type=str, help=TRACE_DIR_HELP)
+    parser.add_argument("--warmup", action="store_true", help=WARMUP_HELP)
+    parser.add_argument(
+        "--warmup-sizes",
+        default=["512x512"],
+        nargs="+",
+        help=WARMUP_SIZES_HELP,
+    )
+    parser.add_argument(
+        "--warmup-strategies",
+        default=["Original"],
+        nargs="+",
+        choices=["Original", "Resize", "Crop", "Tile", "Pyramid"],
+        help="HD strategies used by --warmup",
+    )
 
     # Plugins
     parser.add_argument(
@@ -210,6 +309,55 @@ def parse_args():
                     "torch.cuda.is_available() is False, please use --device cpu or check your pytorch installation"
                 )
 
+    if args.result_cache_size < 0:
+        parser.error(f"invalid --result-cache-size: {args.result_cache_size} < 0")
+
+    if args.max_batch_size < 1:
+        parser.error(f"invalid --max-batch-size: {args.max_batch_size} < 1")
+
+    if args.max_queue_size < 0:
+        parser.error(f"invalid --max-queue-size: {args.max_queue_size} < 0")
+
+    if args.model_cache_size < 0:
+        parser.error(f"invalid --model-cache-size: {args.model_cache_size} < 0")
+
+    if args.memory_budget != "auto":
+        try:
+            memory_budget = int(args.memory_budget)
+        except ValueError:
+            memory_budget = -1
+        if memory_budget < 0:
+            parser.error(
+                f"invalid --memory-budget: {args.memory_budget}, should be MB or auto"
+            )
+
+    if args.shape_buckets and min(args.shape_buckets) <= 0:
+        parser.error(f"invalid --shape-buckets: {args.shape_buckets}")
+
+    if args.no_half and args.precision in ["fp16", "bf16"]:
+        parser.error(f"--no-half conflicts with --precision {args.precision}")
+
+    if args.backend == "onnxruntime" and args.model != "lama":
+        parser.error("onnxruntime backend only supports lama model")
+    if args.onnx_intra_op_threads < 0 or args.onnx_inter_op_threads < 0:
+        parser.error("invalid --onnx-intra-op-threads/--onnx-inter-op-threads")
+
+    if args.replicas < 1:
+        parser.error(f"invalid --replicas: {args.replicas} < 1")
+    if args.replica_devices:
+        args.replicas = len(args.replica_devices)
+
+    warmup_sizes = []
+    for size in args.warmup_sizes:
+        try:
+            width, height = map(int, size.lower().split("x"))
+        except ValueError:
+            parser.error(f"invalid --warmup-sizes: {size}, should be WIDTHxHEIGHT")
+        if width <= 0 or height <= 0:
+            parser.error(f"invalid --warmup-sizes: {size}")
+        warmup_sizes.append((height, width))
+    args.warmup_sizes = warmup_sizes
+
     if args.sd_local_model_path and args.model == "sd1.5":
         if not os.path.exists(args.sd_local_model_path):
             parser.error(
@@ -253,4 +401,12 @@ def parse_args():
             if not output_dir.is_dir():
                 parser.error(f"invalid --output-dir: {output_dir} is not a directory")
 
+    if args.trace_dir is not None:
+        trace_dir = Path(args.trace_dir)
+        if not trace_dir.exists():
+            logger.info(f"Creating trace directory: {trace_dir}")
+            trace_dir.mkdir(parents=True)
+        elif not trace_dir.is_dir():
+            parser.error(f"invalid --trace-dir: {trace_dir} is not a directory")
+
     return args
@@ -0,0 +1,173 @@
+"""
+Post-processing of inpainting results: paste the result back into the image and
+match colors of the inpainted region to the rest of the image.
+
+Only the bounding box of the mask is processed, pixels outside it are copied from
+the source image.
+"""
+
+from typing import Optional
+
+import cv2
+import numpy as np
+import torch
+
+from lama_cleaner.helper import mask_bbox
+
+
+def histogram_lookup(source_hist: np.ndarray, reference_hist: np.ndarray) -> np.ndarray:
+    """
+    Map each value to the smallest reference value whose cdf is not less than its cdf
+
+    Args:
+        source_hist: (256,)
+        reference_hist: (256,)
+
+    Returns:
+        (256,) uint8 lookup table
+    """
+    source_cdf = np.cumsum(source_hist, dtype=np.float64)
+    source_cdf /= source_cdf[-1]
+    reference_cdf = np.cumsum(reference_hist, dtype=np.float64)
+    reference_cdf /= reference_cdf[-1]
+    lookup = np.searchsorted(reference_cdf, source_cdf, side="left")
+    return np.minimum(lookup, 255).astype(np.uint8)
+
+
+def _to_tensor(image: np.ndarray, device: torch.device) -> torch.Tensor:
+    # torch doesn't support negative strides, e.g: image[:, :, ::-1]
+    if image.ndim == 3 and image.strides[-1] < 0:
+        return torch.from_numpy(image[:, :, ::-1]).to(device).flip(-1)
+    return torch.from_numpy(image).to(device)
+
+
+def channel_histograms(
+    image: np.ndarray,
+    mask: Optional[np.ndarray] = None,
+    device: Optional[torch.device] = None,
+) -> np.ndarray:
+    """
+    Args:
+        image: (h, w, c) uint8
+        mask: (h, w) only count pixels where mask is nonzero
+        device: cuda device to compute on, cpu uses cv2.calcHist
+
+    Returns:
+        (c, 256) float64
+    """
+    if device is not None and device.type == "cuda":
+        pixels = _to_tensor(image, device)
+        if mask is not None:
+            pixels = pixels[_to_tensor(mask, device) != 0]
+        pixels = pixels.reshape(-1, image.shape[-1]).float()
+        return np.stack(
+            [
+                torch.histc(pixels[:, c], bins=256, min=0, max=255).cpu().numpy()
+                for c in range(image.shape[-1])
+            ]
+        ).astype(np.float64)
+
+    channels = list(range(image.shape[-1]))
+    if image.strides[-1] < 0:
+        # cv2 doesn't support negative strides, read the channels in reverse order
+        image = image[:, :, ::-1]
+        channels = channels[::-1]
+    if mask is not None:
+        mask = mask.astype(np.uint8, copy=False)
+    return np.stack(
+        [cv2.calcHist([image], [c], mask, [256], [0, 256]).ravel() for c in channels]
+    ).astype(np.float64)
+
+
+def match_histograms(
+    source: np.ndarray,
+    reference: np.ndarray,
+    mask: np.ndarray,
+    margin: int = 0,
+    device: Optional[torch.device] = None,
+) -> np.ndarray:
+    """
+    Match the histogram of each channel of source to reference, histograms are
+    computed on pixels outside the mask, the lookup is applied inside the bounding box
+    of the mask
+
+    Args:
+        source: (h, w, c) uint8
+        reference: (h, w, c) uint8
+        mask: (h, w) 0~255
+        margin: pixels to expand the box the lookup is applied to, e.g: mask blur
+        device: cuda device to compute histograms on
+
+    Returns:
+        (h, w, c) uint8, a copy of source
+    """
+    box = mask_bbox(mask)
+    if box is None:
+        return source
+    x1, y1, x2, y2 = box
+    box_mask = mask[y1:y2, x1:x2]
+
+    # histograms of the whole image minus the masked pixels, all inside the box
+    source_hist = channel_histograms(source, device=device) - channel_histograms(
+        source[y1:y2, x1:x2], box_mask, device=device
+    )
+    reference_hist = channel_histograms(reference, device=device) - channel_histograms(
+        reference[y1:y2, x1:x2], box_mask, device=device
+    )
+    if source_hist[0].sum() == 0 or reference_hist[0].sum() == 0:
+        # the whole image is masked, nothing to match
+        return source
+
+    lookup = np.stack(
+        [histogram_lookup(s, r) for s, r in zip(source_hist, reference_hist)],
+        axis=-1,
+    )
+    x1, y1, x2, y2 = mask_bbox(mask, margin)
+    result = source.copy()
+    result[y1:y2, x1:x2] = cv2.LUT(
+        np.ascontiguousarray(source[y1:y2, x1:x2]), lookup[np.newaxis]
+    )
+    return result
+
+
+def blend_masked(
+    result: np.ndarray, image: np.ndarray, mask: np.ndarray, blur: int = 0
+) -> np.ndarray:
+    """
+    Paste result into image where mask is set, only the (blur expanded) bounding box
+    of the mask is blurred and blended, pixels outside it are copied from image.
+
+    Args:
+        result: (h, w, 3) BGR
+        image: (h, w, 3) RGB
+        mask: (h, w) 0~255
+        blur: radius of the gaussian blur applied to the mask, 0 to disable
+
+    Returns:
+        (h, w, 3) BGR uint8
+    """
+    output = cv2.cvtColor(image.astype(np.uint8, copy=False), cv2.COLOR_RGB2BGR)
+    # a gaussian kernel of radius blur spreads the mask by blur pixels
+    box = mask_bbox(mask, blur)
+    if box is None:
+        return output
+    x1, y1, x2, y2 = box
+
+    if blur:
+        # blur with enough context that the box matches blurring the whole mask
+        bx1, by1, bx2, by2 = mask_bbox(mask, 2 * blur)
+        k = 2 * blur + 1
+        blurred = cv2.GaussianBlur(mask[by1:by2, bx1:bx2], (k, k), 0)
+        box_mask = blurred[y1 - by1 : y2 - by1, x1 - bx1 : x2 - bx1]
+    else:
+        box_mask = mask[y1:y2, x1:x2]
+
+    alpha = box_mask.astype(np.float32)[:, :, np.newaxis]
+    alpha /= 255
+    src = output[y1:y2, x1:x2]
+    blended = result[y1:y2, x1:x2].astype(np.float32)
+    blended -= src
+    blended *= alpha
+    blended += src
+    output[y1:y2, x1:x2] = blended
+    return output
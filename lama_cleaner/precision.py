@@ -0,0 +1,231 @@
+"""
+Numeric precision models run with, set by --precision:
+
+- fp32: full precision
+- fp16: half precision, cuda only
+- bf16: bfloat16, cuda devices supporting it and cpus with native bf16 instructions
+  (avx512_bf16 or amx)
+- auto: fp16 on cuda for models that have always run in half precision there,
+  bf16 on cpus with native bf16 for models opting in with cpu_auto_bf16 after a
+  parity run against fp32, fp32 otherwise
+
+Models whose weights can be cast (diffusion models, MAT, LDM) load them in the
+chosen dtype, the others run their forward under torch.autocast. Precision a
+model or device doesn't support falls back to fp32. Check the result and speed
+of a precision against fp32 with:
+
+    python -m lama_cleaner.precision --model lama --device cpu --precision bf16
+"""
+
+import argparse
+import contextlib
+import functools
+import time
+from typing import Dict, Iterable, Sequence
+
+import numpy as np
+import torch
+from loguru import logger
+
+from lama_cleaner.const import AVAILABLE_PRECISIONS
+
+PRECISION_DTYPES = {
+    "fp32": torch.float32,
+    "fp16": torch.float16,
+    "bf16": torch.bfloat16,
+}
+
+
+@functools.lru_cache()
+def cpu_supports_bf16() -> bool:
+    """The cpu has native bf16 instructions, emulated bf16 is slower than fp32"""
+    try:
+        with open("/proc/cpuinfo") as f:
+            flags = set(f.read().split())
+    except OSError:
+        return False
+    return bool(flags & {"avx512_bf16", "amx_bf16"})
+
+
+def device_supports(precision: str, device: torch.device) -> bool:
+    if precision == "fp32":
+        return True
+    if device.type == "cuda":
+        if precision == "bf16":
+            return torch.cuda.is_bf16_supported()
+        return True
+    if device.type == "cpu":
+        return precision == "bf16" and cpu_supports_bf16()
+    return False
+
+
+def resolve_precision(
+    precision: str,
+    device: torch.device,
+    supported: Dict[str, Sequence[str]],
+    cuda_half: bool = False,
+    cpu_auto_bf16: bool = False,
+    no_half: bool = False,
+) -> str:
+    """
+    Args:
+        precision: one of AVAILABLE_PRECISIONS
+        device:
+        supported: device type -> precisions other than fp32 the model supports
+        cuda_half: the model runs in fp16 on cuda with auto precision
+        cpu_auto_bf16: the model runs in bf16 on cpus with native bf16 with auto
+            precision, only set after checking the results with check_parity
+        no_half: --no-half, auto precision uses fp32
+
+    Returns:
+        fp32, fp16 or bf16
+    """
+    if precision not in AVAILABLE_PRECISIONS:
+        raise ValueError(
+            f"Unknown precision: {precision}, choices: {AVAILABLE_PRECISIONS}"
+        )
+    model_supported = supported.get(device.type, ())
+    if precision == "auto":
+        if no_half:
+            return "fp32"
+        if device.type == "cuda" and cuda_half and "fp16" in model_supported:
+            return "fp16"
+        if (
+            device.type == "cpu"
+            and cpu_auto_bf16
+            and "bf16" in model_supported
+            and device_supports("bf16", device)
+        ):
+            return "bf16"
+        return "fp32"
+
+    if precision == "fp32":
+        return precision
+    if precision not in model_supported or not device_supports(precision, device):
+        logger.warning(
+            f"{precision} is not supported by the model on {device}, use fp32"
+        )
+        return "fp32"
+    return precision
+
+
+def autocast(device: torch.device, precision: str):
+    if precision == "fp32":
+        return contextlib.nullcontext()
+    return torch.autocast(device_type=device.type, dtype=PRECISION_DTYPES[precision])
+
+
+def _fp32_forward(module: torch.nn.Module):
+    forward = module.forward
+
+    @functools.wraps(forward)
+    def _forward(*args, **kwargs):
+        def _cast(x):
+            if isinstance(x, torch.Tensor) and x.is_floating_point():
+                return x.float()
+            return x
+
+        with torch.autocast(device_type=_device_type(module), enabled=False):
+            return forward(
+                *[_cast(it) for it in args],
+                **{k: _cast(v) for k, v in kwargs.items()},
+            )
+
+    module.forward = _forward
+
+
+def _device_type(module: torch.nn.Module) -> str:
+    for it in module.parameters():
+        return it.device.type
+    for it in module.buffers():
+        return it.device.type
+    return "cpu"
+
+
+def keep_fp32(module: torch.nn.Module, class_names: Iterable[str]) -> int:
+    """
+    Run submodules of these classes in fp32 when the model runs under autocast,
+    e.g: FFT doesn't support bf16 and needs power of 2 sizes in fp16 on cuda.
+    TorchScript modules can't be patched and are skipped.
+
+    Returns:
+        number of submodules kept in fp32
+    """
+    class_names = set(class_names)
+    count = 0
+    for it in module.modules():
+        if isinstance(it, torch.jit.ScriptModule):
+            continue
+        if type(it).__name__ in class_names:
+            _fp32_forward(it)
+            count += 1
+    return count
+
+
+def check_parity(reference, model, image, mask, config, runs: int = 3) -> dict:
+    """
+    Run the same request with two models, e.g: fp32 and bf16
+
+    Returns:
+        mean/max absolute difference of the results and median latency of each
+    """
+
+    def _run(m):
+        times = []
+        for _ in range(runs):
+            start = time.time()
+            result = m(image, mask, config)
+            times.append(time.time() - start)
+        return result, float(np.median(times))
+
+    expected, reference_time = _run(reference)
+    result, model_time = _run(model)
+    diff = np.abs(result.astype(np.float32) - expected.astype(np.float32))
+    return {
+        "mean_diff": float(diff.mean()),
+        "max_diff": float(diff.max()),
+        "reference_time": reference_time,
+        "time": model_time,
+    }
+
+
+if __name__ == "__main__":
+    from lama_cleaner.const import AVAILABLE_MODELS
+    from lama_cleaner.model_manager import ModelManager
+    from lama_cleaner.schema import Config, HDStrategy, SDSampler
+
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--model", default="lama", choices=AVAILABLE_MODELS)
+    parser.add_argument("--device", default="cpu", type=str)
+    parser.add_argument("--precision", default="bf16", choices=AVAILABLE_PRECISIONS)
+    parser.add_argument("--sizes", default=["512x512", "1024x1024"], nargs="+")
+    parser.add_argument("--runs", default=3, type=int)
+    args = parser.parse_args()
+
+    device = torch.device(args.device)
+    reference = ModelManager(args.model, device, precision="fp32")
+    model = ModelManager(args.model, device, precision=args.precision)
+    print(f"{args.model} on {device}: fp32 vs {model.model.precision}")
+    config = Config(
+        ldm_steps=2,
+        hd_strategy=HDStrategy.ORIGINAL,
+        hd_strategy_crop_margin=128,
+        hd_strategy_crop_trigger_size=128,
+        hd_strategy_resize_limit=128,
+        prompt="a fox is sitting on a bench",
+        sd_steps=5,
+        sd_sampler=SDSampler.ddim,
+    )
+    rng = np.random.default_rng(0)
+    for size in args.sizes:
+        width, height = map(int, size.split("x"))
+        image = rng.integers(0, 256, (height, width, 3), dtype=np.uint8)
+        mask = np.zeros((height, width), dtype=np.uint8)
+        mask[height // 4 : height * 3 // 4, width // 4 : width * 3 // 4] = 255
+        stats = check_parity(reference, model, image, mask, config, args.runs)
+        print(
+            f"{size}: mean diff {stats['mean_diff']:.2f}, "
+            f"max diff {stats['max_diff']:.0f}, "
+            f"fp32 {stats['reference_time']:.3f}s, "
+            f"{model.model.precision} {stats['time']:.3f}s"
+        )
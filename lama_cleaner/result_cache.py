@@ -0,0 +1,165 @@
+import collections
+import hashlib
+import json
+import threading
+from typing import NamedTuple, Optional
+
+import numpy as np
+
+from lama_cleaner.const import DIFFUSION_MODELS
+from lama_cleaner.schema import Config
+
+# Config fields only used by diffusion models(sd/paint_by_example/instruct_pix2pix),
+# they don't change the result of other models
+DIFFUSION_CONFIG_PREFIXES = (
+    "sd_",
+    "paint_by_example_",
+    "p2p_",
+    "controlnet_",
+    "croper_",
+)
+DIFFUSION_CONFIG_FIELDS = {"prompt", "negative_prompt", "use_croper"}
+
+
+class CachedResult(NamedTuple):
+    data: bytes
+    mimetype: str
+    # decoded result(RGB) for the session, the encoded bytes may be rotated by
+    # EXIF orientation or lossy
+    image: Optional[np.ndarray] = None
+    # config the result was produced with, differs from the request after a
+    # downgrade or out of memory fallback
+    config: Optional[Config] = None
+
+    @property
+    def nbytes(self) -> int:
+        return len(self.data) + (self.image.nbytes if self.image is not None else 0)
+
+
+def _update_array(h, arr: Optional[np.ndarray]):
+    if arr is None:
+        h.update(b"none")
+        return
+    h.update(f"{arr.shape}{arr.dtype}".encode())
+    h.update(np.ascontiguousarray(arr).data)
+
+
+def config_cache_fields(config: Config, model_name: str) -> dict:
+    fields = config.dict(exclude={"paint_by_example_example_image"})
+    if model_name not in DIFFUSION_MODELS:
+        fields = {
+            k: v
+            for k, v in fields.items()
+            if not k.startswith(DIFFUSION_CONFIG_PREFIXES)
+            and k not in DIFFUSION_CONFIG_FIELDS
+        }
+    return fields
+
+
+def make_cache_key(
+    image: np.ndarray, mask: np.ndarray, model_name: str, config: Config, **extra
+) -> str:
+    """
+    Args:
+        image: decoded image
+        mask: decoded mask
+        model_name:
+        config: seeds must be resolved before making key
+        **extra: anything else affects the encoded result, e.g: ext, quality, exif
+
+    Returns:
+        hex digest
+    """
+    h = hashlib.blake2b(digest_size=20)
+    _update_array(h, image)
+    _update_array(h, mask)
+    h.update(model_name.encode())
+    h.update(
+        json.dumps(config_cache_fields(config, model_name), sort_keys=True).encode()
+    )
+    if (
+        model_name in DIFFUSION_MODELS
+        and config.paint_by_example_example_image is not None
+    ):
+        _update_array(h, np.asarray(config.paint_by_example_example_image))
+    for k in sorted(extra):
+        v = extra[k]
+        h.update(k.encode())
+        if isinstance(v, np.ndarray) or v is None:
+            _update_array(h, v)
+        elif isinstance(v, bytes):
+            h.update(v)
+        else:
+            h.update(str(v).encode())
+    return h.hexdigest()
+
+
+class ResultCache:
+    """
+    In-memory LRU cache of encoded inpainting results, bounded by the total size
+    of cached bytes and decoded images
+    """
+
+    def __init__(self, max_bytes: int):
+        self.max_bytes = max_bytes
+        self._entries: "collections.OrderedDict[str, CachedResult]" = (
+            collections.OrderedDict()
+        )
+        self._lock = threading.Lock()
+        self.total_bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key: str) -> Optional[CachedResult]:
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry
+
+    def put(
+        self,
+        key: str,
+        data: bytes,
+        mimetype: str,
+        image: Optional[np.ndarray] = None,
+        config: Optional[Config] = None,
+    ):
+        entry = CachedResult(data, mimetype, image, config)
+        if entry.nbytes > self.max_bytes:
+            return
+        with self._lock:
+            old = self._entries.pop(key, None)
+            if old is not None:
+                self.total_bytes -= old.nbytes
+            self._entries[key] = entry
+            self.total_bytes += entry.nbytes
+            while self.total_bytes > self.max_bytes:
+                _, evicted = self._entries.popitem(last=False)
+                self.total_bytes -= evicted.nbytes
+                self.evictions += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+            self.total_bytes = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self) -> dict:
+        with self._lock:
+            total = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hitRate": self.hits / total if total else 0,
+                "evictions": self.evictions,
+                "entries": len(self._entries),
+                "bytes": self.total_bytes,
+                "maxBytes": self.max_bytes,
+            }
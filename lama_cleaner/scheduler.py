@@ -0,0 +1,261 @@
+import collections
+import contextvars
+import queue
+import threading
+import time
+import uuid
+from typing import Callable, Dict, Optional
+
+from loguru import logger
+
+
+class QueueFullError(Exception):
+    def __init__(self, depth: int, retry_after: float):
+        super().__init__(f"Inference queue is full ({depth} jobs waiting)")
+        self.depth = depth
+        self.retry_after = retry_after
+
+
+class JobCancelledError(Exception):
+    def __init__(self, job_id: str):
+        super().__init__(f"Job {job_id} cancelled")
+        self.job_id = job_id
+
+
+_current_job: contextvars.ContextVar = contextvars.ContextVar(
+    "lama_cleaner_job", default=None
+)
+
+
+def check_cancelled():
+    """
+    Raise JobCancelledError if the job running in the current context is cancelled.
+    Called by long running model code between steps, e.g: sampler steps, crop boxes
+    """
+    job = _current_job.get()
+    if job is not None and job.cancelled:
+        raise JobCancelledError(job.id)
+
+
+def set_job_info(key: str, value):
+    """Attach information to the job running in the current context, see Job.info"""
+    job = _current_job.get()
+    if job is not None:
+        job.info[key] = value
+
+
+class Job:
+    def __init__(self, fn: Callable, args, kwargs, job_id: Optional[str] = None):
+        self.id = job_id or uuid.uuid4().hex
+        self.fn = fn
+        self.args = args
+        self.kwargs = kwargs
+        # run in the context of the submitting thread, e.g: tracing of the request
+        self.context = contextvars.copy_context()
+        self.enqueue_time = time.time()
+        self.start_time: Optional[float] = None
+        self.finish_time: Optional[float] = None
+        self._done = threading.Event()
+        self._cancelled = threading.Event()
+        self._result = None
+        self._error: Optional[Exception] = None
+        # set by the job with set_job_info, e.g: the config finally used
+        self.info = {}
+
+    @property
+    def done(self) -> bool:
+        return self._done.is_set()
+
+    @property
+    def cancelled(self) -> bool:
+        return self._cancelled.is_set()
+
+    def cancel(self):
+        """
+        A job waiting in the queue is skipped, a running job stops at the next
+        check_cancelled()
+        """
+        self._cancelled.set()
+
+    @property
+    def wait_time(self) -> float:
+        """Seconds spent in the queue before a worker picked the job up"""
+        end = self.start_time if self.start_time is not None else time.time()
+        return end - self.enqueue_time
+
+    @property
+    def run_time(self) -> float:
+        """Seconds spent running on the worker"""
+        if self.start_time is None:
+            return 0.0
+        end = self.finish_time if self.finish_time is not None else time.time()
+        return end - self.start_time
+
+    def result(self, timeout: Optional[float] = None):
+        """Block until the job finished, re-raise the worker exception if any"""
+        if not self._done.wait(timeout):
+            raise TimeoutError(f"Job {self.id} not finished after {timeout}s")
+        if self._error is not None:
+            raise self._error
+        return self._result
+
+    def _run(self):
+        self.start_time = time.time()
+        try:
+            if self.cancelled:
+                raise JobCancelledError(self.id)
+            self._result = self.context.run(self._run_in_context)
+        except Exception as e:
+            self._error = e
+        finally:
+            self.finish_time = time.time()
+            self._done.set()
+
+    def _run_in_context(self):
+        _current_job.set(self)
+        return self.fn(*self.args, **self.kwargs)
+
+
+class InferenceScheduler:
+    """
+    Bounded FIFO queue in front of the models. Only the worker threads touch the
+    models, HTTP threads submit jobs and wait for the result, so concurrent
+    requests never race on the same ModelManager.
+    """
+
+    def __init__(
+        self,
+        max_queue_size: int = 8,
+        num_workers: int = 1,
+        worker_init: Optional[Callable[[int], None]] = None,
+    ):
+        """
+
+        Args:
+            max_queue_size: max number of jobs waiting to run, 0 means unbounded
+            num_workers: number of inference worker threads
+            worker_init: called with the worker index in each worker thread before it
+                takes any job, e.g: DevicePool.bind_worker
+        """
+        self.max_queue_size = max_queue_size
+        self.num_workers = num_workers
+        self.worker_init = worker_init
+        self._queue = queue.Queue(maxsize=max_queue_size)
+        self._lock = threading.Lock()
+        self._running = 0
+        # job id -> jobs waiting or running
+        self._jobs: Dict[str, Job] = {}
+        self._wait_times = collections.deque(maxlen=100)
+        self._run_times = collections.deque(maxlen=100)
+        self._workers = []
+        for i in range(num_workers):
+            worker = threading.Thread(
+                target=self._worker_loop,
+                args=(i,),
+                name=f"inference-worker-{i}",
+                daemon=True,
+            )
+            worker.start()
+            self._workers.append(worker)
+
+    @property
+    def depth(self) -> int:
+        """Number of jobs waiting in the queue, running jobs excluded"""
+        return self._queue.qsize()
+
+    @property
+    def running(self) -> int:
+        return self._running
+
+    def submit(
+        self, fn: Callable, *args, job_id: Optional[str] = None, **kwargs
+    ) -> Job:
+        job = Job(fn, args, kwargs, job_id=job_id)
+        with self._lock:
+            if job.id in self._jobs:
+                raise ValueError(f"Job {job.id} already exists")
+            self._jobs[job.id] = job
+        try:
+            self._queue.put_nowait(job)
+        except queue.Full:
+            with self._lock:
+                self._jobs.pop(job.id)
+            raise QueueFullError(self.depth, self.estimate_wait_time())
+        return job
+
+    def cancel(self, job_id: str) -> bool:
+        """
+        Returns:
+            False if the job is not found or already finished
+        """
+        with self._lock:
+            job = self._jobs.get(job_id)
+        if job is None:
+            return False
+        job.cancel()
+        logger.info(f"Job {job_id} cancelled")
+        return True
+
+    def run(self, fn: Callable, *args, **kwargs):
+        """Submit a job and block until it's done"""
+        return self.submit(fn, *args, **kwargs).result()
+
+    def estimate_wait_time(self) -> float:
+        """Rough time(seconds) a newly submitted job will wait before running"""
+        with self._lock:
+            avg_run_time = (
+                sum(self._run_times) / len(self._run_times) if self._run_times else 0
+            )
+        pending = self.depth + self._running
+        return avg_run_time * pending / max(self.num_workers, 1)
+
+    def stats(self) -> dict:
+        with self._lock:
+            wait_times = list(self._wait_times)
+            run_times = list(self._run_times)
+
+        def _avg_ms(values):
+            return sum(values) / len(values) * 1000 if values else 0
+
+        return {
+            "depth": self.depth,
+            "running": self._running,
+            "maxQueueSize": self.max_queue_size,
+            "numWorkers": self.num_workers,
+            "avgWaitTime": _avg_ms(wait_times),
+            "maxWaitTime": max(wait_times) * 1000 if wait_times else 0,
+            "avgRunTime": _avg_ms(run_times),
+            "estimatedWaitTime": self.estimate_wait_time() * 1000,
+        }
+
+    def shutdown(self):
+        for _ in self._workers:
+            self._queue.put(None)
+        for worker in self._workers:
+            worker.join()
+
+    def _worker_loop(self, index: int):
+        if self.worker_init is not None:
+            self.worker_init(index)
+        while True:
+            job = self._queue.get()
+            if job is None:
+                break
+
+            with self._lock:
+                self._running += 1
+            try:
+                job._run()
+            finally:
+                with self._lock:
+                    self._running -= 1
+                    self._jobs.pop(job.id, None)
+                    self._wait_times.append(job.wait_time)
+                    if not isinstance(job._error, JobCancelledError):
+                        self._run_times.append(job.run_time)
+                self._queue.task_done()
+
+            if isinstance(job._error, JobCancelledError):
+                logger.info(f"Job {job.id} stopped after {job.run_time:.2f}s")
+            elif job._error is not None:
+                logger.debug(f"Job {job.id} failed: {job._error}")
@@ -13,6 +13,13 @@ class HDStrategy(str, Enum):
     RESIZE = "Resize"
     # Crop masking area(with a margin controlled by hd_strategy_crop_margin) from the original image to do inpainting
     CROP = "Crop"
+    # Split the image into overlapping tiles(hd_strategy_tile_size), inpaint tiles containing
+    # mask and blend them with feathered weights. Memory doesn't grow with image size.
+    TILE = "Tile"
+    # Inpaint the image resized to hd_strategy_resize_limit for global structure, then refine a
+    # band(hd_strategy_pyramid_band) along the mask border in full resolution tiles, with the
+    # upsampled low resolution result as context.
+    PYRAMID = "Pyramid"
 
 
 class LDMSampler(str, Enum):
@@ -30,6 +37,10 @@ class SDSampler(str, Enum):
     uni_pc = "uni_pc"
 
 
+# smaller tiles run a forward for every few pixels
+MIN_TILE_SIZE = 64
+
+
 class Config(BaseModel):
     class Config:
         arbitrary_types_allowed = True
@@ -47,6 +58,15 @@ class Config(BaseModel):
     # If the longer side of the image is larger than this value, use crop strategy
     hd_strategy_crop_trigger_size: int
     hd_strategy_resize_limit: int
+    # Number of crops of the same size in one forward
+    hd_strategy_crop_batch_size: int = 4
+    hd_strategy_tile_size: int = 1024
+    # Overlap of neighbouring tiles, seams are blended in the overlap
+    hd_strategy_tile_overlap: int = 128
+    # Number of tiles in one forward
+    hd_strategy_tile_batch_size: int = 1
+    # Width of the mask border refined in full resolution by pyramid strategy
+    hd_strategy_pyramid_band: int = 128
 
     # Configs for Stable Diffusion 1.5
     prompt: str = ""
@@ -98,3 +118,29 @@ class Config(BaseModel):
     # ControlNet
     controlnet_conditioning_scale: float = 0.4
     controlnet_method: str = "control_v11p_sd15_canny"
+
+    def check_hd_strategy(self):
+        """
+        Raises:
+            ValueError: hd strategy settings running too many or no forwards
+        """
+        if self.hd_strategy_tile_size < MIN_TILE_SIZE:
+            raise ValueError(
+                f"hd_strategy_tile_size must be at least {MIN_TILE_SIZE}, "
+                f"got {self.hd_strategy_tile_size}"
+            )
+        if not 0 <= self.hd_strategy_tile_overlap < self.hd_strategy_tile_size:
+            raise ValueError(
+                f"hd_strategy_tile_overlap must be in [0, hd_strategy_tile_size), "
+                f"got {self.hd_strategy_tile_overlap}"
+            )
+        for name in ["hd_strategy_crop_batch_size", "hd_strategy_tile_batch_size"]:
+            if getattr(self, name) < 1:
+                raise ValueError(
+                    f"{name} must be at least 1, got {getattr(self, name)}"
+                )
+        if self.hd_strategy_pyramid_band < 0:
+            raise ValueError(
+                f"hd_strategy_pyramid_band must not be negative, "
+                f"got {self.hd_strategy_pyramid_band}"
+            )
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 import os
+import functools
 import hashlib
 
 os.environ["PYTORCH_ENABLE_MPS_FALLBACK"] = "1"
@@ -9,7 +10,10 @@ import io
 import logging
 import multiprocessing
 import random
-import time
+import select
+import socket
+import threading
+import zipfile
 from pathlib import Path
 
 import cv2
@@ -18,10 +22,17 @@ import torch
 from PIL import Image
 from loguru import logger
 
+from lama_cleaner import metrics, tracing
 from lama_cleaner.const import SD15_MODELS
+from lama_cleaner.device_pool import DevicePool, replica_specs
 from lama_cleaner.file_manager import FileManager
+from lama_cleaner.memory_estimator import (
+    AdmissionController,
+    MemoryAdmissionError,
+    MB,
+    available_memory,
+)
 from lama_cleaner.model.utils import torch_gc
-from lama_cleaner.model_manager import ModelManager
 from lama_cleaner.plugins import (
     InteractiveSeg,
     RemoveBG,
@@ -31,7 +42,17 @@ from lama_cleaner.plugins import (
     RestoreFormerPlugin,
     AnimeSeg,
 )
-from lama_cleaner.schema import Config
+from lama_cleaner.result_cache import ResultCache, make_cache_key
+from lama_cleaner.scheduler import (
+    InferenceScheduler,
+    Job,
+    JobCancelledError,
+    QueueFullError,
+    check_cancelled,
+)
+from lama_cleaner.schema import Config, HDStrategy
+from lama_cleaner.session import SessionStore
+from lama_cleaner.warmup import warmup
 
 try:
     torch._C._jit_override_can_fuse_on_cpu(False)
@@ -57,12 +78,20 @@ from flask_socketio import SocketIO
 cli.show_server_banner = lambda *_: None
 from flask_cors import CORS
 
+from lama_cleaner.encoding import (
+    DEFAULT_PNG_COMPRESS_LEVEL,
+    LOSSLESS_EXTS,
+    ext_to_mimetype,
+    negotiate_ext,
+)
 from lama_cleaner.helper import (
+    concat_alpha_channel,
     load_img,
     numpy_to_bytes,
     resize_max_size,
     pil_to_bytes,
 )
+from lama_cleaner.mask_codec import decode_mask
 
 NUM_THREADS = str(multiprocessing.cpu_count())
 
@@ -103,7 +132,10 @@ sio_logger = logging.getLogger("sio-logger")
 sio_logger.setLevel(logging.ERROR)
 socketio = SocketIO(app, cors_allowed_origins="*", async_mode="threading")
 
-model: ModelManager = None
+model: DevicePool = None
+scheduler: InferenceScheduler = None
+result_cache: ResultCache = None
+session_store: SessionStore = None
 thumb: FileManager = None
 output_dir: str = None
 device = None
@@ -115,7 +147,20 @@ is_enable_file_manager: bool = False
 is_enable_auto_saving: bool = False
 is_desktop: bool = False
 image_quality: int = 95
+png_compress_level: int = DEFAULT_PNG_COMPRESS_LEVEL
+max_batch_size: int = 16
 plugins = {}
+# cleared until warmup finished
+ready = threading.Event()
+ready.set()
+# plugins are not replicated, only one plugin job runs at a time
+plugin_lock = threading.Lock()
+# seconds between checks of client disconnection while waiting for a job
+CLIENT_CHECK_INTERVAL = 0.5
+# every request is traced and saved to trace_dir if it's set, otherwise only requests
+# with X-Trace header are traced
+trace_dir: str = None
+trace_store = tracing.TraceStore()
 
 
 def get_image_ext(img_bytes):
@@ -126,9 +171,118 @@ def get_image_ext(img_bytes):
 
 
 def diffuser_callback(i, t, latents):
+    check_cancelled()
     socketio.emit("diffusion_progress", {"step": i})
 
 
+def client_disconnected() -> bool:
+    """Check whether the client closed the connection of the current request"""
+    sock = request.environ.get("werkzeug.socket")
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        # closed connection is readable with no data, request body is already read
+        return bool(readable) and sock.recv(1, socket.MSG_PEEK) == b""
+    except ValueError:
+        # e.g: MSG_PEEK is not supported by ssl socket
+        return False
+    except OSError:
+        return True
+
+
+def wait_job(job: Job):
+    """Wait for the result of job, cancel it if the client disconnected"""
+    while True:
+        try:
+            return job.result(timeout=CLIENT_CHECK_INTERVAL)
+        except TimeoutError:
+            if not job.cancelled and client_disconnected():
+                logger.info(f"Client of job {job.id} disconnected")
+                job.cancel()
+
+
+def queue_full_response(e: QueueFullError):
+    metrics.queue_full_errors.inc()
+    response = make_response(str(e), 429)
+    response.headers["Retry-After"] = str(max(int(e.retry_after + 0.5), 1))
+    return response
+
+
+def memory_admission_response(e: MemoryAdmissionError):
+    reason = "busy" if e.retryable else "too_large"
+    metrics.memory_rejections.inc(model=model.name, reason=reason)
+    if e.retryable:
+        response = make_response(str(e), 503)
+        response.headers["Retry-After"] = "1"
+        return response
+    return str(e), 413
+
+
+def downgrade_headers(response, config: Config, used: Config):
+    """
+    Tell the client the request ran with cheaper settings than it asked for, chosen
+    by memory admission control or the out of memory fallback
+    """
+    if used.hd_strategy != config.hd_strategy:
+        response.headers["X-HD-Strategy"] = HDStrategy(used.hd_strategy).value
+    if used.sd_scale != config.sd_scale:
+        response.headers["X-SD-Scale"] = str(used.sd_scale)
+    return response
+
+
+def run_memory_calibration():
+    try:
+        model.calibrate_memory()
+    except Exception as e:
+        logger.exception(f"Memory calibration failed, requests are not estimated: {e}")
+
+
+def run_warmup(sizes, hd_strategies):
+    try:
+        seconds = sum(inference(model.run_on_all, warmup, sizes, hd_strategies))
+        logger.info(f"Warmup finished in {seconds:.2f}s")
+    except Exception as e:
+        logger.exception(f"Warmup failed: {e}")
+    finally:
+        ready.set()
+
+
+def run_plugin_job(name: str, *args):
+    with plugin_lock:
+        return plugins[name](*args)
+
+
+def traced_request(fn):
+    """Record the request as a tracing.Trace, trace id is returned in X-Trace-Id"""
+
+    @functools.wraps(fn)
+    def wrapper(*args, **kwargs):
+        if trace_dir is None and not request.headers.get("X-Trace"):
+            return fn(*args, **kwargs)
+
+        trace = tracing.Trace(request.path)
+        with tracing.activate(trace):
+            with tracing.span(request.path):
+                response = make_response(fn(*args, **kwargs))
+        trace_store.put(trace)
+        if trace_dir is not None:
+            trace.dump(trace_dir)
+        response.headers["X-Trace-Id"] = trace.id
+        return response
+
+    return wrapper
+
+
+def inference(fn, *args, stage_times: metrics.StageTimes = None):
+    # Runs on the inference worker thread, release cached memory after each job
+    try:
+        with metrics.collect(stage_times):
+            return fn(*args)
+    finally:
+        torch_gc()
+
+
 @app.route("/save_image", methods=["POST"])
 def save_image():
     if output_dir is None:
@@ -141,21 +295,10 @@ def save_image():
     image, alpha_channel, exif_infos = load_img(origin_image_bytes, return_exif=True)
     save_path = os.path.join(output_dir, filename)
 
-    if alpha_channel is not None:
-        if alpha_channel.shape[:2] != image.shape[:2]:
-            alpha_channel = cv2.resize(
-                alpha_channel, dsize=(image.shape[1], image.shape[0])
-            )
-        image = np.concatenate((image, alpha_channel[:, :, np.newaxis]), axis=-1)
-
+    image = concat_alpha_channel(image, alpha_channel)
     pil_image = Image.fromarray(image)
 
-    img_bytes = pil_to_bytes(
-        pil_image,
-        ext,
-        quality=image_quality,
-        exif_infos=exif_infos,
-    )
+    img_bytes = image_to_bytes(pil_image, ext, exif_infos)
     with open(save_path, "wb") as fw:
         fw.write(img_bytes)
 
@@ -208,31 +351,45 @@ def media_thumbnail_file(tab, filename):
     return response
 
 
-@app.route("/inpaint", methods=["POST"])
-def process():
-    input = request.files
-    # RGB
-    origin_image_bytes = input["image"].read()
-    image, alpha_channel, exif_infos = load_img(origin_image_bytes, return_exif=True)
+def image_to_bytes(pil_img, ext: str, exif_infos, lossless: bool = False) -> bytes:
+    return pil_to_bytes(
+        pil_img,
+        ext,
+        quality=image_quality,
+        exif_infos=exif_infos,
+        png_compress_level=png_compress_level,
+        lossless=lossless,
+    )
 
-    mask, _ = load_img(input["mask"].read(), gray=True)
-    mask = cv2.threshold(mask, 127, 255, cv2.THRESH_BINARY)[1]
 
-    if image.shape[:2] != mask.shape[:2]:
-        return (
-            f"Mask shape{mask.shape[:2]} not queal to Image shape{image.shape[:2]}",
-            400,
-        )
+def response_ext(origin_ext: str, has_alpha: bool) -> str:
+    """Output format negotiated with Accept header, default to the input format"""
+    return negotiate_ext(request.headers.get("Accept"), origin_ext, has_alpha)
 
-    original_shape = image.shape
-    interpolation = cv2.INTER_CUBIC
 
-    form = request.form
-    size_limit = max(image.shape)
+def result_to_bytes(
+    bgr_np_img, alpha_channel, ext: str, exif_infos, lossless: bool = False
+) -> bytes:
+    res_np_img = cv2.cvtColor(bgr_np_img.astype(np.uint8), cv2.COLOR_BGR2RGB)
+    res_np_img = concat_alpha_channel(res_np_img, alpha_channel)
+    return image_to_bytes(Image.fromarray(res_np_img), ext, exif_infos, lossless)
+
+
+def inpaint_response(
+    img_bytes: bytes, mimetype: str, config: Config, cache_status: str = None
+):
+    response = make_response(send_file(io.BytesIO(img_bytes), mimetype=mimetype))
+    response.vary.add("Accept")
+    response.headers["X-Seed"] = str(config.sd_seed)
+    if cache_status is not None:
+        response.headers["X-Cache"] = cache_status
+    return response
+
 
-    if "paintByExampleImage" in input:
+def build_config(form, files) -> Config:
+    if "paintByExampleImage" in files:
         paint_by_example_example_image, _ = load_img(
-            input["paintByExampleImage"].read()
+            files["paintByExampleImage"].read()
         )
         paint_by_example_example_image = Image.fromarray(paint_by_example_example_image)
     else:
@@ -275,66 +432,396 @@ def process():
         controlnet_conditioning_scale=form["controlnet_conditioning_scale"],
         controlnet_method=form["controlnet_method"],
     )
+    # optional, older clients don't send them
+    for field, name in [
+        ("hdStrategyCropBatchSize", "hd_strategy_crop_batch_size"),
+        ("hdStrategyTileSize", "hd_strategy_tile_size"),
+        ("hdStrategyTileOverlap", "hd_strategy_tile_overlap"),
+        ("hdStrategyTileBatchSize", "hd_strategy_tile_batch_size"),
+        ("hdStrategyPyramidBand", "hd_strategy_pyramid_band"),
+    ]:
+        if field in form:
+            try:
+                setattr(config, name, int(form[field]))
+            except ValueError:
+                raise ValueError(f"Invalid {field}: {form[field]}")
+    config.check_hd_strategy()
 
     if config.sd_seed == -1:
         config.sd_seed = random.randint(1, 999999999)
     if config.paint_by_example_seed == -1:
         config.paint_by_example_seed = random.randint(1, 999999999)
+    return config
+
+
+@app.route("/session", methods=["POST"])
+def create_session():
+    if session_store is None:
+        return "Image session is disabled", 404
+    origin_image_bytes = request.files["image"].read()
+    image, alpha_channel, exif_infos = load_img(origin_image_bytes, return_exif=True)
+    session = session_store.create(
+        image, alpha_channel, exif_infos, get_image_ext(origin_image_bytes)
+    )
+    return (
+        jsonify(
+            {
+                "sessionId": session.id,
+                "width": image.shape[1],
+                "height": image.shape[0],
+            }
+        ),
+        200,
+    )
+
+
+@app.route("/session/<session_id>/image")
+def get_session_image(session_id):
+    session = session_store.get(session_id) if session_store else None
+    if session is None:
+        return f"Session {session_id} not found", 404
+    image = concat_alpha_channel(session.image, session.alpha_channel)
+    ext = response_ext(session.ext, session.alpha_channel is not None)
+    response = make_response(
+        send_file(
+            io.BytesIO(
+                image_to_bytes(
+                    Image.fromarray(image),
+                    ext,
+                    session.exif_infos,
+                    lossless=session.ext in LOSSLESS_EXTS,
+                )
+            ),
+            mimetype=ext_to_mimetype(ext),
+        )
+    )
+    response.vary.add("Accept")
+    return response
+
+
+@app.route("/session/<session_id>", methods=["DELETE"])
+def delete_session(session_id):
+    if session_store is None or not session_store.delete(session_id):
+        return f"Session {session_id} not found", 404
+    return "ok", 200
+
+
+@app.route("/session/<session_id>/commit", methods=["POST"])
+def commit_session(session_id):
+    """Apply the result of incremental inpainting to the session image"""
+    session = session_store.get(session_id) if session_store else None
+    if session is None:
+        return f"Session {session_id} not found", 404
+    session.commit()
+    return "ok", 200
+
+
+@app.route("/inpaint", methods=["POST"])
+@traced_request
+def process():
+    stage_times = metrics.StageTimes()
+    input = request.files
+    form = request.form
+    session = None
+    if "sessionId" in form:
+        session = session_store.get(form["sessionId"]) if session_store else None
+        if session is None:
+            return f"Session {form['sessionId']} not found", 404
+        image = session.image
+        alpha_channel = session.alpha_channel
+        exif_infos = session.exif_infos
+        ext = session.ext
+    else:
+        # RGB
+        origin_image_bytes = input["image"].read()
+        with stage_times.timer("decode"):
+            image, alpha_channel, exif_infos = load_img(
+                origin_image_bytes, return_exif=True
+            )
+        ext = get_image_ext(origin_image_bytes)
+
+    with stage_times.timer("decode"):
+        try:
+            mask = decode_mask(
+                input["mask"].read(),
+                form.get("maskEncoding", "png"),
+                image.shape[:2],
+            )
+        except ValueError as e:
+            return str(e), 400
+
+    if image.shape[:2] != mask.shape[:2]:
+        return (
+            f"Mask shape{mask.shape[:2]} not queal to Image shape{image.shape[:2]}",
+            400,
+        )
+
+    original_shape = image.shape
+    interpolation = cv2.INTER_CUBIC
+
+    size_limit = max(image.shape)
+
+    try:
+        config = build_config(form, input)
+    except ValueError as e:
+        return str(e), 400
+    lossless = ext in LOSSLESS_EXTS
+    ext = response_ext(ext, alpha_channel is not None)
+
+    # incremental: mask contains all strokes since last commit, only changed regions
+    # are inpainted again, the session image is kept unchanged
+    incremental = session is not None and form.get("incremental", "false") == "true"
+    if incremental:
+        incremental_key = make_cache_key(
+            None, None, model.name, config, controlnet=is_controlnet
+        )
+        prev_mask, prev_result = session.incremental_state(incremental_key)
+        if prev_mask is None:
+            prev_mask = np.zeros_like(mask)
+            prev_result = image[:, :, ::-1]
 
     logger.info(f"Origin image shape: {original_shape}")
-    image = resize_max_size(image, size_limit=size_limit, interpolation=interpolation)
+    with stage_times.timer("preprocess"):
+        image = resize_max_size(
+            image, size_limit=size_limit, interpolation=interpolation
+        )
+        mask = resize_max_size(mask, size_limit=size_limit, interpolation=interpolation)
+    try:
+        admitted_config = model.admit(image, mask, config)
+    except MemoryAdmissionError as e:
+        return memory_admission_response(e)
+    requested_config, config = config, admitted_config
+    metric_labels = dict(
+        model=model.name, hd_strategy=HDStrategy(config.hd_strategy).value
+    )
+
+    cache_key = None
+    if result_cache is not None and not incremental:
+        cache_key = make_cache_key(
+            image,
+            mask,
+            model.name,
+            config,
+            controlnet=is_controlnet,
+            alpha_channel=alpha_channel,
+            ext=ext,
+            lossless=lossless,
+            quality=image_quality,
+            png_compress_level=png_compress_level,
+            exif=exif_infos["exif"].tobytes(),
+            parameters=exif_infos["parameters"],
+        )
+        cached = result_cache.get(cache_key)
+        if cached is not None:
+            logger.info(f"Result cache hit: {cache_key}")
+            if session is not None and cached.image is not None:
+                session.update(cached.image)
+            socketio.emit("diffusion_finish")
+            stage_times.observe(**metric_labels)
+            return downgrade_headers(
+                inpaint_response(cached.data, cached.mimetype, config, "HIT"),
+                requested_config,
+                cached.config or config,
+            )
 
-    mask = resize_max_size(mask, size_limit=size_limit, interpolation=interpolation)
+    try:
+        if incremental:
+            job = scheduler.submit(
+                inference,
+                model.incremental_call,
+                image,
+                mask,
+                prev_mask,
+                prev_result,
+                config,
+                stage_times=stage_times,
+                job_id=form.get("jobId"),
+            )
+        else:
+            job = scheduler.submit(
+                inference,
+                model,
+                image,
+                mask,
+                config,
+                stage_times=stage_times,
+                job_id=form.get("jobId"),
+            )
+    except QueueFullError as e:
+        return queue_full_response(e)
+    except ValueError as e:
+        return str(e), 409
 
-    start = time.time()
     try:
-        res_np_img = model(image, mask, config)
+        res_np_img = wait_job(job)
+    except JobCancelledError as e:
+        return str(e), 499
+    except MemoryAdmissionError as e:
+        return memory_admission_response(e)
     except RuntimeError as e:
         if "CUDA out of memory. " in str(e):
+            metrics.oom_errors.inc(model=model.name)
             # NOTE: the string may change?
             return "CUDA out of memory", 500
         else:
             logger.exception(e)
             return f"{str(e)}", 500
     finally:
-        logger.info(f"process time: {(time.time() - start) * 1000}ms")
-        torch_gc()
+        logger.info(
+            f"process time: {job.run_time * 1000}ms, queue wait time: {job.wait_time * 1000}ms"
+        )
 
-    res_np_img = cv2.cvtColor(res_np_img.astype(np.uint8), cv2.COLOR_BGR2RGB)
-    if alpha_channel is not None:
-        if alpha_channel.shape[:2] != res_np_img.shape[:2]:
-            alpha_channel = cv2.resize(
-                alpha_channel, dsize=(res_np_img.shape[1], res_np_img.shape[0])
-            )
-        res_np_img = np.concatenate(
-            (res_np_img, alpha_channel[:, :, np.newaxis]), axis=-1
+    stage_times.add("queue", job.wait_time)
+    with stage_times.timer("encode"):
+        img_bytes = result_to_bytes(
+            res_np_img, alpha_channel, ext, exif_infos=exif_infos, lossless=lossless
         )
+    mimetype = ext_to_mimetype(ext)
+    used_config = job.info.get("fallback_config", config)
+    if incremental:
+        session.update_incremental(mask, res_np_img.astype(np.uint8), incremental_key)
+    elif session is not None or cache_key is not None:
+        rgb_result = cv2.cvtColor(res_np_img.astype(np.uint8), cv2.COLOR_BGR2RGB)
+        if session is not None:
+            # inpainting result is the image of the next stroke
+            session.update(rgb_result)
+        if cache_key is not None:
+            # kept decoded, a cache hit updates the session without decoding the bytes
+            result_cache.put(cache_key, img_bytes, mimetype, rgb_result, used_config)
 
-    ext = get_image_ext(origin_image_bytes)
+    socketio.emit("diffusion_finish")
+    stage_times.observe(**metric_labels)
+    return downgrade_headers(
+        inpaint_response(
+            img_bytes, mimetype, config, "MISS" if cache_key is not None else None
+        ),
+        requested_config,
+        used_config,
+    )
 
-    bytes_io = io.BytesIO(
-        pil_to_bytes(
-            Image.fromarray(res_np_img),
-            ext,
-            quality=image_quality,
-            exif_infos=exif_infos,
+
+@app.route("/inpaint_batch", methods=["POST"])
+@traced_request
+def process_batch():
+    """
+    Inpaint multiple image/mask pairs with the same settings, images are paired with
+    masks by upload order. Returns a zip file, result of the i-th image is named
+    `{i}_{filename}`
+    """
+    input = request.files
+    image_files = input.getlist("image")
+    mask_files = input.getlist("mask")
+    if len(image_files) != len(mask_files):
+        return (
+            f"Number of images({len(image_files)}) not equal to number of masks({len(mask_files)})",
+            400,
+        )
+    if len(image_files) == 0:
+        return "No image", 400
+    if len(image_files) > max_batch_size:
+        return f"Batch size {len(image_files)} exceeds {max_batch_size}", 400
+
+    stage_times = metrics.StageTimes()
+    mask_encoding = request.form.get("maskEncoding", "png")
+    images, masks, alpha_channels, exifs, exts = [], [], [], [], []
+    for image_file, mask_file in zip(image_files, mask_files):
+        origin_image_bytes = image_file.read()
+        with stage_times.timer("decode"):
+            image, alpha_channel, exif_infos = load_img(
+                origin_image_bytes, return_exif=True
+            )
+            try:
+                mask = decode_mask(mask_file.read(), mask_encoding, image.shape[:2])
+            except ValueError as e:
+                return f"{mask_file.filename}: {e}", 400
+        if image.shape[:2] != mask.shape[:2]:
+            return (
+                f"{image_file.filename}: Mask shape{mask.shape[:2]} not queal to Image shape{image.shape[:2]}",
+                400,
+            )
+        images.append(image)
+        masks.append(mask)
+        alpha_channels.append(alpha_channel)
+        exifs.append(exif_infos)
+        exts.append(get_image_ext(origin_image_bytes))
+
+    try:
+        requested_config = config = build_config(request.form, input)
+    except ValueError as e:
+        return str(e), 400
+    logger.info(f"Batch size: {len(images)}")
+    try:
+        # a downgraded config is used for every image
+        for image, mask in zip(images, masks):
+            config = model.admit(image, mask, config)
+    except MemoryAdmissionError as e:
+        return memory_admission_response(e)
+
+    try:
+        job = scheduler.submit(
+            inference,
+            model.inpaint_batch,
+            images,
+            masks,
+            config,
+            stage_times=stage_times,
+            job_id=request.form.get("jobId"),
+        )
+    except QueueFullError as e:
+        return queue_full_response(e)
+    except ValueError as e:
+        return str(e), 409
+
+    try:
+        res_np_imgs = wait_job(job)
+    except JobCancelledError as e:
+        return str(e), 499
+    except MemoryAdmissionError as e:
+        return memory_admission_response(e)
+    except RuntimeError as e:
+        if "CUDA out of memory. " in str(e):
+            metrics.oom_errors.inc(model=model.name)
+            # NOTE: the string may change?
+            return "CUDA out of memory", 500
+        else:
+            logger.exception(e)
+            return f"{str(e)}", 500
+    finally:
+        logger.info(
+            f"batch process time: {job.run_time * 1000}ms, queue wait time: {job.wait_time * 1000}ms"
         )
+
+    stage_times.add("queue", job.wait_time)
+    bytes_io = io.BytesIO()
+    with stage_times.timer("encode"):
+        with zipfile.ZipFile(bytes_io, "w", compression=zipfile.ZIP_STORED) as zf:
+            for i, res_np_img in enumerate(res_np_imgs):
+                stem = Path(image_files[i].filename or "image").stem
+                zf.writestr(
+                    f"{i}_{stem}.{exts[i]}",
+                    result_to_bytes(res_np_img, alpha_channels[i], exts[i], exifs[i]),
+                )
+    bytes_io.seek(0)
+    stage_times.observe(
+        model=model.name, hd_strategy=HDStrategy(config.hd_strategy).value
     )
 
     response = make_response(
         send_file(
-            # io.BytesIO(numpy_to_bytes(res_np_img, ext)),
             bytes_io,
-            mimetype=f"image/{ext}",
+            mimetype="application/zip",
+            as_attachment=True,
+            download_name="inpaint_batch.zip",
         )
     )
     response.headers["X-Seed"] = str(config.sd_seed)
-
-    socketio.emit("diffusion_finish")
-    return response
+    return downgrade_headers(
+        response, requested_config, job.info.get("fallback_config", config)
+    )
 
 
 @app.route("/run_plugin", methods=["POST"])
+@traced_request
 def run_plugin():
     form = request.form
     files = request.files
@@ -342,31 +829,55 @@ def run_plugin():
     if name not in plugins:
         return "Plugin not found", 500
 
+    stage_times = metrics.StageTimes()
     origin_image_bytes = files["image"].read()  # RGB
-    rgb_np_img, alpha_channel, exif_infos = load_img(
-        origin_image_bytes, return_exif=True
-    )
+    with stage_times.timer("decode"):
+        rgb_np_img, alpha_channel, exif_infos = load_img(
+            origin_image_bytes, return_exif=True
+        )
+
+    form = dict(form)
+    if name == InteractiveSeg.name:
+        img_md5 = hashlib.md5(origin_image_bytes).hexdigest()
+        form["img_md5"] = img_md5
+
+    try:
+        job = scheduler.submit(
+            inference,
+            run_plugin_job,
+            name,
+            rgb_np_img,
+            files,
+            form,
+            job_id=form.get("jobId"),
+        )
+    except QueueFullError as e:
+        return queue_full_response(e)
+    except ValueError as e:
+        return str(e), 409
 
-    start = time.time()
     try:
-        form = dict(form)
-        if name == InteractiveSeg.name:
-            img_md5 = hashlib.md5(origin_image_bytes).hexdigest()
-            form["img_md5"] = img_md5
-        bgr_res = plugins[name](rgb_np_img, files, form)
+        bgr_res = wait_job(job)
+    except JobCancelledError as e:
+        return str(e), 499
     except RuntimeError as e:
         torch.cuda.empty_cache()
         if "CUDA out of memory. " in str(e):
+            metrics.oom_errors.inc(plugin=name)
             # NOTE: the string may change?
             return "CUDA out of memory", 500
         else:
             logger.exception(e)
             return "Internal Server Error", 500
 
-    logger.info(f"{name} process time: {(time.time() - start) * 1000}ms")
-    torch_gc()
+    logger.info(
+        f"{name} process time: {job.run_time * 1000}ms, queue wait time: {job.wait_time * 1000}ms"
+    )
+    stage_times.add("queue", job.wait_time)
+    stage_times.add("forward", job.run_time)
 
     if name == MakeGIF.name:
+        stage_times.observe(plugin=name)
         return send_file(
             io.BytesIO(bgr_res),
             mimetype="image/gif",
@@ -374,9 +885,12 @@ def run_plugin():
             download_name=form["filename"],
         )
     if name == InteractiveSeg.name:
+        with stage_times.timer("encode"):
+            img_bytes = numpy_to_bytes(bgr_res, "png")
+        stage_times.observe(plugin=name)
         return make_response(
             send_file(
-                io.BytesIO(numpy_to_bytes(bgr_res, "png")),
+                io.BytesIO(img_bytes),
                 mimetype="image/png",
             )
         )
@@ -387,28 +901,22 @@ def run_plugin():
     else:
         rgb_res = cv2.cvtColor(bgr_res, cv2.COLOR_BGR2RGB)
         ext = get_image_ext(origin_image_bytes)
-        if alpha_channel is not None:
-            if alpha_channel.shape[:2] != rgb_res.shape[:2]:
-                alpha_channel = cv2.resize(
-                    alpha_channel, dsize=(rgb_res.shape[1], rgb_res.shape[0])
-                )
-            rgb_res = np.concatenate(
-                (rgb_res, alpha_channel[:, :, np.newaxis]), axis=-1
-            )
+        rgb_res = concat_alpha_channel(rgb_res, alpha_channel)
+    lossless = ext in LOSSLESS_EXTS
+    ext = response_ext(ext, rgb_res.ndim == 3 and rgb_res.shape[2] == 4)
 
+    with stage_times.timer("encode"):
+        img_bytes = image_to_bytes(
+            Image.fromarray(rgb_res), ext, exif_infos, lossless=lossless
+        )
+    stage_times.observe(plugin=name)
     response = make_response(
         send_file(
-            io.BytesIO(
-                pil_to_bytes(
-                    Image.fromarray(rgb_res),
-                    ext,
-                    quality=image_quality,
-                    exif_infos=exif_infos,
-                )
-            ),
-            mimetype=f"image/{ext}",
+            io.BytesIO(img_bytes),
+            mimetype=ext_to_mimetype(ext),
         )
     )
+    response.vary.add("Accept")
     return response
 
 
@@ -424,6 +932,52 @@ def get_server_config():
     }, 200
 
 
+@app.route("/trace/<trace_id>")
+def get_trace(trace_id):
+    """Chrome trace json of a request traced with X-Trace header"""
+    trace = trace_store.get(trace_id)
+    if trace is None:
+        return f"Trace {trace_id} not found", 404
+    return jsonify(trace.to_chrome_trace()), 200
+
+
+@app.route("/metrics")
+def get_metrics():
+    return make_response(
+        metrics.registry.render(), 200, {"Content-Type": metrics.CONTENT_TYPE}
+    )
+
+
+@app.route("/ready")
+def get_ready():
+    if not ready.is_set():
+        return jsonify({"ready": False}), 503
+    return jsonify({"ready": True}), 200
+
+
+@app.route("/cancel/<job_id>", methods=["POST"])
+def cancel_job(job_id):
+    """Cancel a job submitted with jobId form field"""
+    if not scheduler.cancel(job_id):
+        return f"Job {job_id} not found", 404
+    return "ok", 200
+
+
+@app.route("/queue")
+def get_queue_status():
+    stats = {**scheduler.stats(), "replicas": model.stats()}
+    if model.admission is not None:
+        stats["memory"] = model.admission.stats()
+    return jsonify(stats), 200
+
+
+@app.route("/result_cache")
+def get_result_cache_stats():
+    if result_cache is None:
+        return "Result cache is disabled", 404
+    return jsonify(result_cache.stats()), 200
+
+
 @app.route("/model")
 def current_model():
     return model.name, 200
@@ -439,6 +993,21 @@ def get_is_desktop():
     return str(is_desktop), 200
 
 
+@app.route("/models/resident")
+def get_resident_models():
+    resident_models = model.resident_models()
+    return (
+        jsonify(
+            {
+                "models": resident_models,
+                "totalSize": sum(it["size"] for it in resident_models),
+                "maxSize": model.model_cache_size,
+            }
+        ),
+        200,
+    )
+
+
 @app.route("/model", methods=["POST"])
 def switch_model():
     if is_disable_model_switch:
@@ -449,9 +1018,16 @@ def switch_model():
         return "Same model", 200
 
     try:
-        model.switch(new_name)
+        scheduler.run(model.switch, new_name)
+    except QueueFullError as e:
+        return queue_full_response(e)
     except NotImplementedError:
         return f"{new_name} not implemented", 403
+    if model.admission is not None:
+        try:
+            scheduler.submit(run_memory_calibration)
+        except QueueFullError:
+            logger.warning(f"Queue is full, memory of {new_name} is not calibrated")
     return f"ok, switch to {new_name}", 200
 
 
@@ -527,6 +1103,9 @@ def build_plugins(args):
 
 def main(args):
     global model
+    global scheduler
+    global result_cache
+    global session_store
     global device
     global input_image_path
     global is_disable_model_switch
@@ -538,10 +1117,16 @@ def main(args):
     global is_controlnet
     global controlnet_method
     global image_quality
+    global png_compress_level
+    global max_batch_size
+    global trace_dir
 
     build_plugins(args)
 
     image_quality = args.quality
+    png_compress_level = args.png_compress_level
+    max_batch_size = args.max_batch_size
+    trace_dir = args.trace_dir
 
     if args.sd_controlnet and args.model in SD15_MODELS:
         is_controlnet = True
@@ -581,12 +1166,33 @@ def main(args):
     else:
         input_image_path = args.input
 
-    model = ModelManager(
+    specs = replica_specs(device, args.replicas, args.replica_devices)
+    admission = None
+    if args.memory_budget != "0":
+        capacity = {}
+        for spec in specs:
+            if args.memory_budget == "auto":
+                ratio = 0.9 if spec.device.type == "cuda" else 0.8
+                capacity[str(spec.device)] = int(available_memory(spec.device) * ratio)
+            else:
+                capacity[str(spec.device)] = int(args.memory_budget) * MB
+        logger.info(
+            f"Memory budget: { {k: f'{v / MB:.0f}MB' for k, v in capacity.items()} }, "
+            f"policy: {args.memory_policy}"
+        )
+        admission = AdmissionController(
+            capacity, args.memory_policy, profile_path=args.memory_profile
+        )
+
+    model = DevicePool(
         name=args.model,
+        specs=specs,
+        admission=admission,
         sd_controlnet=args.sd_controlnet,
         sd_controlnet_method=args.sd_controlnet_method,
-        device=device,
+        model_cache_size=args.model_cache_size * 1024 * 1024,
         no_half=args.no_half,
+        precision=args.precision,
         hf_access_token=args.hf_access_token,
         disable_nsfw=args.sd_disable_nsfw or args.disable_nsfw,
         sd_cpu_textencoder=args.sd_cpu_textencoder,
@@ -596,7 +1202,37 @@ def main(args):
         cpu_offload=args.cpu_offload,
         enable_xformers=args.sd_enable_xformers or args.enable_xformers,
         callback=diffuser_callback,
+        oom_fallback=args.oom_fallback,
+        shape_buckets=args.shape_buckets,
+        backend=args.backend,
+        onnx_model=args.onnx_model,
+        onnx_intra_op_threads=args.onnx_intra_op_threads,
+        onnx_inter_op_threads=args.onnx_inter_op_threads,
     )
+    # one worker bound to each replica
+    scheduler = InferenceScheduler(
+        max_queue_size=args.max_queue_size,
+        num_workers=len(model),
+        worker_init=model.bind_worker,
+    )
+    metrics.queue_depth.set_function(lambda: scheduler.depth)
+    metrics.running_jobs.set_function(lambda: scheduler.running)
+    if args.warmup:
+        # first job of the queue, requests arrived before it finished wait behind it
+        ready.clear()
+        scheduler.submit(
+            run_warmup,
+            args.warmup_sizes,
+            [HDStrategy(it) for it in args.warmup_strategies],
+        )
+    if admission is not None:
+        scheduler.submit(run_memory_calibration)
+    if args.result_cache_size > 0:
+        result_cache = ResultCache(max_bytes=args.result_cache_size * 1024 * 1024)
+    if args.max_sessions > 0:
+        session_store = SessionStore(
+            max_sessions=args.max_sessions, ttl=args.session_ttl
+        )
 
     if args.gui:
         app_width, app_height = args.gui_size
@@ -0,0 +1,120 @@
+import collections
+import threading
+import time
+import uuid
+from typing import Optional
+
+import cv2
+import numpy as np
+
+
+class ImageSession:
+    def __init__(self, image: np.ndarray, alpha_channel, exif_infos, ext: str):
+        """
+
+        Args:
+            image: [H, W, C] RGB, current image of the editing session
+            alpha_channel: [H, W] or None
+            exif_infos: returned by load_img(return_exif=True)
+            ext: image format of the uploaded image
+        """
+        self.id = uuid.uuid4().hex
+        self.image = image
+        self.alpha_channel = alpha_channel
+        self.exif_infos = exif_infos
+        self.ext = ext
+        self.last_access = time.time()
+        # state of incremental inpainting, image is kept unchanged until commit()
+        self.prev_mask: Optional[np.ndarray] = None
+        self.prev_result: Optional[np.ndarray] = None
+        self.prev_key: Optional[str] = None
+
+    def update(self, image: np.ndarray):
+        self.image = image
+        self.reset_incremental()
+        self.last_access = time.time()
+
+    def update_incremental(self, mask: np.ndarray, result: np.ndarray, key: str):
+        """
+        Args:
+            mask: [H, W] mask of all strokes since last commit
+            result: [H, W, C] BGR, inpainting result of mask
+            key: settings of result, previous result is dropped when settings changed
+        """
+        self.prev_mask = mask
+        self.prev_result = result
+        self.prev_key = key
+        self.last_access = time.time()
+
+    def incremental_state(self, key: str):
+        """
+        Returns:
+            (prev_mask, prev_result), both None if there is no reusable result
+        """
+        if self.prev_key != key:
+            return None, None
+        return self.prev_mask, self.prev_result
+
+    def reset_incremental(self):
+        self.prev_mask = None
+        self.prev_result = None
+        self.prev_key = None
+
+    def commit(self):
+        """Use the incremental result as image of the following strokes"""
+        if self.prev_result is not None:
+            self.update(cv2.cvtColor(self.prev_result, cv2.COLOR_BGR2RGB))
+
+
+class SessionStore:
+    """
+    Keep the decoded image of each editing session, so clients upload the image
+    once and only send masks afterwards
+    """
+
+    def __init__(self, max_sessions: int = 8, ttl: float = 3600):
+        """
+
+        Args:
+            max_sessions: least recently used sessions are dropped when exceeded
+            ttl: seconds, sessions not accessed for ttl seconds are dropped
+        """
+        self.max_sessions = max_sessions
+        self.ttl = ttl
+        self._sessions: "collections.OrderedDict[str, ImageSession]" = (
+            collections.OrderedDict()
+        )
+        self._lock = threading.Lock()
+
+    def create(self, image, alpha_channel, exif_infos, ext: str) -> ImageSession:
+        session = ImageSession(image, alpha_channel, exif_infos, ext)
+        with self._lock:
+            self._sessions[session.id] = session
+            self._evict()
+        return session
+
+    def get(self, session_id: str) -> Optional[ImageSession]:
+        with self._lock:
+            self._evict()
+            session = self._sessions.get(session_id)
+            if session is not None:
+                session.last_access = time.time()
+                self._sessions.move_to_end(session_id)
+            return session
+
+    def delete(self, session_id: str) -> bool:
+        with self._lock:
+            return self._sessions.pop(session_id, None) is not None
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def _evict(self):
+        now = time.time()
+        expired = [
+            k for k, v in self._sessions.items() if now - v.last_access > self.ttl
+        ]
+        for k in expired:
+            del self._sessions[k]
+        while len(self._sessions) > self.max_sessions:
+            self._sessions.popitem(last=False)
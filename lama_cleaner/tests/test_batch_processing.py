@@ -0,0 +1,47 @@
+import shutil
+from pathlib import Path
+
+import cv2
+
+from lama_cleaner.batch_processing import main, pair_image_mask, parse_batch_args
+
+current_dir = Path(__file__).parent.absolute().resolve()
+
+
+def test_batch_processing(tmp_path):
+    image_dir = tmp_path / "images"
+    mask_dir = tmp_path / "masks"
+    output_dir = tmp_path / "output"
+    image_dir.mkdir()
+    mask_dir.mkdir()
+    for i in range(3):
+        shutil.copy(current_dir / "image.png", image_dir / f"{i}.png")
+        shutil.copy(current_dir / "mask.png", mask_dir / f"{i}.png")
+    # image without mask is skipped
+    shutil.copy(current_dir / "bunny.jpeg", image_dir / "bunny.jpeg")
+
+    assert len(pair_image_mask(image_dir, mask_dir)) == 3
+    assert len(pair_image_mask(image_dir, current_dir / "mask.png")) == 4
+
+    args = parse_batch_args(
+        [
+            "--image",
+            str(image_dir),
+            "--mask",
+            str(mask_dir),
+            "--output",
+            str(output_dir),
+            "--model",
+            "cv2",
+            "--device",
+            "cpu",
+            "--batch-size",
+            "2",
+        ]
+    )
+    main(args)
+
+    assert sorted(it.name for it in output_dir.glob("*")) == ["0.png", "1.png", "2.png"]
+    img = cv2.imread(str(current_dir / "image.png"))
+    res = cv2.imread(str(output_dir / "0.png"))
+    assert res.shape == img.shape
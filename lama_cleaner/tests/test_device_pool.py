@@ -0,0 +1,168 @@
+import os
+import threading
+
+import pytest
+import torch
+
+from lama_cleaner import model_manager
+from lama_cleaner.device_pool import (
+    DevicePool,
+    ReplicaSpec,
+    parse_cores,
+    replica_specs,
+    split_cores,
+)
+from lama_cleaner.memory_estimator import MB, AdmissionController, MemoryProfile
+from lama_cleaner.scheduler import InferenceScheduler
+from lama_cleaner.schema import HDStrategy
+from lama_cleaner.tests.test_model import get_config, get_data
+from lama_cleaner.tests.test_model_manager import FakeModel
+
+
+def test_parse_replica_spec():
+    assert parse_cores("0-3,8,10-11") == {0, 1, 2, 3, 8, 10, 11}
+
+    spec = ReplicaSpec.parse("cpu:0-1")
+    assert spec.device == torch.device("cpu")
+    assert spec.cores == {0, 1}
+
+    spec = ReplicaSpec.parse("cuda:1")
+    assert spec.device == torch.device("cuda:1")
+    assert spec.cores is None
+
+
+def test_replica_specs():
+    cpu = torch.device("cpu")
+    assert replica_specs(cpu, 1)[0].cores is None
+    assert [it.device for it in replica_specs(cpu, 3, ["cpu", "cpu:0"])] == [cpu, cpu]
+
+    num_cores = len(split_cores(1)[0])
+    if num_cores < 2:
+        pytest.skip("need at least 2 cores")
+    specs = replica_specs(cpu, 2)
+    assert len(specs) == 2
+    assert not specs[0].cores & specs[1].cores
+    assert len(specs[0].cores) == num_cores // 2
+
+
+def test_device_pool_dispatch():
+    specs = [ReplicaSpec(torch.device("cpu")) for _ in range(2)]
+    pool = DevicePool("cv2", specs)
+    scheduler = InferenceScheduler(
+        max_queue_size=0, num_workers=len(pool), worker_init=pool.bind_worker
+    )
+
+    # replicas block until both are busy, so each job must run on a different one
+    barrier = threading.Barrier(2, timeout=10)
+    replica_models = {}
+
+    def _run(model):
+        replica_models[threading.current_thread().name] = model
+        barrier.wait()
+
+    jobs = [scheduler.submit(pool.run, _run) for _ in range(2)]
+    for job in jobs:
+        job.result()
+    # each worker runs on its own replica
+    assert replica_models == {
+        f"inference-worker-{it.index}": it.model for it in pool.replicas
+    }
+    assert [it["numJobs"] for it in pool.stats()] == [1, 1]
+
+    img, mask = get_data()
+    cfg = get_config(HDStrategy.ORIGINAL)
+    results = [
+        job.result()
+        for job in [scheduler.submit(pool, img, mask, cfg) for _ in range(4)]
+    ]
+    for result in results:
+        assert (result == results[0]).all()
+
+    pool.switch("cv2")
+    assert pool.name == "cv2"
+    scheduler.shutdown()
+
+
+def test_device_pool_switch_waits_for_jobs():
+    specs = [ReplicaSpec(torch.device("cpu")) for _ in range(2)]
+    pool = DevicePool("cv2", specs)
+    running = threading.Event()
+    finish = threading.Event()
+
+    def _run(model):
+        running.set()
+        finish.wait(10)
+
+    job = threading.Thread(target=pool.run, args=(_run,))
+    job.start()
+    assert running.wait(10)
+    switch = threading.Thread(target=pool.switch, args=("cv2",))
+    switch.start()
+    # switch holds every replica, it can't start while a job is running
+    switch.join(0.2)
+    assert switch.is_alive()
+    finish.set()
+    job.join()
+    switch.join(10)
+    assert not switch.is_alive()
+
+    with pytest.raises(NotImplementedError):
+        pool.switch("unknown")
+    assert pool.name == "cv2"
+
+
+@pytest.mark.skipif(not hasattr(os, "sched_setaffinity"), reason="linux only")
+def test_device_pool_pin_cores():
+    core = min(os.sched_getaffinity(0))
+    origin_affinity = os.sched_getaffinity(0)
+    origin_num_threads = torch.get_num_threads()
+    pool = DevicePool("cv2", [ReplicaSpec(torch.device("cpu"), {core})])
+    scheduler = InferenceScheduler(
+        max_queue_size=0, num_workers=len(pool), worker_init=pool.bind_worker
+    )
+
+    def _run(model):
+        return os.sched_getaffinity(0), torch.get_num_threads()
+
+    assert scheduler.run(pool.run, _run) == ({core}, 1)
+    scheduler.shutdown()
+    # only the worker is pinned and sized
+    assert os.sched_getaffinity(0) == origin_affinity
+    assert torch.get_num_threads() == origin_num_threads
+
+
+class FlakyModel(FakeModel):
+    """Loads on the first replica only"""
+
+    num_init = 0
+
+    def init_model(self, device, **kwargs):
+        FlakyModel.num_init += 1
+        if FlakyModel.num_init > 1:
+            raise RuntimeError("download failed")
+        super().init_model(device, **kwargs)
+
+
+def test_device_pool_switch_failed(monkeypatch):
+    monkeypatch.setitem(model_manager.models, "fake", FakeModel)
+    monkeypatch.setitem(model_manager.models, "flaky", FlakyModel)
+    pool = DevicePool("fake", [ReplicaSpec(torch.device("cpu")) for _ in range(2)])
+    with pytest.raises(RuntimeError):
+        pool.switch("flaky")
+    # the replica that failed and the one switched before it both run fake again
+    assert pool.name == "fake"
+    for replica in pool.replicas:
+        assert replica.model.name == "fake"
+        assert isinstance(replica.model.model, FakeModel)
+        assert not isinstance(replica.model.model, FlakyModel)
+
+
+def test_device_pool_admit_during_switch():
+    admission = AdmissionController({"cpu": 50 * MB}, policy="queue")
+    admission.profiles["cv2:cpu:fp32"] = MemoryProfile(0, MB / 1000)
+    pool = DevicePool("cv2", [ReplicaSpec(torch.device("cpu"))], admission=admission)
+    img, mask = get_data()
+    config = get_config(HDStrategy.ORIGINAL)
+    # model evicted while the next one loads
+    pool.replicas[0].model.model = None
+    assert pool.admit(img, mask, config) is config
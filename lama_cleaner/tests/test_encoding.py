@@ -0,0 +1,72 @@
+import io
+from pathlib import Path
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from lama_cleaner.encoding import encode_image, negotiate_ext, parse_accept
+from lama_cleaner.helper import load_img
+
+current_dir = Path(__file__).parent.absolute().resolve()
+
+
+def test_parse_accept():
+    assert parse_accept("image/webp, image/*;q=0.8 ,*/*;q=abc") == [
+        ("image/webp", 1.0),
+        ("image/*", 0.8),
+        ("*/*", 0.0),
+    ]
+    assert parse_accept(None) == []
+
+
+@pytest.mark.parametrize(
+    "accept, default, has_alpha, expected",
+    [
+        (None, "png", False, "png"),
+        ("*/*", "jpeg", False, "jpeg"),
+        # tie keeps the input format
+        ("image/webp,*/*", "png", False, "png"),
+        ("image/webp,*/*;q=0.8", "png", False, "webp"),
+        ("image/webp;q=0.5,image/png", "png", False, "png"),
+        ("image/png", "jpeg", False, "png"),
+        ("image/*;q=0.5,image/jpeg", "png", False, "jpeg"),
+        ("image/*;q=0.5,image/jpeg", "png", True, "png"),
+        ("text/html", "png", False, "png"),
+    ],
+)
+def test_negotiate_ext(accept, default, has_alpha, expected):
+    assert negotiate_ext(accept, default, has_alpha) == expected
+
+
+def test_png_keeps_parameters_and_exif():
+    img_bytes = (current_dir / "pnginfo_test.png").read_bytes()
+    np_img, _, exif_infos = load_img(img_bytes, return_exif=True)
+    pil_img = Image.fromarray(np_img)
+
+    sizes = []
+    for level in [0, 1, 9]:
+        data = encode_image(
+            pil_img, "png", exif_infos=exif_infos, png_compress_level=level
+        )
+        res_img = Image.open(io.BytesIO(data))
+        assert res_img.info.get("parameters") == exif_infos["parameters"]
+        assert res_img.getexif() == exif_infos["exif"]
+        np.testing.assert_array_equal(np.asarray(res_img), np_img)
+        sizes.append(len(data))
+    assert sizes[0] > sizes[1] >= sizes[2]
+
+
+def test_webp():
+    rgba = np.random.randint(0, 256, (64, 96, 4), dtype=np.uint8)
+    pil_img = Image.fromarray(rgba)
+
+    data = encode_image(pil_img, "webp", lossless=True)
+    res_img = Image.open(io.BytesIO(data))
+    assert res_img.format == "WEBP"
+    np.testing.assert_array_equal(np.asarray(res_img), rgba)
+
+    data = encode_image(pil_img, "webp", quality=50, exif_infos={"parameters": "a"})
+    res_img = Image.open(io.BytesIO(data))
+    assert res_img.size == (96, 64)
+    assert res_img.mode == "RGBA"
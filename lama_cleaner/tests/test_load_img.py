@@ -1,5 +1,11 @@
+import io
 from pathlib import Path
 
+import cv2
+import numpy as np
+import pytest
+from PIL import Image, ImageOps
+
 from lama_cleaner.helper import load_img
 
 current_dir = Path(__file__).parent.absolute().resolve()
@@ -19,3 +25,68 @@ def test_load_jpg_image():
         np_img, alpha_channel = load_img(f.read())
     assert np_img.shape == (394, 448, 3)
     assert alpha_channel is None
+
+
+def _encode(np_img, ext, orientation=1, **kwargs):
+    exif = Image.Exif()
+    exif[0x0112] = orientation
+    with io.BytesIO() as output:
+        Image.fromarray(np_img).save(output, format=ext, exif=exif, **kwargs)
+        return output.getvalue()
+
+
+def _pil_load(img_bytes, mode):
+    image = ImageOps.exif_transpose(Image.open(io.BytesIO(img_bytes)))
+    return np.array(image.convert(mode))
+
+
+@pytest.mark.parametrize("orientation", range(1, 9))
+@pytest.mark.parametrize("ext", ["png", "jpeg"])
+def test_exif_orientation(ext, orientation):
+    for np_img in [
+        cv2.resize(
+            np.random.randint(0, 256, (5, 8, 3), dtype=np.uint8),
+            (64, 40),
+            interpolation=cv2.INTER_LINEAR,
+        ),
+        np.random.randint(0, 256, (40, 64, 3), dtype=np.uint8),
+    ]:
+        img_bytes = _encode(np_img, ext, orientation)
+
+        res, alpha_channel, exif_infos = load_img(img_bytes, return_exif=True)
+        assert alpha_channel is None
+        assert exif_infos["exif"][0x0112] == orientation
+        expected = _pil_load(img_bytes, "RGB")
+        assert res.shape == expected.shape
+        assert np.abs(res.astype(int) - expected).max() <= 1
+
+        # both convert the decoded RGB to gray with the same weights, rounding of
+        # cv2 and PIL differs by at most 1
+        gray, _ = load_img(img_bytes, gray=True)
+        assert np.abs(gray.astype(int) - _pil_load(img_bytes, "L")).max() <= 1
+
+
+@pytest.mark.parametrize("orientation", [1, 6])
+def test_rgba_png(orientation):
+    np_img = np.random.randint(0, 256, (40, 64, 4), dtype=np.uint8)
+    img_bytes = _encode(np_img, "png", orientation)
+
+    res, alpha_channel = load_img(img_bytes)
+    expected = _pil_load(img_bytes, "RGBA")
+    np.testing.assert_array_equal(res, expected[:, :, :3])
+    np.testing.assert_array_equal(alpha_channel, expected[:, :, 3])
+    assert alpha_channel.flags["C_CONTIGUOUS"]
+
+
+def test_fallback_to_pil():
+    np_img = np.random.randint(0, 256, (40, 64, 3), dtype=np.uint8)
+    # RGB in PIL, BGRA in cv2
+    img_bytes = _encode(np_img, "png", transparency=(0, 0, 0))
+    res, alpha_channel = load_img(img_bytes)
+    np.testing.assert_array_equal(res, np_img)
+    assert alpha_channel is None
+
+    img_bytes = _encode(np.stack([np_img[:, :, 0]] * 2, axis=-1), "png")
+    res, alpha_channel = load_img(img_bytes)
+    np.testing.assert_array_equal(res, _pil_load(img_bytes, "RGB"))
+
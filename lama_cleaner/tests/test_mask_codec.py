@@ -0,0 +1,79 @@
+import json
+
+import cv2
+import numpy as np
+import pytest
+
+from lama_cleaner.mask_codec import (
+    decode_bitpacked,
+    decode_mask,
+    decode_rle,
+    encode_bitpacked,
+    encode_rle,
+)
+
+
+def _random_mask(height=37, width=53):
+    mask = np.zeros((height, width), dtype=np.uint8)
+    cv2.circle(mask, (width // 3, height // 2), 9, 255, -1)
+    cv2.line(mask, (0, 0), (width - 1, height - 1), 255, 3)
+    return mask
+
+
+def test_rle():
+    mask = np.array([[0, 255, 255], [0, 0, 255]], dtype=np.uint8)
+    # column-major: 0 0 | 255 | 0 | 255 255
+    assert encode_rle(mask, compress=False) == {"size": [2, 3], "counts": [2, 1, 1, 2]}
+    np.testing.assert_array_equal(
+        decode_rle({"size": [2, 3], "counts": [2, 1, 1, 2]}), mask
+    )
+    # starts with masked pixel
+    mask = np.full((2, 2), 255, dtype=np.uint8)
+    assert encode_rle(mask, compress=False)["counts"] == [0, 4]
+
+
+@pytest.mark.parametrize("compress", [True, False])
+def test_rle_roundtrip(compress):
+    mask = _random_mask()
+    rle = encode_rle(mask, compress=compress)
+    decoded = decode_rle(rle)
+    assert decoded.flags["C_CONTIGUOUS"]
+    np.testing.assert_array_equal(decoded, mask)
+
+
+def test_rle_pycocotools():
+    mask_utils = pytest.importorskip("pycocotools.mask")
+    mask = _random_mask()
+    rle = mask_utils.encode(np.asfortranarray(mask > 0, dtype=np.uint8))
+    assert rle["counts"].decode() == encode_rle(mask)["counts"]
+    rle["counts"] = rle["counts"].decode()
+    np.testing.assert_array_equal(decode_rle(rle), mask)
+
+
+def test_bitpacked_roundtrip():
+    mask = _random_mask()
+    data = encode_bitpacked(mask)
+    assert len(data) == mask.shape[0] * 7
+    np.testing.assert_array_equal(decode_bitpacked(data, mask.shape), mask)
+
+
+def test_decode_mask():
+    mask = _random_mask()
+    shape = mask.shape
+    png = cv2.imencode(".png", mask)[1].tobytes()
+    np.testing.assert_array_equal(decode_mask(png, "png", shape), mask)
+    rle = json.dumps(encode_rle(mask)).encode()
+    np.testing.assert_array_equal(decode_mask(rle, "rle", shape), mask)
+    bitpacked = encode_bitpacked(mask)
+    np.testing.assert_array_equal(decode_mask(bitpacked, "bitpacked", shape), mask)
+
+    with pytest.raises(ValueError):
+        decode_mask(rle, "rle", (shape[0] + 1, shape[1]))
+    with pytest.raises(ValueError):
+        decode_mask(b"{", "rle", shape)
+    with pytest.raises(ValueError):
+        decode_mask(json.dumps({"size": shape, "counts": [1]}), "rle", shape)
+    with pytest.raises(ValueError):
+        decode_mask(bitpacked[:-1], "bitpacked", shape)
+    with pytest.raises(ValueError):
+        decode_mask(bitpacked, "jpeg", shape)
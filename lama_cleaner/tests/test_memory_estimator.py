@@ -0,0 +1,137 @@
+import threading
+import time
+
+import pytest
+import torch
+
+from lama_cleaner.memory_estimator import (
+    MB,
+    AdmissionController,
+    MemoryAdmissionError,
+    MemoryBudget,
+    MemoryProfile,
+)
+from lama_cleaner.model_manager import ModelManager
+from lama_cleaner.scheduler import InferenceScheduler
+from lama_cleaner.schema import HDStrategy
+from lama_cleaner.tests.test_model import get_config, get_data
+
+
+@pytest.mark.parametrize(
+    "strategy", [HDStrategy.ORIGINAL, HDStrategy.RESIZE, HDStrategy.CROP]
+)
+def test_forward_shapes(monkeypatch, strategy):
+    model = ModelManager(name="cv2", device=torch.device("cpu")).model
+    img, mask = get_data(fx=1.3, fy=0.7)
+    config = get_config(strategy)
+
+    shapes = []
+    forward = model.forward
+
+    def _forward(image, mask, config):
+        shapes.append(image.shape[:2])
+        return forward(image, mask, config)
+
+    monkeypatch.setattr(model, "forward", _forward)
+    model(img, mask, config)
+    assert model.forward_shapes(img, mask, config) == shapes
+
+
+def test_memory_profile_fit():
+    profile = MemoryProfile.fit([(100, 1100), (300, 1300)])
+    assert profile.base == pytest.approx(1000)
+    assert profile.per_pixel == pytest.approx(1)
+    assert profile.estimate((10, 20), batch_size=2) == 1400
+    # fixed input size
+    assert MemoryProfile.fit([(100, 1000), (100, 1200)]) == (1200, 0)
+
+
+def test_memory_budget():
+    budget = MemoryBudget(100)
+    order = []
+
+    def second():
+        with budget.reserve(60):
+            order.append("second")
+
+    with budget.reserve(60):
+        t = threading.Thread(target=second)
+        t.start()
+        time.sleep(0.05)
+        # waits for the first reservation
+        assert order == []
+        with pytest.raises(MemoryAdmissionError) as e:
+            with budget.reserve(60, block=False):
+                pass
+        assert e.value.retryable
+        order.append("first")
+    t.join()
+    assert order == ["first", "second"]
+    assert budget.used == 0
+
+    # larger than the budget, runs alone
+    with budget.reserve(1000):
+        assert budget.used == 100
+
+
+def test_admit():
+    model = ModelManager(name="cv2", device=torch.device("cpu")).model
+    img, mask = get_data()
+    controller = AdmissionController({"cpu": 50 * MB}, policy="queue")
+    config = get_config(HDStrategy.ORIGINAL)
+    # not calibrated
+    assert controller.admit(model, img, mask, config) is config
+
+    # 1MB for every 1000 pixels
+    controller.profiles["cv2:cpu:fp32"] = MemoryProfile(0, MB / 1000)
+    small = config.copy(
+        update={"hd_strategy": HDStrategy.RESIZE, "hd_strategy_resize_limit": 128}
+    )
+    assert controller.admit(model, img, mask, small) is small
+    with pytest.raises(MemoryAdmissionError) as e:
+        controller.admit(model, img, mask, config)
+    assert not e.value.retryable
+
+    controller.policy = "downgrade"
+    downgraded = controller.admit(model, img, mask, config)
+    assert downgraded.hd_strategy != HDStrategy.ORIGINAL
+    assert controller.estimate(model, img, mask, downgraded) <= 50 * MB
+
+
+@pytest.mark.parametrize("oom_fallback", [True, False])
+def test_oom_fallback(monkeypatch, oom_fallback):
+    manager = ModelManager(
+        name="cv2", device=torch.device("cpu"), oom_fallback=oom_fallback
+    )
+    model = manager.model
+    img, mask = get_data(fx=2, fy=2)
+    forward = model.forward
+    shapes = []
+
+    def _forward(image, mask, config):
+        shapes.append(image.shape[:2])
+        if image.shape[0] * image.shape[1] > 300 * 300:
+            raise RuntimeError("CUDA out of memory. Tried to allocate 2.00 GiB")
+        return forward(image, mask, config)
+
+    monkeypatch.setattr(model, "forward", _forward)
+    # mask of the whole image, crop strategy doesn't help
+    mask[:] = 255
+    config = get_config(HDStrategy.ORIGINAL, hd_strategy_resize_limit=2048)
+    scheduler = InferenceScheduler()
+    job = scheduler.submit(manager, img, mask, config)
+    if not oom_fallback:
+        with pytest.raises(RuntimeError):
+            job.result()
+        assert len(shapes) == 1
+        scheduler.shutdown()
+        return
+
+    result = job.result()
+    assert result.shape == img.shape
+    used = job.info["fallback_config"]
+    assert used.hd_strategy == HDStrategy.RESIZE
+    # ORIGINAL, CROP, then RESIZE 384, 288
+    assert [max(it) for it in shapes] == [512, 512, 384, 288]
+    assert used.hd_strategy_resize_limit == 288
+    scheduler.shutdown()
@@ -0,0 +1,55 @@
+import threading
+
+from lama_cleaner import metrics
+from lama_cleaner.metrics import Counter, Gauge, Histogram, Registry, StageTimes
+
+
+def test_render():
+    registry = Registry()
+    histogram = registry.register(
+        Histogram("test_seconds", "test histogram", ["stage"], buckets=[0.1, 1])
+    )
+    counter = registry.register(Counter("test_total", "test counter", ["model"]))
+    gauge = registry.register(Gauge("test_depth", "test gauge"))
+
+    histogram.observe(0.05, stage="decode")
+    histogram.observe(0.5, stage="decode")
+    histogram.observe(5, stage="decode")
+    counter.inc(model='a"b')
+    gauge.set_function(lambda: 3)
+
+    text = registry.render()
+    assert "# TYPE test_seconds histogram" in text
+    assert 'test_seconds_bucket{stage="decode",le="0.1"} 1.0' in text
+    assert 'test_seconds_bucket{stage="decode",le="1.0"} 2.0' in text
+    assert 'test_seconds_bucket{stage="decode",le="+Inf"} 3.0' in text
+    assert 'test_seconds_count{stage="decode"} 3.0' in text
+    assert 'test_seconds_sum{stage="decode"} 5.55' in text
+    assert 'test_total{model="a\\"b"} 1.0' in text
+    assert "test_depth 3.0" in text
+
+
+def test_stage_times_collect():
+    stage_times = StageTimes()
+
+    def _worker():
+        with metrics.collect(stage_times):
+            with metrics.timer("forward"):
+                pass
+            with metrics.timer("forward"):
+                pass
+        # not collected outside of collect()
+        with metrics.timer("encode"):
+            pass
+
+    thread = threading.Thread(target=_worker)
+    thread.start()
+    thread.join()
+    assert list(stage_times.stages) == ["forward"]
+
+    before = metrics.stage_seconds.count(stage="forward", model="test_model")
+    stage_times.observe(model="test_model")
+    assert metrics.stage_seconds.count(stage="forward", model="test_model") == (
+        before + 1
+    )
+    assert metrics.stage_seconds.count(stage="total", model="test_model") >= 1
@@ -1,9 +1,11 @@
 from pathlib import Path
 
 import cv2
+import numpy as np
 import pytest
 import torch
 
+from lama_cleaner.postprocess import blend_masked, match_histograms
 from lama_cleaner.model_manager import ModelManager
 from lama_cleaner.schema import Config, HDStrategy, LDMSampler, SDSampler
 
@@ -88,6 +90,31 @@ def test_lama(strategy):
     )
 
 
+def test_lama_onnxruntime(tmp_path):
+    pytest.importorskip("onnx")
+    pytest.importorskip("onnxruntime")
+    cfg = get_config(HDStrategy.ORIGINAL)
+    img, mask = get_data(fx=1.3)
+    torch_result = ModelManager(name="lama", device=device)(img, mask, cfg)
+
+    model = ModelManager(
+        name="lama",
+        device=device,
+        backend="onnxruntime",
+        onnx_model=tmp_path / "big-lama.onnx",
+        onnx_intra_op_threads=2,
+    )
+    assert (tmp_path / "big-lama.onnx").exists()
+    # dynamic height and width, the session is reused
+    for fx in [1, 1.3]:
+        img, mask = get_data(fx=fx)
+        result = model(img, mask, cfg)
+        assert result.shape == img.shape
+    diff = np.abs(result.astype(np.float32) - torch_result.astype(np.float32))
+    assert diff.mean() < 1
+    assert diff.max() <= 16
+
+
 @pytest.mark.parametrize(
     "strategy", [HDStrategy.ORIGINAL, HDStrategy.RESIZE, HDStrategy.CROP]
 )
@@ -192,3 +219,313 @@ def test_manga(strategy):
         img_p=current_dir / "overture-creations-5sI6fQgYIuo.png",
         mask_p=current_dir / "overture-creations-5sI6fQgYIuo_mask.png",
     )
+
+
+@pytest.mark.parametrize("strategy", [HDStrategy.ORIGINAL, HDStrategy.CROP])
+def test_cv2_batch(strategy):
+    model = ModelManager(
+        name="cv2",
+        device=torch.device(device),
+    )
+    cfg = get_config(strategy)
+    img, mask = get_data()
+    small_img, small_mask = get_data(fx=0.5, fy=0.5)
+    images = [img, small_img, img.copy()]
+    masks = [mask, small_mask, mask.copy()]
+
+    forward_batch_sizes = []
+    forward_batch = model.model.forward_batch
+
+    def _forward_batch(images, masks, config):
+        forward_batch_sizes.append(len(images))
+        return forward_batch(images, masks, config)
+
+    model.model.forward_batch = _forward_batch
+    results = model.inpaint_batch(images, masks, cfg)
+
+    assert len(results) == len(images)
+    for image, mask, result in zip(images, masks, results):
+        assert result.shape == image.shape
+        assert (result == model(image, mask, cfg)).all()
+
+    if strategy == HDStrategy.ORIGINAL:
+        assert sorted(forward_batch_sizes) == [1, 2]
+
+
+def test_cv2_incremental():
+    model = ModelManager(
+        name="cv2",
+        device=torch.device(device),
+    )
+    cfg = get_config(HDStrategy.CROP, hd_strategy_crop_trigger_size=0)
+    img, _ = get_data()
+    h, w = img.shape[:2]
+    mask1 = np.zeros((h, w), dtype=np.uint8)
+    mask1[10:40, 10:40] = 255
+    mask2 = mask1.copy()
+    mask2[h - 40 : h - 10, w - 40 : w - 10] = 255
+
+    run_box_count = 0
+    run_box = model.model._run_box
+
+    def _run_box(*args):
+        nonlocal run_box_count
+        run_box_count += 1
+        return run_box(*args)
+
+    model.model._run_box = _run_box
+
+    empty_mask = np.zeros_like(mask1)
+    result1 = model.incremental_call(img, mask1, empty_mask, img[:, :, ::-1], cfg)
+    assert run_box_count == 1
+    assert (result1 == model(img, mask1, cfg).astype(np.uint8)).all()
+
+    run_box_count = 0
+    result2 = model.incremental_call(img, mask2, mask1, result1, cfg)
+    assert run_box_count == 1
+    assert (result2[: h // 2, : w // 2] == result1[: h // 2, : w // 2]).all()
+    assert (result2[mask2 == 0] == img[:, :, ::-1][mask2 == 0]).all()
+
+    # erase the second stroke
+    run_box_count = 0
+    result3 = model.incremental_call(img, mask1, mask2, result2, cfg)
+    assert run_box_count == 0
+    assert (result3 == result1).all()
+
+
+@pytest.mark.parametrize("batch_size", [1, 3])
+def test_cv2_tile(batch_size):
+    model = ModelManager(
+        name="cv2",
+        device=torch.device(device),
+    )
+    cfg = get_config(
+        HDStrategy.TILE,
+        hd_strategy_tile_size=96,
+        hd_strategy_tile_overlap=32,
+        hd_strategy_tile_batch_size=batch_size,
+    )
+    img, mask = get_data()
+    h, w = img.shape[:2]
+    mask[:] = 0
+    mask[10:40, 10:40] = 255
+    mask[h - 40 : h - 10, w - 40 : w - 10] = 255
+
+    forward_shapes = []
+    forward = model.model.forward
+
+    def _forward(image, mask, config):
+        forward_shapes.append(image.shape[:2])
+        # identity, overlapping tiles must blend back into the input
+        return image[:, :, ::-1]
+
+    model.model.forward = _forward
+    result = model(img, mask, cfg)
+    # tiles start at 0, 64, 128, 160, the second stroke is in 2x2 tiles
+    assert len(forward_shapes) == 5
+    assert all(it == (96, 96) for it in forward_shapes)
+    np.testing.assert_allclose(result, img[:, :, ::-1], atol=1e-3)
+    assert model.model.forward_shapes(img, mask, cfg) == forward_shapes
+
+    model.model.forward = forward
+    result = model(img, mask, cfg)
+    assert result.shape == img.shape
+    assert (result[mask == 0] == img[:, :, ::-1][mask == 0]).all()
+
+
+def test_tile_size():
+    model = ModelManager(name="cv2", device=torch.device(device)).model
+    for kwargs in [
+        dict(hd_strategy_tile_size=0),
+        dict(hd_strategy_tile_size=63),
+        dict(hd_strategy_tile_size=64, hd_strategy_tile_overlap=64),
+        dict(hd_strategy_tile_overlap=-1),
+        dict(hd_strategy_tile_batch_size=0),
+    ]:
+        with pytest.raises(ValueError):
+            get_config(HDStrategy.TILE, **kwargs).check_hd_strategy()
+    get_config(
+        HDStrategy.TILE, hd_strategy_tile_size=64, hd_strategy_tile_overlap=0
+    ).check_hd_strategy()
+
+    # configs not from the server are clamped by the model
+    cfg = get_config(
+        HDStrategy.TILE, hd_strategy_tile_size=0, hd_strategy_tile_overlap=0
+    )
+    assert model._tile_size(cfg) == 64
+    model.pad_mod = 48
+    assert model._tile_size(cfg) == 96
+    # tiles start at 0, 96, 104
+    assert len(model._tile_boxes(200, 200, cfg)) == 9
+
+
+def test_tile_mask_threshold():
+    model = ModelManager(name="cv2", device=torch.device(device)).model
+    cfg = get_config(
+        HDStrategy.TILE, hd_strategy_tile_size=64, hd_strategy_tile_overlap=0
+    )
+    mask = np.zeros((128, 128), dtype=np.uint8)
+    # below the threshold of blending, not inpainted
+    mask[:64, :64] = 127
+    mask[100:110, 100:110] = 255
+    assert model._masked_tile_boxes(mask, cfg) == [[64, 64, 128, 128]]
+
+
+def test_cv2_crop_plan():
+    model = ModelManager(
+        name="cv2",
+        device=torch.device(device),
+    )
+    cfg = get_config(
+        HDStrategy.CROP, hd_strategy_crop_trigger_size=0, hd_strategy_crop_batch_size=4
+    )
+    img, mask = get_data(fx=4, fy=4)
+    mask[:] = 0
+    # a cluster of specks and two far away strokes
+    for i in range(40):
+        x, y = 100 + (i % 8) * 12, 100 + (i // 8) * 12
+        mask[y : y + 4, x : x + 4] = 255
+    mask[600:620, 900:920] = 255
+    mask[900:920, 600:620] = 255
+
+    windows = model.model._plan_crop_boxes(mask, cfg)
+    assert len(windows) == 3
+    for l, t, r, b in windows:
+        assert (b - t) % 64 == 0 and (r - l) % 64 == 0
+    covered = np.zeros_like(mask)
+    for l, t, r, b in windows:
+        covered[t:b, l:r] = 255
+    assert (covered[mask > 0] > 0).all()
+
+    forward_batch_sizes = []
+    forward_batch = model.model.forward_batch
+
+    def _forward_batch(images, masks, config):
+        forward_batch_sizes.append(len(images))
+        return forward_batch(images, masks, config)
+
+    model.model.forward_batch = _forward_batch
+    result = model(img, mask, cfg)
+    # two far away strokes have the same crop size
+    assert sorted(forward_batch_sizes) == [1, 2]
+    assert (result[mask == 0] == img[:, :, ::-1][mask == 0]).all()
+
+
+def test_cv2_pyramid():
+    model = ModelManager(
+        name="cv2",
+        device=torch.device(device),
+    )
+    cfg = get_config(
+        HDStrategy.PYRAMID,
+        hd_strategy_resize_limit=256,
+        hd_strategy_tile_size=256,
+        hd_strategy_pyramid_band=32,
+    )
+    img, mask = get_data(fx=4, fy=4)
+    mask[:] = 0
+    mask[100:900, 100:900] = 255
+
+    forward_shapes = []
+    forward = model.model.forward
+
+    def _forward(image, mask, config):
+        forward_shapes.append(image.shape[:2])
+        return forward(image, mask, config)
+
+    model.model.forward = _forward
+    result = model(img, mask, cfg)
+    assert result.shape == img.shape
+    assert forward_shapes[0] == (256, 256)
+    # tiles start at 0, 128, ..., 768, 3x3 tiles inside the mask are not refined
+    assert len(forward_shapes) == 1 + 7 * 7 - 3 * 3
+    assert model.model.forward_shapes(img, mask, cfg) == forward_shapes
+    assert (result[mask == 0] == img[:, :, ::-1][mask == 0]).all()
+
+
+def test_cv2_shape_buckets():
+    model = ModelManager(
+        name="cv2",
+        device=torch.device(device),
+        shape_buckets=[100, 256, 384],
+    )
+    cfg = get_config(HDStrategy.ORIGINAL)
+    assert model.model.padded_shape(90, 101) == (100, 256)
+    # larger than all buckets
+    assert model.model.padded_shape(300, 500) == (384, 500)
+
+    forward_shapes = []
+    forward = model.model.forward
+
+    def _forward(image, mask, config):
+        forward_shapes.append(image.shape[:2])
+        return forward(image, mask, config)
+
+    model.model.forward = _forward
+    for fx, fy in [(0.7, 0.8), (0.8, 0.9), (0.3, 0.9)]:
+        img, mask = get_data(fx=fx, fy=fy)
+        result = model(img, mask, cfg)
+        assert result.shape == img.shape
+    assert forward_shapes == [(256, 256), (256, 256), (256, 100)]
+    assert model.model.shape_stats() == {"256x256": 2, "256x100": 1}
+
+
+@pytest.mark.parametrize("blur", [0, 5])
+def test_blend_masked(blur):
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 256, (120, 160, 3), dtype=np.uint8)
+    result = rng.integers(0, 256, (120, 160, 3), dtype=np.uint8)
+    mask = np.zeros((120, 160), dtype=np.uint8)
+    mask[30:50, 40:70] = 255
+    # touches the border
+    mask[100:, 150:] = 128
+
+    blended = blend_masked(result, img, mask, blur)
+    assert blended.dtype == np.uint8
+
+    if blur:
+        mask = cv2.GaussianBlur(mask, (2 * blur + 1, 2 * blur + 1), 0)
+    mask = mask[:, :, np.newaxis]
+    expected = result * (mask / 255) + img[:, :, ::-1] * (1 - (mask / 255))
+    assert np.abs(blended.astype(np.int32) - expected.astype(np.uint8)).max() <= 1
+    assert (blended[mask[:, :, 0] == 0] == img[:, :, ::-1][mask[:, :, 0] == 0]).all()
+
+    empty = np.zeros_like(mask[:, :, 0])
+    assert (blend_masked(result, img, empty, blur) == img[:, :, ::-1]).all()
+
+
+def _match_histograms_loop(source, reference, mask):
+    channels = []
+    for c in range(source.shape[-1]):
+        source_hist, _ = np.histogram(source[:, :, c][mask == 0], 256, [0, 256])
+        reference_hist, _ = np.histogram(reference[:, :, c][mask == 0], 256, [0, 256])
+        source_cdf = source_hist.cumsum() / source_hist.sum()
+        reference_cdf = reference_hist.cumsum() / reference_hist.sum()
+        lookup = np.zeros(256, dtype=np.uint8)
+        for i, it in enumerate(source_cdf):
+            lookup[i] = next(j for j, ref in enumerate(reference_cdf) if ref >= it)
+        channels.append(lookup[source[:, :, c]])
+    return np.stack(channels, axis=-1)
+
+
+@pytest.mark.parametrize("margin", [0, 5])
+def test_match_histograms(margin):
+    rng = np.random.default_rng(0)
+    img = rng.integers(0, 256, (120, 160, 3), dtype=np.uint8)
+    # darker and lower contrast
+    result = (rng.integers(0, 256, (120, 160, 3)) // 3 + 20).astype(np.uint8)
+    mask = np.zeros((120, 160), dtype=np.uint8)
+    mask[30:50, 40:70] = 255
+
+    reference = img[:, :, ::-1]
+    matched = match_histograms(result, reference, mask, margin=margin)
+    expected = _match_histograms_loop(result, reference, mask)
+    box = (slice(30 - margin, 50 + margin), slice(40 - margin, 70 + margin))
+    assert (matched[box] == expected[box]).all()
+    # outside the box is left as is, blending copies it from the image
+    outside = np.ones(mask.shape, dtype=bool)
+    outside[box] = False
+    assert (matched[outside] == result[outside]).all()
+
+    mask[:] = 255
+    assert match_histograms(result, reference, mask) is result
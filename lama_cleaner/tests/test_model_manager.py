@@ -0,0 +1,89 @@
+import pytest
+import torch
+
+from lama_cleaner import model_manager
+from lama_cleaner.model.base import InpaintModel
+from lama_cleaner.model_manager import ModelManager, model_footprint
+
+MB = 1024 * 1024
+
+
+class FakeModel(InpaintModel):
+    name = "fake"
+    num_init = 0
+
+    def init_model(self, device, **kwargs):
+        FakeModel.num_init += 1
+        # 1MB of float32 parameters
+        self.model = torch.nn.Linear(512, 512, bias=False)
+
+    @staticmethod
+    def is_downloaded() -> bool:
+        return True
+
+    def forward(self, image, mask, config):
+        return image[:, :, ::-1]
+
+
+class BrokenModel(FakeModel):
+    def init_model(self, device, **kwargs):
+        raise RuntimeError("download failed")
+
+
+@pytest.fixture
+def fake_models(monkeypatch):
+    for name in ["fake1", "fake2", "fake3"]:
+        monkeypatch.setitem(model_manager.models, name, FakeModel)
+    monkeypatch.setitem(model_manager.models, "broken", BrokenModel)
+    FakeModel.num_init = 0
+
+
+def test_model_footprint():
+    model = FakeModel(torch.device("cpu"))
+    assert model_footprint(model) == MB
+
+
+def test_switch_without_cache(fake_models):
+    model = ModelManager(name="fake1", device=torch.device("cpu"))
+    model.switch("fake2")
+    model.switch("fake1")
+    assert FakeModel.num_init == 3
+    assert [it["name"] for it in model.resident_models()] == ["fake1"]
+
+
+def test_switch_resident_models(fake_models):
+    model = ModelManager(
+        name="fake1", device=torch.device("cpu"), model_cache_size=2 * MB
+    )
+    model.switch("fake2")
+    fake2 = model.model
+    model.switch("fake1")
+    model.switch("fake2")
+    assert model.model is fake2
+    assert FakeModel.num_init == 2
+
+    # fake1 is least recently used
+    model.switch("fake3")
+    assert FakeModel.num_init == 3
+    assert model.resident_models() == [
+        {"name": "fake2", "size": MB, "current": False},
+        {"name": "fake3", "size": MB, "current": True},
+    ]
+
+    model.switch("cv2")
+    assert model.name == "cv2"
+    assert len(model.resident_models()) == 3
+
+
+@pytest.mark.parametrize("model_cache_size", [0, 2 * MB])
+def test_switch_failed(fake_models, model_cache_size):
+    model = ModelManager(
+        name="fake1", device=torch.device("cpu"), model_cache_size=model_cache_size
+    )
+    with pytest.raises(RuntimeError):
+        model.switch("broken")
+    # the current model is kept, or loaded again if it was evicted to make room
+    assert model.name == "fake1"
+    assert isinstance(model.model, FakeModel)
+    assert [it["name"] for it in model.resident_models()] == ["fake1"]
+    assert FakeModel.num_init == (2 if model_cache_size == 0 else 1)
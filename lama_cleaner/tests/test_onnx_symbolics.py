@@ -0,0 +1,55 @@
+import numpy as np
+import pytest
+import torch
+
+from lama_cleaner.onnx_symbolics import register_fft_symbolics
+
+
+class FourierUnit(torch.nn.Module):
+    """Same FFT ops as FourierUnit of big-lama"""
+
+    def __init__(self):
+        super().__init__()
+        self.conv = torch.nn.Conv2d(4, 4, 1)
+
+    def forward(self, x):
+        b, c, h, w = x.shape
+        ffted = torch.fft.rfftn(x, dim=(-2, -1), norm="ortho")
+        ffted = torch.stack((ffted.real, ffted.imag), dim=-1)
+        ffted = ffted.permute(0, 1, 4, 2, 3).contiguous()
+        ffted = self.conv(ffted.view(b, -1, h, ffted.shape[-1]))
+        ffted = ffted.view(b, c, 2, h, -1).permute(0, 1, 3, 4, 2).contiguous()
+        ffted = torch.complex(ffted[..., 0], ffted[..., 1])
+        return torch.fft.irfftn(ffted, s=(h, w), dim=(-2, -1), norm="ortho")
+
+
+def test_fft_symbolics(tmp_path):
+    pytest.importorskip("onnx")
+    ort = pytest.importorskip("onnxruntime")
+    register_fft_symbolics(17)
+    model = torch.jit.script(FourierUnit().eval())
+    output = str(tmp_path / "fourier_unit.onnx")
+    dynamic_axes = {0: "batch", 2: "height", 3: "width"}
+    with torch.no_grad():
+        torch.onnx.export(
+            model,
+            (torch.rand(1, 2, 64, 64),),
+            output,
+            input_names=["x"],
+            output_names=["y"],
+            dynamic_axes={"x": dynamic_axes, "y": dynamic_axes},
+            opset_version=17,
+            dynamo=False,
+        )
+    session = ort.InferenceSession(output, providers=["CPUExecutionProvider"])
+    # odd width rebuilds the spectrum without a nyquist column
+    for shape in [(1, 2, 64, 64), (2, 2, 40, 56), (1, 2, 24, 35)]:
+        x = torch.randn(*shape)
+        with torch.no_grad():
+            expected = model(x).numpy()
+        result = session.run(None, {"x": x.numpy()})[0]
+        assert result.shape == expected.shape
+        assert np.abs(result - expected).max() < 1e-4
+
+    with pytest.raises(ValueError):
+        register_fft_symbolics(16)
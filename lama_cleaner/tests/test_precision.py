@@ -0,0 +1,103 @@
+import pytest
+import torch
+
+from lama_cleaner import precision
+from lama_cleaner.model import lama
+from lama_cleaner.model_manager import ModelManager
+from lama_cleaner.precision import check_parity, keep_fp32, resolve_precision
+from lama_cleaner.schema import HDStrategy
+from lama_cleaner.tests.test_model import get_config, get_data
+
+cpu = torch.device("cpu")
+cuda = torch.device("cuda")
+supported = {"cuda": ("fp16", "bf16"), "cpu": ("bf16",)}
+
+
+@pytest.mark.parametrize("cpu_bf16", [True, False])
+def test_resolve_precision(monkeypatch, cpu_bf16):
+    monkeypatch.setattr(precision, "cpu_supports_bf16", lambda: cpu_bf16)
+    cpu_bf16_precision = "bf16" if cpu_bf16 else "fp32"
+    # models opt in to bf16 on cpu
+    assert resolve_precision("auto", cpu, supported) == "fp32"
+    assert (
+        resolve_precision("auto", cpu, supported, cpu_auto_bf16=True)
+        == cpu_bf16_precision
+    )
+    assert (
+        resolve_precision("auto", cpu, supported, cpu_auto_bf16=True, no_half=True)
+        == "fp32"
+    )
+    assert resolve_precision("bf16", cpu, supported) == cpu_bf16_precision
+    # fp16 is cuda only, models without bf16 support fall back to fp32
+    assert resolve_precision("fp16", cpu, supported) == "fp32"
+    assert resolve_precision("bf16", cpu, {"cuda": ("fp16",)}) == "fp32"
+    assert resolve_precision("fp32", cpu, supported) == "fp32"
+
+    assert resolve_precision("auto", cuda, supported, cuda_half=True) == "fp16"
+    assert resolve_precision("auto", cuda, supported) == "fp32"
+    assert resolve_precision("auto", cuda, {}, cuda_half=True) == "fp32"
+    with pytest.raises(ValueError):
+        resolve_precision("int8", cpu, supported)
+
+
+class Spectral(torch.nn.Module):
+    def forward(self, x):
+        assert x.dtype == torch.float32
+        return torch.fft.rfft2(x).abs()
+
+
+def test_keep_fp32():
+    model = torch.nn.Sequential(torch.nn.Conv2d(3, 3, 3), Spectral())
+    x = torch.rand(1, 3, 16, 16)
+    with precision.autocast(cpu, "bf16"):
+        with pytest.raises(AssertionError):
+            model(x)
+
+    assert keep_fp32(model, ["Spectral"]) == 1
+    with precision.autocast(cpu, "bf16"):
+        output = model(x)
+    assert output.dtype == torch.float32
+    assert torch.allclose(output, model(x), rtol=0.1, atol=0.5)
+
+
+def test_model_precision():
+    # cv2 doesn't run on torch, always fp32
+    model = ModelManager(name="cv2", device=cpu, precision="bf16")
+    assert model.model.precision == "fp32"
+
+    reference = ModelManager(name="cv2", device=cpu, precision="fp32")
+    img, mask = get_data()
+    stats = check_parity(
+        reference, model, img, mask, get_config(HDStrategy.ORIGINAL), runs=1
+    )
+    assert stats["mean_diff"] == 0
+    assert stats["time"] > 0
+
+
+class TinyLaMa(torch.nn.Module):
+    """Stands in for big-lama.pt, its output keeps the autocast dtype"""
+
+    def __init__(self):
+        super().__init__()
+        self.conv = torch.nn.Conv2d(4, 3, 3, padding=1)
+
+    def forward(self, image, mask):
+        return torch.sigmoid(self.conv(torch.cat([image, mask], dim=1)))
+
+
+def test_model_bf16_forward(monkeypatch, tmp_path):
+    monkeypatch.setattr(precision, "cpu_supports_bf16", lambda: True)
+    model_path = str(tmp_path / "tiny-lama.pt")
+    torch.jit.script(TinyLaMa().eval()).save(model_path)
+    monkeypatch.setattr(lama, "LAMA_MODEL_URL", model_path)
+
+    reference = ModelManager(name="lama", device=cpu, precision="fp32")
+    model = ModelManager(name="lama", device=cpu, precision="bf16")
+    model.model.model = reference.model.model
+    assert model.model.precision == "bf16"
+
+    img, mask = get_data()
+    stats = check_parity(
+        reference, model, img, mask, get_config(HDStrategy.ORIGINAL), runs=1
+    )
+    assert 0 < stats["mean_diff"] < 2
@@ -0,0 +1,80 @@
+import numpy as np
+
+from lama_cleaner.result_cache import ResultCache, make_cache_key
+from lama_cleaner.schema import Config, HDStrategy
+
+
+def get_config(**kwargs):
+    data = dict(
+        ldm_steps=1,
+        hd_strategy=HDStrategy.ORIGINAL,
+        hd_strategy_crop_margin=32,
+        hd_strategy_crop_trigger_size=200,
+        hd_strategy_resize_limit=200,
+    )
+    data.update(**kwargs)
+    return Config(**data)
+
+
+def test_cache_key():
+    image = np.random.randint(0, 255, (64, 64, 3), dtype=np.uint8)
+    mask = np.zeros((64, 64), dtype=np.uint8)
+    key = make_cache_key(image, mask, "lama", get_config(), ext="png")
+
+    assert key == make_cache_key(image.copy(), mask, "lama", get_config(), ext="png")
+    # seed is not used by lama
+    assert key == make_cache_key(image, mask, "lama", get_config(sd_seed=1), ext="png")
+    assert key != make_cache_key(image, mask, "lama", get_config(), ext="jpeg")
+    assert key != make_cache_key(image, mask, "ldm", get_config(), ext="png")
+    assert key != make_cache_key(
+        image, mask, "lama", get_config(hd_strategy=HDStrategy.CROP), ext="png"
+    )
+    mask[0, 0] = 255
+    assert key != make_cache_key(image, mask, "lama", get_config(), ext="png")
+
+    sd_key = make_cache_key(image, mask, "sd1.5", get_config(sd_seed=1))
+    assert sd_key != make_cache_key(image, mask, "sd1.5", get_config(sd_seed=2))
+
+
+def test_lru_eviction():
+    cache = ResultCache(max_bytes=10)
+    cache.put("a", b"1234", "image/png")
+    cache.put("b", b"1234", "image/png")
+    assert cache.get("a").data == b"1234"
+
+    cache.put("c", b"1234", "image/png")
+    assert cache.get("b") is None
+    assert cache.get("a") is not None
+    assert cache.get("c") is not None
+
+    # larger than max_bytes, never cached
+    cache.put("d", b"12345678901", "image/png")
+    assert cache.get("d") is None
+
+    stats = cache.stats()
+    assert stats["hits"] == 3
+    assert stats["misses"] == 2
+    assert stats["evictions"] == 1
+    assert stats["bytes"] == 8
+    assert len(cache) == 2
+
+
+def test_cached_image():
+    image = np.zeros((2, 2, 3), dtype=np.uint8)
+    cache = ResultCache(max_bytes=18)
+    cache.put("a", b"1234", "image/png", image)
+    assert cache.get("a").image is image
+    # encoded and decoded bytes count against max_bytes
+    assert cache.stats()["bytes"] == 16
+    cache.put("b", b"1234", "image/png")
+    assert cache.get("a") is None
+
+
+def test_cached_config():
+    cache = ResultCache(max_bytes=1024)
+    # result of a request which fell back to resize strategy
+    used = get_config(hd_strategy=HDStrategy.RESIZE)
+    cache.put("a", b"1234", "image/png", config=used)
+    assert cache.get("a").config is used
+    cache.put("b", b"1234", "image/png")
+    assert cache.get("b").config is None
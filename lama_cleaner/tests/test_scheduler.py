@@ -0,0 +1,137 @@
+import threading
+import time
+
+import pytest
+import torch
+
+from lama_cleaner.model_manager import ModelManager
+from lama_cleaner.scheduler import (
+    InferenceScheduler,
+    JobCancelledError,
+    QueueFullError,
+    check_cancelled,
+)
+from lama_cleaner.schema import HDStrategy
+from lama_cleaner.tests.test_model import get_config, get_data
+
+
+def test_jobs_are_serialized():
+    scheduler = InferenceScheduler(max_queue_size=0, num_workers=1)
+    lock = threading.Lock()
+    running = []
+    max_running = []
+
+    def work(i):
+        with lock:
+            running.append(i)
+            max_running.append(len(running))
+        time.sleep(0.01)
+        with lock:
+            running.remove(i)
+        return i * 2
+
+    jobs = [scheduler.submit(work, i) for i in range(10)]
+    assert [job.result() for job in jobs] == [i * 2 for i in range(10)]
+    assert max(max_running) == 1
+    scheduler.shutdown()
+
+
+def test_queue_full():
+    scheduler = InferenceScheduler(max_queue_size=1, num_workers=1)
+    started = threading.Event()
+    release = threading.Event()
+
+    def block():
+        started.set()
+        release.wait()
+
+    running_job = scheduler.submit(block)
+    started.wait()
+    queued_job = scheduler.submit(lambda: "ok")
+    assert scheduler.depth == 1
+
+    with pytest.raises(QueueFullError):
+        scheduler.submit(lambda: "rejected")
+
+    release.set()
+    running_job.result()
+    assert queued_job.result() == "ok"
+    assert queued_job.wait_time > 0
+    scheduler.shutdown()
+
+
+def test_job_error():
+    scheduler = InferenceScheduler()
+
+    def fail():
+        raise RuntimeError("CUDA out of memory. ")
+
+    with pytest.raises(RuntimeError):
+        scheduler.run(fail)
+
+    assert scheduler.run(lambda a, b=0: a + b, 1, b=2) == 3
+    stats = scheduler.stats()
+    assert stats["depth"] == 0
+    assert stats["running"] == 0
+    scheduler.shutdown()
+
+
+def test_cancel():
+    scheduler = InferenceScheduler(max_queue_size=0, num_workers=1)
+    started = threading.Event()
+    steps = []
+
+    def sample():
+        started.set()
+        for i in range(1000):
+            check_cancelled()
+            steps.append(i)
+            time.sleep(0.01)
+
+    running_job = scheduler.submit(sample, job_id="running")
+    queued_job = scheduler.submit(lambda: steps.append("queued"), job_id="queued")
+    with pytest.raises(ValueError):
+        scheduler.submit(lambda: None, job_id="queued")
+
+    started.wait()
+    assert scheduler.cancel("queued")
+    assert scheduler.cancel("running")
+    with pytest.raises(JobCancelledError):
+        running_job.result(timeout=1)
+    with pytest.raises(JobCancelledError):
+        queued_job.result(timeout=1)
+    assert len(steps) < 1000
+    assert "queued" not in steps
+
+    assert not scheduler.cancel("running")
+    # outside of a job
+    check_cancelled()
+    scheduler.shutdown()
+
+
+def test_cancel_between_crop_boxes(monkeypatch):
+    scheduler = InferenceScheduler(max_queue_size=0, num_workers=1)
+    model = ModelManager(name="cv2", device=torch.device("cpu"))
+    img, mask = get_data()
+    mask[:] = 0
+    mask[10:20, 10:20] = 255
+    mask[100:110, 100:110] = 255
+    mask[200:210, 200:210] = 255
+
+    run_boxes = model.model._run_boxes
+    boxes = []
+
+    def _run_boxes(*args, **kwargs):
+        boxes.append(args[2])
+        scheduler.cancel("crop")
+        return run_boxes(*args, **kwargs)
+
+    monkeypatch.setattr(model.model, "_run_boxes", _run_boxes)
+    config = get_config(
+        HDStrategy.CROP, hd_strategy_crop_trigger_size=0, hd_strategy_crop_batch_size=1
+    )
+    job = scheduler.submit(model, img, mask, config, job_id="crop")
+    with pytest.raises(JobCancelledError):
+        job.result(timeout=10)
+    assert len(boxes) == 1
+    scheduler.shutdown()
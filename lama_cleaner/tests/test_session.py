@@ -0,0 +1,35 @@
+import time
+
+import numpy as np
+
+from lama_cleaner.session import SessionStore
+
+
+def _create(store):
+    image = np.zeros((8, 8, 3), dtype=np.uint8)
+    return store.create(image, None, {"exif": None, "parameters": None}, "png")
+
+
+def test_session_lru():
+    store = SessionStore(max_sessions=2)
+    s1 = _create(store)
+    s2 = _create(store)
+    assert store.get(s1.id) is s1
+
+    s3 = _create(store)
+    assert store.get(s2.id) is None
+    assert store.get(s1.id) is s1
+    assert store.get(s3.id) is s3
+
+    assert store.delete(s1.id)
+    assert not store.delete(s1.id)
+    assert len(store) == 1
+
+
+def test_session_ttl():
+    store = SessionStore(ttl=0.05)
+    session = _create(store)
+    session.update(np.ones((8, 8, 3), dtype=np.uint8))
+    assert store.get(session.id).image.sum() == 8 * 8 * 3
+    time.sleep(0.1)
+    assert store.get(session.id) is None
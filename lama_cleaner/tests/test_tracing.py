@@ -0,0 +1,82 @@
+import json
+
+import torch
+
+from lama_cleaner import tracing
+from lama_cleaner.model_manager import ModelManager
+from lama_cleaner.scheduler import InferenceScheduler
+from lama_cleaner.schema import HDStrategy
+from lama_cleaner.tests.test_model import get_config, get_data
+from lama_cleaner.tracing import Trace, TraceStore
+
+
+def _event_names(trace: Trace):
+    return [it[0] for it in trace.events]
+
+
+def test_span_without_trace():
+    assert tracing.current() is None
+    with tracing.span("noop"):
+        pass
+
+
+def test_span():
+    trace = Trace("test")
+    with tracing.activate(trace):
+        with tracing.span("outer", size=512):
+            with tracing.span("inner"):
+                pass
+    assert tracing.current() is None
+    assert _event_names(trace) == ["inner", "outer"]
+
+    chrome_trace = json.loads(json.dumps(trace.to_chrome_trace()))
+    events = [it for it in chrome_trace["traceEvents"] if it["ph"] == "X"]
+    outer = next(it for it in events if it["name"] == "outer")
+    inner = next(it for it in events if it["name"] == "inner")
+    assert outer["args"] == {"size": 512}
+    assert outer["ts"] <= inner["ts"]
+    assert inner["ts"] + inner["dur"] <= outer["ts"] + outer["dur"]
+    assert chrome_trace["otherData"]["id"] == trace.id
+
+
+def test_scheduler_propagates_trace():
+    scheduler = InferenceScheduler(max_queue_size=0, num_workers=1)
+
+    @tracing.traced("job")
+    def _job():
+        return tracing.current()
+
+    trace = Trace("test")
+    with tracing.activate(trace):
+        assert scheduler.run(_job) is trace
+    assert scheduler.run(_job) is None
+    scheduler.shutdown()
+
+    assert _event_names(trace) == ["job"]
+    # recorded on the worker thread
+    assert trace.events[0][4] == "inference-worker-0"
+
+
+def test_trace_store():
+    store = TraceStore(max_traces=2)
+    traces = [Trace(str(i)) for i in range(3)]
+    for it in traces:
+        store.put(it)
+    assert store.get(traces[0].id) is None
+    assert store.get(traces[2].id) is traces[2]
+
+
+def test_model_spans(tmp_path):
+    model = ModelManager(name="cv2", device=torch.device("cpu"))
+    img, mask = get_data(fx=1, fy=1)
+    trace = Trace("test")
+    with tracing.activate(trace):
+        model(img, mask, get_config(HDStrategy.CROP, hd_strategy_crop_trigger_size=0))
+
+    names = _event_names(trace)
+    assert "InpaintModel.__call__" in names
+    assert "run_boxes" in names
+    assert "pad_forward_batch" in names
+
+    path = trace.dump(tmp_path)
+    assert json.loads(path.read_text())["otherData"]["name"] == "test"
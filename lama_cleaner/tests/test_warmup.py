@@ -0,0 +1,35 @@
+import torch
+
+from lama_cleaner.model_manager import ModelManager
+from lama_cleaner.schema import HDStrategy
+from lama_cleaner.warmup import warmup
+
+
+def test_warmup():
+    model = ModelManager(name="cv2", device=torch.device("cpu"))
+    calls = []
+    configs = []
+    model_call = model.model.__call__
+
+    def _call(image, mask, config):
+        calls.append((image.shape[:2], config.hd_strategy))
+        configs.append(config)
+        return model_call(image, mask, config)
+
+    model.model = _call
+    warmup(
+        model,
+        sizes=[(64, 96), (128, 128)],
+        hd_strategies=[HDStrategy.ORIGINAL, HDStrategy.CROP],
+        times=2,
+    )
+    assert len(calls) == 8
+    assert calls[:4] == [
+        ((64, 96), HDStrategy.ORIGINAL),
+        ((64, 96), HDStrategy.ORIGINAL),
+        ((64, 96), HDStrategy.CROP),
+        ((64, 96), HDStrategy.CROP),
+    ]
+    # same hd strategy settings as real requests
+    assert configs[-1].hd_strategy_crop_trigger_size == 800
+    assert configs[-1].hd_strategy_resize_limit == 2048
@@ -0,0 +1,156 @@
+"""
+Per-request tracing, dumped in Chrome trace format(open with chrome://tracing or
+https://ui.perfetto.dev)
+
+Spans are only recorded when a trace is activated for the current context, otherwise
+span() costs one ContextVar lookup. InferenceScheduler runs jobs in the context of
+the submitting thread, so spans on the inference worker go to the request's trace.
+"""
+
+import collections
+import contextlib
+import contextvars
+import functools
+import json
+import os
+import threading
+import time
+import uuid
+from pathlib import Path
+from typing import Optional
+
+_current_trace: contextvars.ContextVar = contextvars.ContextVar(
+    "lama_cleaner_trace", default=None
+)
+
+
+class Trace:
+    def __init__(self, name: str):
+        self.id = uuid.uuid4().hex
+        self.name = name
+        self.start = time.perf_counter()
+        self.events = []
+        self._lock = threading.Lock()
+
+    def add_event(self, name: str, start: float, end: float, args: dict):
+        """start, end: time.perf_counter()"""
+        thread = threading.current_thread()
+        with self._lock:
+            self.events.append(
+                (name, start - self.start, end - start, thread.ident, thread.name, args)
+            )
+
+    def to_chrome_trace(self) -> dict:
+        pid = os.getpid()
+        with self._lock:
+            events = list(self.events)
+
+        trace_events = []
+        thread_names = {}
+        for name, start, duration, tid, thread_name, args in events:
+            thread_names[tid] = thread_name
+            trace_events.append(
+                {
+                    "name": name,
+                    "ph": "X",
+                    "ts": start * 1e6,
+                    "dur": duration * 1e6,
+                    "pid": pid,
+                    "tid": tid,
+                    "args": args,
+                }
+            )
+        for tid, thread_name in thread_names.items():
+            trace_events.append(
+                {
+                    "name": "thread_name",
+                    "ph": "M",
+                    "pid": pid,
+                    "tid": tid,
+                    "args": {"name": thread_name},
+                }
+            )
+        return {
+            "traceEvents": trace_events,
+            "displayTimeUnit": "ms",
+            "otherData": {"id": self.id, "name": self.name},
+        }
+
+    def dump(self, trace_dir) -> Path:
+        path = Path(trace_dir) / f"{self.id}.json"
+        path.write_text(json.dumps(self.to_chrome_trace()))
+        return path
+
+
+class TraceStore:
+    """Keep the latest traces in memory"""
+
+    def __init__(self, max_traces: int = 32):
+        self._traces: "collections.OrderedDict[str, Trace]" = collections.OrderedDict()
+        self.max_traces = max_traces
+        self._lock = threading.Lock()
+
+    def put(self, trace: Trace):
+        with self._lock:
+            self._traces[trace.id] = trace
+            while len(self._traces) > self.max_traces:
+                self._traces.popitem(last=False)
+
+    def get(self, trace_id: str) -> Optional[Trace]:
+        with self._lock:
+            return self._traces.get(trace_id)
+
+
+def current() -> Optional[Trace]:
+    return _current_trace.get()
+
+
+@contextlib.contextmanager
+def activate(trace: Optional[Trace]):
+    """Record spans of the current context to trace"""
+    token = _current_trace.set(trace)
+    try:
+        yield trace
+    finally:
+        _current_trace.reset(token)
+
+
+@contextlib.contextmanager
+def span(name: str, device=None, **args):
+    """
+    Args:
+        name:
+        device: torch device, cuda is synchronized before the span ends, so the span
+            includes the kernels launched in it. Only when tracing is enabled
+        **args: shown in the trace viewer
+    """
+    trace = _current_trace.get()
+    if trace is None:
+        yield
+        return
+
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        if device is not None and getattr(device, "type", device) == "cuda":
+            import torch
+
+            torch.cuda.synchronize(device)
+        trace.add_event(name, start, time.perf_counter(), args)
+
+
+def traced(name: str):
+    """Decorator, record each call of the function as a span"""
+
+    def decorator(fn):
+        @functools.wraps(fn)
+        def wrapper(*args, **kwargs):
+            if _current_trace.get() is None:
+                return fn(*args, **kwargs)
+            with span(name):
+                return fn(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,72 @@
+import time
+from typing import List, Tuple
+
+import numpy as np
+from loguru import logger
+
+from lama_cleaner.schema import Config, HDStrategy, SDSampler
+
+
+def run_model(model, size, hd_strategy: HDStrategy = HDStrategy.ORIGINAL):
+    """
+    Run model on a random image
+
+    Args:
+        model: ModelManager
+        size: (height, width)
+        hd_strategy:
+    """
+    # RGB
+    image = np.random.randint(0, 256, (size[0], size[1], 3)).astype(np.uint8)
+    # one stroke in the center, crop strategy runs on a single box like a real request
+    mask = np.zeros(size, dtype=np.uint8)
+    h, w = size
+    mask[h // 4 : h * 3 // 4, w // 4 : w * 3 // 4] = 255
+
+    # defaults of the web app and batch processing, so resize/crop/pyramid warm up
+    # the shapes real requests run, original strategy doesn't use them
+    config = Config(
+        ldm_steps=2,
+        hd_strategy=hd_strategy,
+        hd_strategy_crop_margin=196,
+        hd_strategy_crop_trigger_size=800,
+        hd_strategy_resize_limit=2048,
+        prompt="a fox is sitting on a bench",
+        sd_steps=5,
+        sd_sampler=SDSampler.ddim,
+    )
+    model(image, mask, config)
+
+
+def warmup(
+    model,
+    sizes: List[Tuple[int, int]],
+    hd_strategies: List[HDStrategy],
+    times: int = 2,
+) -> float:
+    """
+    Run model on every size and hd strategy, so the first real request doesn't pay
+    for TorchScript shape specialization and cuDNN/oneDNN kernel selection.
+    TorchScript profiling executor optimizes the graph on the second run of a shape,
+    so every shape runs twice by default.
+
+    Args:
+        model: ModelManager
+        sizes: list of (height, width)
+        hd_strategies:
+        times: number of runs of each size and hd strategy
+
+    Returns:
+        seconds used
+    """
+    start = time.time()
+    for size in sizes:
+        for hd_strategy in hd_strategies:
+            run_start = time.time()
+            for _ in range(times):
+                run_model(model, size, hd_strategy)
+            logger.info(
+                f"Warmup {model.name} size: {size} hd_strategy: {hd_strategy.value} "
+                f"{(time.time() - run_start) / times * 1000:.2f}ms/run"
+            )
+    return time.time() - start